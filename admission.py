@@ -0,0 +1,112 @@
+"""
+Admission control of the API: per-account token buckets weighted by the cost of the request and the admission
+of the connections to the thread pool, which sheds the load when too many of them wait for a free thread.
+Both are O(1) per request. The state is kept in the process, in the pre-fork mode every worker has its own limits.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class RateLimiter(object):
+    """
+    Token bucket per key: the bucket holds up to burst tokens and is refilled with rate tokens per second.
+    A request is admitted when the bucket has min(cost, burst) tokens and takes its whole cost, so a request
+    bigger than the burst can pass a full bucket and leaves it in debt. Buckets are kept for capacity keys
+    in LRU order, an evicted key starts with a full bucket again.
+    """
+    def __init__(self, rate, burst, capacity=10000, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.capacity = capacity
+        self.clock = clock
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+        self.admitted = 0
+        self.rejected = 0
+
+    def allow(self, key, cost=1):
+        now = self.clock()
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                tokens = self.burst
+                if len(self.buckets) >= self.capacity:
+                    self.buckets.popitem(last=False)
+            else:
+                tokens, updated = bucket
+                tokens = min(self.burst, tokens + (now - updated) * self.rate)
+                self.buckets.move_to_end(key)
+            if tokens >= min(cost, self.burst):
+                tokens -= cost
+                admitted = True
+                self.admitted += 1
+            else:
+                admitted = False
+                self.rejected += 1
+            self.buckets[key] = (tokens, now)
+            return admitted
+
+    def stats(self):
+        return {"admitted": self.admitted, "rejected": self.rejected, "accounts": len(self.buckets)}
+
+
+class ConcurrencyLimiter(object):
+    """
+    Admission of the work for a pool of limit workers: up to limit units run and up to max_queue wait for
+    a worker, the others are shed at once instead of waiting in the queue. acquire() is called before the unit
+    is queued, start() when a worker takes it and release() when it is done.
+    """
+    def __init__(self, limit, max_queue=0):
+        self.limit = limit
+        self.max_queue = max_queue
+        self.active = 0
+        self.queued = 0
+        self.shed = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        :return True when the unit is admitted to the queue, False when it is shed
+        """
+        with self.lock:
+            if self.active + self.queued >= self.limit + self.max_queue:
+                self.shed += 1
+                return False
+            self.queued += 1
+            return True
+
+    def start(self):
+        with self.lock:
+            self.queued -= 1
+            self.active += 1
+
+    def cancel(self):
+        """
+        the admitted unit is dropped before a worker takes it
+        """
+        with self.lock:
+            self.queued -= 1
+
+    def release(self):
+        with self.lock:
+            self.active -= 1
+
+    def stats(self):
+        return {"active": self.active, "queued": self.queued, "shed": self.shed}
+
+
+def request_cost(method, arguments):
+    """
+    cost of the request in tokens: the number of the client ids or of the batch items, 1 for the others
+    """
+    if isinstance(arguments, dict):
+        if method == "clients_interests":
+            values = arguments.get("client_ids")
+        elif method == "online_score_batch":
+            values = arguments.get("items")
+        else:
+            values = None
+        if isinstance(values, list) and values:
+            return len(values)
+    return 1
@@ -2,17 +2,31 @@
 # -*- coding: utf-8 -*-
 
 import abc
-import json
+import collections
 import datetime
+import functools
+import inspect
 import logging
 import re
-import hashlib
-import uuid
-from optparse import OptionParser
+import os
+import selectors
+import signal
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from http.server import BaseHTTPRequestHandler, HTTPServer
 
-from scoring import get_interests, get_score
-from store import MockStore, MockStoreConnection
+from scoring import get_interests_many, get_score, get_scores_many
+import logs
+import metrics
+import profiling
+import serializers
+from auth import AuthVerifier
+from memo import ResponseMemo
+from admission import ConcurrencyLimiter, RateLimiter, request_cost
+from breaker import CircuitBreaker, STATES as BREAKER_STATES
+from store import MockStore, MockStoreConnection, StoreConnectionPool, TieredStore, BreakerStore, MeteredStore
 
 SALT = "Otus"
 ADMIN_LOGIN = "admin"
@@ -22,13 +36,25 @@ BAD_REQUEST = 400
 FORBIDDEN = 403
 NOT_FOUND = 404
 INVALID_REQUEST = 422
+TOO_MANY_REQUESTS = 429
 INTERNAL_ERROR = 500
+SERVICE_UNAVAILABLE = 503
+MAX_BATCH_SIZE = 10000
+MAX_PROFILE_REQUESTS = 100000
+ADMIN_METHODS = ("profile",)
+KEEPALIVE_TIMEOUT = 15
+MAX_REQUESTS_PER_CONNECTION = 1000
+MAX_QUEUE = 64
+SHED_LINGER = 1
+GZIP_LEVEL = 5
 ERRORS = {
     BAD_REQUEST: "Bad Request",
     FORBIDDEN: "Forbidden",
     NOT_FOUND: "Not Found",
     INVALID_REQUEST: "Invalid Request",
+    TOO_MANY_REQUESTS: "Too Many Requests",
     INTERNAL_ERROR: "Internal Server Error",
+    SERVICE_UNAVAILABLE: "Service Unavailable",
 }
 UNKNOWN = 0
 MALE = 1
@@ -42,6 +68,38 @@ GENDERS = {
 ###--------------------------------------------- Create Descriptors ------------------------------------------
 
 
+@functools.lru_cache(maxsize=1024)
+def parse_date(value):
+    """
+    function parses the date in format DD.MM.YYYY without strptime, the recent dates are taken from the cache
+    :return datetime.date or raises ValueError
+    """
+    day, month, year = value.split('.')
+    if not (0 < len(day) <= 2 and 0 < len(month) <= 2 and len(year) == 4 and
+            (day + month + year).isascii() and (day + month + year).isdigit()):
+        raise ValueError('{} is not in format DD.MM.YYYY'.format(value))
+    return datetime.date(int(year), int(month), int(day))
+
+
+class Today(object):
+    """
+    today's date, datetime.date.today() is called again only after the midnight
+    """
+    def __init__(self):
+        self.date = None
+        self.tomorrow = 0.
+
+    def __call__(self):
+        now = time.time()
+        if now >= self.tomorrow:
+            self.date = datetime.date.today()
+            self.tomorrow = time.mktime((self.date + datetime.timedelta(days=1)).timetuple())
+        return self.date
+
+
+today = Today()
+
+
 class Fields:
     __metaclass__ = abc.ABCMeta
 
@@ -59,11 +117,13 @@ class Fields:
     def __set__(self, instance, value):
         if self.required and value is None:
             raise ValueError('{} is a required field'.format(self.public_name))
-        self.validate(value)
-        setattr(instance, self.private_name, value)
+        setattr(instance, self.private_name, self.validate(value))
 
     @abc.abstractmethod
     def validate(self, value):
+        """
+        checks the value and returns the value to store, which is parsed once here for the fields like dates
+        """
         pass
 
 
@@ -71,57 +131,65 @@ class CharField(Fields):
     def validate(self, value):
         if not isinstance(value, str) and value is not None:
             raise TypeError('{} must be a string'.format(self.public_name))
+        return value
 
 
 class ArgumentsField(Fields):
     def validate(self, value):
         if not isinstance(value, dict):
             raise TypeError('{} must be a dictionary'.format(self.public_name))
+        return value
 
 
 class EmailField(Fields):
+    email_templ = re.compile(r'\w+@[a-z]+\.[a-z]+')
+
     def validate(self, value):
-        email_ = r'\w+@[a-z]+\.[a-z]+'
-        email_templ = re.compile(email_)
         if value is not None:
             if not isinstance(value, str):
                 raise TypeError('{} must be a string'.format(self.public_name))
-            elif not email_templ.fullmatch(value):
+            elif not self.email_templ.fullmatch(value):
                 raise ValueError('{} is not an email address'.format(self.public_name))
+        return value
 
 
 class PhoneField(Fields):
+    phone_templ = re.compile(r'7\d{10}')
+
     def validate(self, value):
-        phone_ = r'7\d{10}'
-        phone_templ = re.compile(phone_)
         if value is not None:
             if not isinstance(value, (str, int)):
                 raise TypeError('{} must be a string or an integer'.format(self.public_name))
-            elif ((isinstance(value, str) and not phone_templ.fullmatch(value)) or
+            elif ((isinstance(value, str) and not self.phone_templ.fullmatch(value)) or
                   (isinstance(value, int) and value//7e+10 < 1.)):
                 raise ValueError('{} is not a phone number, should start with 7'.format(self.public_name))
+        return value
 
 
 class DateField(Fields):
     def validate(self, value):
         if value is not None:
+            if not isinstance(value, str):
+                raise TypeError('{} must be a string'.format(self.public_name))
             try:
-                datetime.datetime.strptime(value, '%d.%m.%Y')
+                value = parse_date(value)
             except ValueError:
                 raise ValueError('{} must be a correct data, in format DD.MM.YYYY'.format(self.public_name))
+        return value
 
 
 class BirthDayField(Fields):
     def validate(self, value):
-        now = datetime.datetime.today()
         if value is not None:
+            if not isinstance(value, str):
+                raise TypeError('{} must be a string'.format(self.public_name))
             try:
-                data_tmp = datetime.datetime.strptime(value, '%d.%m.%Y')
+                value = parse_date(value)
             except ValueError:
                 raise TypeError('{} must be a correct data, in format DD.MM.YYYY'.format(self.public_name))
-            else:
-                if (now - data_tmp).days / 365 > 70:
-                    raise ValueError('{} is older than 70 yeahs'.format(self.public_name))
+            if (today() - value).days / 365 > 70:
+                raise ValueError('{} is older than 70 yeahs'.format(self.public_name))
+        return value
 
 
 class GenderField(Fields):
@@ -131,6 +199,7 @@ class GenderField(Fields):
                 raise TypeError('{} must be an integer'.format(self.public_name))
             elif value not in [0, 1, 2]:
                 raise ValueError('{} must be one of [0, 1, 2]'.format(self.public_name))
+        return value
 
 
 class ClientIDsField(Fields):
@@ -141,11 +210,53 @@ class ClientIDsField(Fields):
             raise ValueError('{} must be non empty list'.format(self.public_name))
         elif sum([isinstance(i, (int, float)) for i in value]) != len(value):
             raise ValueError('{} must be a list of numbers'.format(self.public_name))
+        return value
+
+
+class ArgumentsListField(Fields):
+    def validate(self, value):
+        if not isinstance(value, list):
+            raise TypeError('{} must be a list'.format(self.public_name))
+        if len(value) == 0:
+            raise ValueError('{} must be non empty list'.format(self.public_name))
+        elif len(value) > MAX_BATCH_SIZE:
+            raise ValueError('{} must have not more than {} items'.format(self.public_name, MAX_BATCH_SIZE))
+        return value
+
+
+class ChoiceField(Fields):
+    def __init__(self, choices, required, nullable=None):
+        super().__init__(required, nullable)
+        self.choices = choices
+
+    def validate(self, value):
+        if value is not None and value not in self.choices:
+            raise ValueError('{} must be one of {}'.format(self.public_name, list(self.choices)))
+        return value
+
+
+class PositiveNumberField(Fields):
+    def __init__(self, maximum, required, nullable=None, integer=False):
+        super().__init__(required, nullable)
+        self.maximum = maximum
+        self.types = int if integer else (int, float)
+
+    def validate(self, value):
+        if value is not None:
+            if not isinstance(value, self.types) or isinstance(value, bool):
+                raise TypeError('{} must be {}'.format(self.public_name,
+                                                       'an integer' if self.types is int else 'a number'))
+            elif not 0 < value <= self.maximum:
+                raise ValueError('{} must be greater than 0 and not greater than {}'.format(
+                    self.public_name, self.maximum))
+        return value
 
 
 ###------------------------------------------ Create API -------------------------------------------------
 
 class ClientsInterestsRequest(object):
+    __slots__ = ('_client_ids', '_date')
+    pairs = (('client_ids',),)
     client_ids = ClientIDsField(required=True)
     date = DateField(required=False, nullable=True)
 
@@ -158,6 +269,8 @@ class ClientsInterestsRequest(object):
 
 
 class OnlineScoreRequest(object):
+    __slots__ = ('_first_name', '_last_name', '_email', '_phone', '_birthday', '_gender')
+    pairs = (('phone', 'email'), ('first_name', 'last_name'), ('gender', 'birthday'))
     first_name = CharField(required=False, nullable=True)
     last_name = CharField(required=False, nullable=True)
     email = EmailField(required=False, nullable=True)
@@ -181,7 +294,35 @@ class OnlineScoreRequest(object):
         self.gender = gender
 
 
+class OnlineScoreBatchRequest(object):
+    __slots__ = ('_items',)
+    items = ArgumentsListField(required=True)
+
+    def __init__(self, items=None):
+        self.items = items
+
+
+class ProfileRequest(object):
+    __slots__ = ('_action', '_mode', '_seconds', '_requests')
+    action = ChoiceField(("start", "status"), required=False, nullable=True)
+    mode = ChoiceField((profiling.SAMPLING, profiling.CPROFILE), required=False, nullable=True)
+    seconds = PositiveNumberField(profiling.MAX_SECONDS, required=False, nullable=True)
+    requests = PositiveNumberField(MAX_PROFILE_REQUESTS, required=False, nullable=True, integer=True)
+
+    def __init__(
+            self,
+            action="start",
+            mode=profiling.SAMPLING,
+            seconds=profiling.DEFAULT_SECONDS,
+            requests=None):
+        self.action = action
+        self.mode = mode
+        self.seconds = seconds
+        self.requests = requests
+
+
 class MethodRequest(object):
+    __slots__ = ('_login', '_token', '_arguments', '_method', '_account')
     account = CharField(required=False, nullable=True)
     login = CharField(required=True, nullable=True)
     token = CharField(required=True, nullable=True)
@@ -206,21 +347,74 @@ class MethodRequest(object):
         return self.login == ADMIN_LOGIN
 
 
+###-------------------------------------------- Compile Validators -------------------------------------------
+
+def compile_validator(cls):
+    """
+    function turns the field declarations of the request class into one validation function: the input
+    dictionary is passed once, fields are checked in the order of cls.__init__ arguments (so the first error
+    is the same as for the descriptors), the pairs from cls.pairs are checked with bit masks; the values are
+    written straight to the __slots__ of the instance
+    :return function, which takes dict of arguments and returns the instance of cls or raises TypeError, ValueError
+    """
+    params = list(inspect.signature(cls.__init__).parameters.values())[1:]
+    for p in params:
+        if p.kind in (p.VAR_POSITIONAL, p.VAR_KEYWORD):
+            raise TypeError('{}.__init__() can not take *{}, every argument must be a field'.format(
+                cls.__qualname__, p.name))
+    fields = tuple((p.name, None if p.default is p.empty else p.default, cls.__dict__[p.name], 1 << n,
+                    cls.__dict__['_' + p.name].__set__) for n, p in enumerate(params))
+    bits = {name: bit for name, _, _, bit, _ in fields}
+    pair_masks = tuple(sum(bits[name] for name in pair) for pair in getattr(cls, 'pairs', ()))
+    unexpected = '{}.__init__() got an unexpected keyword argument '.format(cls.__qualname__)
+
+    def validate(data):
+        if not isinstance(data, dict):
+            raise TypeError('argument after ** must be a mapping, not {}'.format(type(data).__name__))
+        for key in data:
+            if key not in bits:
+                raise TypeError(unexpected + repr(key))
+        instance = object.__new__(cls)
+        mask = 0
+        for name, default, field, bit, set_slot in fields:
+            value = data.get(name, default)
+            if value is None:
+                if field.required:
+                    raise ValueError('{} is a required field'.format(name))
+            else:
+                mask |= bit
+            set_slot(instance, field.validate(value))
+        if pair_masks and not any(mask & pair == pair for pair in pair_masks):
+            raise ValueError('Arguments dictionary does not have required keys')
+        return instance
+
+    return validate
+
+
+validate_method_request = compile_validator(MethodRequest)
+validate_online_score_request = compile_validator(OnlineScoreRequest)
+validate_clients_interests_request = compile_validator(ClientsInterestsRequest)
+validate_online_score_batch_request = compile_validator(OnlineScoreBatchRequest)
+validate_profile_request = compile_validator(ProfileRequest)
+
+
 ###--------------------------------------------------- Methcds ---------------------------------------------------
 
+auth_verifier = AuthVerifier(SALT, ADMIN_SALT)
+# memoization of clients_interests responses, it is switched on by --memo-size
+response_memo = None
+# per-account rate limiting, switched on by --rate
+rate_limiter = None
+metrics.registry.register(metrics.stats_collector("scoring_auth", auth_verifier.stats))
+
+
 def check_auth(request):
     """
     function check the authority and than check that the hashed login corresponds to the token that has been sent
     Takes request event
     :return bool
     """
-    if request.is_admin:
-        digest = hashlib.sha512((datetime.datetime.now().strftime("%Y%m%d%H") + ADMIN_SALT).encode('utf-8')).hexdigest()
-    else:
-        digest = hashlib.sha512((request.account + request.login + SALT).encode('utf-8')).hexdigest()
-    if digest == request.token:
-        return True
-    return False
+    return auth_verifier.verify(request)
 
 
 def get_score_response(request, request_local, store):
@@ -232,9 +426,45 @@ def get_score_response(request, request_local, store):
         response = {'score': 42}
         context = {}
     else:
-        scoring_request_dict = {k[1:]: str(v) for k, v in request_local.__dict__.items() if v is not None}
-        response = {'score': get_score(store, **scoring_request_dict)}
-        context = {'has': [k for k, v in scoring_request_dict.items() if v is not None]}
+        r = request_local
+        response = {'score': get_score(store, r.phone, r.email, r.birthday, r.gender, r.first_name, r.last_name)}
+        context = {'has': [slot[1:] for slot in r.__slots__ if getattr(r, slot) is not None]}
+    return response, context
+
+
+def get_score_arguments(request_local):
+    """
+    function makes get_score keyword arguments from the validated OnlineScoreRequest, the values are passed as
+    they are
+    :return dict
+    """
+    values = ((slot[1:], getattr(request_local, slot)) for slot in request_local.__slots__)
+    return {name: value for name, value in values if value is not None}
+
+
+def get_score_batch_response(request, request_local, store):
+    """
+    function validates every item of the batch on its own and calculates scores of the valid ones
+    with one cache multi-get and multi-set, return per-item responses and aggregated logging context
+    :return List[dict], dict[str, int]
+    """
+    response = []
+    valid = []
+    for n, arguments in enumerate(request_local.items):
+        try:
+            valid.append((n, validate_online_score_request(arguments)))
+            response.append(None)
+        except (TypeError, ValueError) as e:
+            response.append(make_response(INVALID_REQUEST, getattr(e, 'message', str(e))))
+    context = {'nitems': len(response), 'nerrors': len(response) - len(valid)}
+    if request.is_admin:
+        scores = [42] * len(valid)
+    else:
+        scoring_requests = [get_score_arguments(item) for _, item in valid]
+        scores = get_scores_many(store, scoring_requests)
+        context['has'] = dict(collections.Counter(k for r in scoring_requests for k in r))
+    for (n, _), score in zip(valid, scores):
+        response[n] = make_response(OK, {'score': score})
     return response, context
 
 
@@ -243,11 +473,27 @@ def get_interest_response(request, request_local, store):
     function calculate interest, return interest and logging context
     :return dict[str, List[str]], dict[str, List[int]]
     """
-    response = {str(i): get_interests(store, str(i)) for i in request_local.client_ids}
+    response = get_interests_many(store, request_local.client_ids)
     context = {'nclients': len(request_local.client_ids)}
     return response, context
 
 
+def get_profile_response(request, request_local, store):
+    """
+    function starts a profiling session of this process or returns the status of the last one,
+    the result is written to the file from the status when the session is done
+    :return dict, dict
+    """
+    if request_local.action == "status":
+        return profiling.profiler.status(), {}
+    # the null values of the nullable fields mean the defaults
+    mode = request_local.mode or profiling.SAMPLING
+    seconds = profiling.DEFAULT_SECONDS if request_local.seconds is None else request_local.seconds
+    started, status = profiling.profiler.start(mode, seconds, request_local.requests)
+    status["started_now"] = started
+    return status, {"profile": mode}
+
+
 def method_apply(request, store):
     """
     function tries to evaluate scoring or interest with check of variables validity first
@@ -256,33 +502,109 @@ def method_apply(request, store):
     method, arguments = request.method, request.arguments
     context = {}
     available_methods = {
-        "online_score": (OnlineScoreRequest, get_score_response),
-        "clients_interests": (ClientsInterestsRequest, get_interest_response)
+        "online_score": (validate_online_score_request, get_score_response),
+        "clients_interests": (validate_clients_interests_request, get_interest_response),
+        "online_score_batch": (validate_online_score_batch_request, get_score_batch_response),
+        "profile": (validate_profile_request, get_profile_response),
     }
+    if method in ADMIN_METHODS and not request.is_admin:
+        logging.debug("Method %s is only for admin", method)
+        return FORBIDDEN, ERRORS[FORBIDDEN], context
     try:
-        local_request = available_methods[method][0](**arguments)
-        notnullable = [k for k, v in local_request.__dict__.items() if v is not None]
-        if (('_client_ids' in notnullable) or
-            ('_phone' in notnullable and '_email' in notnullable) or
-            ('_first_name' in notnullable and '_last_name' in notnullable) or
-            ('_gender' in notnullable and '_birthday' in notnullable)):
-            pass
-        else:
-            raise ValueError('Arguments dictionary does not have required keys')
+        local_request = available_methods[method][0](arguments)
     except (TypeError, ValueError) as e:
-        logging.info("Validation error: %s" % e)
+        logging.debug("Validation error: %s", e)
         code = INVALID_REQUEST
         response = getattr(e, 'message', str(e))
     except KeyError as e:
-        logging.info("Attribute method is not valid: %s" % e)
+        logging.debug("Attribute method is not valid: %s", e)
         code, response = INVALID_REQUEST, ERRORS[INVALID_REQUEST]
     else:
-        code = OK
-        response, context = available_methods[method][1](request, local_request, store)
-    logging.info(response)
+        try:
+            response, context = available_methods[method][1](request, local_request, store)
+            code = OK
+        except profiling.ProfileError as e:
+            logging.info("Profiling is not started: %s", e)
+            code, response = INVALID_REQUEST, str(e)
+    logging.debug("Response: %s", response)
     return code, response, context
 
 
+###---------------------------------------------------- Metrics ---------------------------------------------------
+
+METRIC_METHODS = frozenset(("online_score", "clients_interests", "online_score_batch", "profile"))
+# by default a request records one histogram, --detailed-metrics adds the stages, the parsing and the store calls
+detailed_metrics = False
+parse_seconds = metrics.registry.histogram("scoring_parse_seconds", (), "Parsing of the request body")
+request_histograms = {}
+
+
+def request_histogram(method, code):
+    """
+    histogram of the whole request of the method with the code, it is kept in request_histograms
+    """
+    histogram = request_histograms[method, code] = metrics.registry.histogram(
+        "scoring_request_seconds", (("method", method), ("code", code)),
+        "Requests of method_handler by method and response code")
+    return histogram
+
+
+@functools.lru_cache(maxsize=None)
+def stage_histograms(method):
+    """
+    histograms of the validate, auth and apply stages of the method
+    """
+    return tuple(metrics.registry.histogram("scoring_stage_seconds", (("method", method), ("stage", stage)),
+                                            "Stages of method_handler") for stage in ("validate", "auth", "apply"))
+
+
+def observe_request(method, code, started, validated, authorized, applied):
+    """
+    function records the time of the request and, with the detailed metrics, of the stages which the request
+    has passed, authorized and applied are None when the request did not get to the stage; the unknown methods
+    share one label
+    """
+    if method not in METRIC_METHODS:
+        method = "unknown"
+    finished = applied if applied is not None else authorized if authorized is not None else validated
+    try:
+        histogram = request_histograms[method, code]
+    except KeyError:
+        histogram = request_histogram(method, code)
+    histogram.observe(finished - started)
+    if detailed_metrics:
+        validate, auth, apply = stage_histograms(method)
+        validate.observe(validated - started)
+        if authorized is not None:
+            auth.observe(authorized - validated)
+        if applied is not None:
+            apply.observe(applied - authorized)
+
+
+def breaker_collector(breaker):
+    """
+    collector of the circuit breaker: a 0/1 gauge per state, the failures in a row and the counters of the
+    transitions between the states
+    """
+    def collect():
+        snapshot = breaker.snapshot()
+        samples = [("scoring_breaker_state", (("state", state),), int(state == snapshot["state"]))
+                   for state in BREAKER_STATES]
+        samples.append(("scoring_breaker_failures", (), snapshot["failures"]))
+        for transition, count in sorted(snapshot["transitions"].items()):
+            old, new = transition.split("->")
+            samples.append(("scoring_breaker_transitions_total", (("from", old), ("to", new)), count))
+        return samples
+    return collect
+
+
+def metrics_handler():
+    """
+    :return: metrics in the Prometheus text format
+    """
+    return metrics.registry.render()
+
+
 def method_handler(request, ctx, store):
     """
     function check the validity of request's attributes, if correct return result from function method_apply
@@ -290,82 +612,619 @@ def method_handler(request, ctx, store):
     :param ctx: logging dictionary
     :return: response and code, is the request successful or not
     """
+    clock = time.perf_counter
+    started = clock()
+    method = authorized = applied = None
     request_body, request_header = request['body'], request['headers']
     try:
-        request_obj = MethodRequest(**request_body)
+        request_obj = validate_method_request(request_body)
     except (TypeError, ValueError) as e:
-        logging.info("Validation had not passed: %s" % getattr(e, 'message', str(e)))
+        validated = clock()
+        logging.debug("Validation had not passed: %s", e)
         code, response = INVALID_REQUEST, ERRORS[INVALID_REQUEST]
     else:
-        if not check_auth(request_obj):
+        method = request_obj.method
+        validated = clock()
+        authenticated = check_auth(request_obj)
+        authorized = clock()
+        if not authenticated:
             code, response = FORBIDDEN, 'Authorization is failed'
-            logging.info("Authorization is failed")
+            logging.debug("Authorization is failed")
+        elif (rate_limiter is not None and not request_obj.is_admin and
+              not rate_limiter.allow((request_obj.account, request_obj.login),
+                                     request_cost(request_obj.method, request_obj.arguments))):
+            code, response = TOO_MANY_REQUESTS, ERRORS[TOO_MANY_REQUESTS]
+            logging.debug("Rate limit of %s/%s is exceeded", request_obj.account, request_obj.login)
         else:
             try:
-                code, response, context = method_apply(request_obj, store)
+                if response_memo is not None:
+                    code, response, context = response_memo.apply(request_obj, store, method_apply, OK)
+                else:
+                    code, response, context = method_apply(request_obj, store)
                 ctx.update(context)
             except ConnectionError as e:
-                logging.info("Validation had not passed: %s" % getattr(e, 'message', str(e)))
+                logging.info("Store is not available: %s", e)
                 code, response = INTERNAL_ERROR, ERRORS[INTERNAL_ERROR]
+            applied = clock()
+    observe_request(method, code, started, validated, authorized, applied)
+    return response, code
+
+
+def route_request(router, path, data_string, headers, context, store):
+    """
+    function parses the body of POST request and passes it to the handler of the path,
+    it is shared by the blocking and the asyncio servers
+    :return: response and code
+    """
+    response, code = {}, OK
+    request = None
+    started = time.perf_counter() if detailed_metrics else None
+    try:
+        request = serializers.loads(data_string)
+    except:
+        code = BAD_REQUEST
+    if started is not None:
+        parse_seconds.observe(time.perf_counter() - started)
+
+    if request:
+        path = path.strip("/")
+        logging.debug("%s: %s %s", path, data_string, context["request_id"])
+        if path in router:
+            try:
+                response, code = profiling.profiler.call(router[path], {"body": request, "headers": headers},
+                                                         context, store)
+            except Exception as e:
+                logging.exception("Unexpected error: %s", e)
+                code = INTERNAL_ERROR
+        else:
+            code = NOT_FOUND
     return response, code
 
 
+def make_response(code, response):
+    """
+    function wraps the result of the handler into the response structure
+    :return dict
+    """
+    if code not in ERRORS:
+        return {"response": response, "code": code}
+    return {"error": response or ERRORS.get(code, "Unknown Error"), "code": code}
+
+
+class LazyStore(object):
+    """
+    class attribute which creates the store on the first use, so importing the module does not build it;
+    assigning the attribute of the class replaces it with the given store
+    """
+    def __init__(self, factory):
+        self.factory = factory
+        self.store = None
+        self.lock = threading.Lock()
+
+    def __get__(self, instance, owner):
+        if self.store is None:
+            with self.lock:
+                if self.store is None:
+                    self.store = self.factory()
+        return self.store
+
+
+def warm_up(handler_class):
+    """
+    function creates and connects the store of the handler and computes the admin token, so the first
+    request of a worker does not pay for them; it runs in every worker after the fork
+    """
+    store = handler_class.store
+    connect = getattr(store, "connect", None)
+    if connect is not None:
+        connect()
+    auth_verifier.admin_digest()
+
+
+def get_request_id(headers):
+    return headers.get('HTTP_X_REQUEST_ID') or os.urandom(16).hex()
+
+
 class MainHTTPHandler(BaseHTTPRequestHandler):
     router = {
         "method": method_handler
     }
-    store = MockStore(MockStoreConnection)
+    get_router = {
+        "metrics": metrics_handler
+    }
+    store = LazyStore(lambda: MockStore(MockStoreConnection()))
+    requests_served = 0
+    counter_lock = threading.Lock()
+    # persistent connections: idle timeout in seconds, limit of requests per connection,
+    # responses from gzip_min_size bytes are compressed for the clients which accept gzip, 0 - never
+    protocol_version = "HTTP/1.1"
+    timeout = KEEPALIVE_TIMEOUT
+    max_requests = MAX_REQUESTS_PER_CONNECTION
+    gzip_min_size = 0
+    disable_nagle_algorithm = True
+
+    @classmethod
+    def count_request(cls):
+        with cls.counter_lock:
+            cls.requests_served += 1
+
+    def setup(self):
+        super().setup()
+        self.connection_requests = 0
+        self.parked = False
+
+    def handle(self):
+        # the thread pool server does not keep a thread for an idle persistent connection: the requests which
+        # are already read are handled, then the connection is parked until the next one comes
+        if not getattr(self.server, 'parks_connections', False):
+            return super().handle()
+        self.handle_one_request()
+        while not self.close_connection and self.buffered():
+            self.handle_one_request()
+        self.parked = not self.close_connection
+
+    def resume(self):
+        """
+        handles the requests of the parked connection when it is readable again
+        """
+        self.parked = False
+        self.handle()
+        self.finish()
+
+    def finish(self):
+        if not self.parked:
+            super().finish()
+
+    def buffered(self):
+        """
+        :return True when the next request is already read into the buffer of rfile, the call does not block
+        """
+        self.connection.setblocking(False)
+        try:
+            return bool(self.rfile.peek(1))
+        except OSError:
+            return False
+        finally:
+            self.connection.settimeout(self.timeout)
 
     def get_request_id(self, headers):
-        return headers.get('HTTP_X_REQUEST_ID', uuid.uuid4().hex)
+        return get_request_id(headers)
+
+    def log_message(self, format, *args):
+        # the access log goes through the logging pipeline instead of the synchronous writes to stderr
+        logging.debug("%s " + format, self.address_string(), *args)
 
     def do_POST(self):
-        response, code = {}, OK
+        self.count_request()
+        self.connection_requests += 1
         context = {"request_id": self.get_request_id(self.headers)}
-        request = None
         data_string = None
         try:
             data_string = self.rfile.read(int(self.headers['Content-Length']))
-            request = json.loads(data_string)
         except:
-            code = BAD_REQUEST
-
-        if request:
-            path = self.path.strip("/")
-            logging.info("%s: %s %s" % (self.path, data_string, context["request_id"]))
-            if path in self.router:
-                try:
-                    response, code = self.router[path]({"body": request, "headers": self.headers}, context, self.store)
-                except Exception as e:
-                    logging.exception("Unexpected error: %s" % e)
-                    code = INTERNAL_ERROR
-            else:
-                code = NOT_FOUND
+            # the body without length can not be separated from the next request
+            self.close_connection = True
+        response, code = route_request(self.router, self.path, data_string, self.headers, context, self.store)
+
+        r = make_response(code, response)
+        context.update(r)
+        logs.log_request(context, code)
+        self.send_body(code, serializers.dumps(r), "application/json")
 
+    def do_GET(self):
+        self.count_request()
+        self.connection_requests += 1
+        path = self.path.strip("/")
+        if path in self.get_router:
+            self.send_body(OK, self.get_router[path]().encode('utf-8'), "text/plain; version=0.0.4")
+        else:
+            self.send_body(NOT_FOUND, serializers.dumps(make_response(NOT_FOUND, None)), "application/json")
+
+    def send_body(self, code, body, content_type):
         self.send_response(code)
-        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Type", content_type)
+        if self.gzip_min_size:
+            self.send_header("Vary", "Accept-Encoding")
+            if len(body) >= self.gzip_min_size and 'gzip' in self.headers.get('Accept-Encoding', ''):
+                import gzip
+                body = gzip.compress(body, GZIP_LEVEL)
+                self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        # an idle connection would block a server which handles one connection at a time
+        if self.connection_requests >= self.max_requests or not getattr(self.server, 'concurrent', False):
+            self.close_connection = True
+        if self.close_connection:
+            self.send_header("Connection", "close")
         self.end_headers()
-        if code not in ERRORS:
-            r = {"response": response, "code": code}
+        self.wfile.write(body)
+
+
+class ConnectionWatcher(object):
+    """
+    One thread which waits with a selector for the sockets to become readable and calls on_ready(),
+    or on_expire() when nothing comes in timeout seconds. The selector and the thread are created by start(),
+    so every forked worker has its own.
+    """
+    def __init__(self):
+        self.selector = None
+        self.incoming = collections.deque()
+        self.running = False
+        self.lock = threading.Lock()
+
+    def start(self):
+        self.selector = selectors.DefaultSelector()
+        self.wakeup, self.waker = socket.socketpair()
+        self.wakeup.setblocking(False)
+        self.waker.setblocking(False)
+        self.selector.register(self.wakeup, selectors.EVENT_READ)
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='watcher', daemon=True)
+        self.thread.start()
+
+    def add(self, sock, on_ready, on_expire, timeout):
+        """
+        function passes the socket to the thread of the watcher, it can be called from any thread
+        """
+        with self.lock:
+            added = self.running
+            if added:
+                self.incoming.append((sock, on_ready, on_expire, timeout))
+        if not added:
+            on_expire()
+            return
+        try:
+            self.waker.send(b'\0')
+        except OSError:
+            pass
+
+    def watch(self, sock, on_ready, on_expire, timeout):
+        """
+        function starts watching the socket, it is called only in the thread of the watcher
+        """
+        self.selector.register(sock, selectors.EVENT_READ, (on_ready, on_expire, time.monotonic() + timeout))
+
+    def run(self):
+        next_check = 0
+        while self.running:
+            for key, _ in self.selector.select(0.5):
+                if key.data is None:
+                    try:
+                        self.wakeup.recv(4096)
+                    except OSError:
+                        pass
+                    continue
+                self.selector.unregister(key.fileobj)
+                self.call(key.data[0])
+            while self.incoming:
+                self.watch(*self.incoming.popleft())
+            now = time.monotonic()
+            if now >= next_check:
+                next_check = now + 0.5
+                for key in list(self.selector.get_map().values()):
+                    if key.data is not None and key.data[2] <= now:
+                        self.selector.unregister(key.fileobj)
+                        self.call(key.data[1])
+        for key in list(self.selector.get_map().values()):
+            if key.data is not None:
+                self.call(key.data[1])
+        while self.incoming:
+            self.call(self.incoming.popleft()[2])
+        self.selector.close()
+        self.wakeup.close()
+        self.waker.close()
+
+    def call(self, callback):
+        try:
+            callback()
+        except Exception:
+            logging.exception("Callback of the connection watcher has failed")
+
+    def stop(self):
+        with self.lock:
+            if not self.running:
+                return
+            self.running = False
+        try:
+            self.waker.send(b'\0')
+        except OSError:
+            pass
+        self.thread.join()
+
+
+class ThreadPoolHTTPServer(HTTPServer):
+    """
+    HTTPServer which handles every accepted connection in a bounded pool of threads,
+    so one slow store call does not block the other requests. An idle persistent connection
+    does not take a thread: it waits in the connection watcher and is handled again when the next request comes.
+    When all the threads are busy and max_queue connections wait for them, the next one is answered 503 at once
+    """
+    concurrent = True
+    parks_connections = True
+
+    def __init__(self, server_address, handler_class, threads, max_queue=MAX_QUEUE):
+        super().__init__(server_address, handler_class)
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='handler')
+        self.watcher = ConnectionWatcher()
+        self.limiter = ConcurrencyLimiter(threads, max_queue)
+        body = serializers.dumps(make_response(SERVICE_UNAVAILABLE, None))
+        self.shed_response = b"".join((
+            b"HTTP/1.1 503 Service Unavailable\r\nContent-Type: application/json\r\nRetry-After: 1\r\n",
+            b"Connection: close\r\nContent-Length: %d\r\n\r\n" % len(body), body))
+
+    def serve_forever(self, poll_interval=0.5):
+        self.watcher.start()
+        super().serve_forever(poll_interval)
+
+    def process_request(self, request, client_address):
+        if not self.limiter.acquire():
+            self.shed(request)
+            return
+        self.executor.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        self.limiter.start()
+        handler = None
+        try:
+            handler = self.RequestHandlerClass(request, client_address, self)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.limiter.release()
+        self.park_or_close(handler, request)
+
+    def resume_thread(self, handler):
+        self.limiter.start()
+        try:
+            handler.resume()
+        except Exception:
+            handler.parked = False
+            self.handle_error(handler.request, handler.client_address)
+        finally:
+            self.limiter.release()
+        self.park_or_close(handler, handler.request)
+
+    def park_or_close(self, handler, request):
+        if handler is not None and getattr(handler, 'parked', False):
+            self.watcher.add(request, functools.partial(self.resume, handler),
+                             functools.partial(self.close_parked, handler), handler.timeout or KEEPALIVE_TIMEOUT)
         else:
-            r = {"error": response or ERRORS.get(code, "Unknown Error"), "code": code}
-        context.update(r)
-        logging.info(context)
-        self.wfile.write(json.dumps(r))
-        return
+            self.shutdown_request(request)
+
+    def resume(self, handler):
+        if not self.limiter.acquire():
+            handler.parked = False
+            try:
+                handler.finish()
+            except OSError:
+                pass
+            self.shed(handler.request)
+            return
+        try:
+            self.executor.submit(self.resume_thread, handler)
+        except RuntimeError:
+            # the executor is shut down
+            self.limiter.cancel()
+            self.close_parked(handler)
+
+    def shed(self, request):
+        """
+        the connection does not take a thread, the watcher answers 503 when the request comes
+        """
+        self.watcher.add(request, functools.partial(self.answer_shed, request),
+                         functools.partial(self.shutdown_request, request), SHED_LINGER)
+
+    def answer_shed(self, request):
+        try:
+            # the request is read, otherwise closing the socket with unread data resets the connection
+            # before the client reads the answer
+            request.setblocking(False)
+            request.recv(65536)
+            request.sendall(self.shed_response)
+            request.shutdown(socket.SHUT_WR)
+        except OSError:
+            self.shutdown_request(request)
+            return
+        logs.log_request({"code": SERVICE_UNAVAILABLE, "error": ERRORS[SERVICE_UNAVAILABLE]}, SERVICE_UNAVAILABLE)
+        self.watcher.watch(request, functools.partial(self.linger, request),
+                           functools.partial(self.shutdown_request, request), SHED_LINGER)
+
+    def linger(self, request):
+        """
+        the rest of the request is read until the client closes the connection
+        """
+        try:
+            if request.recv(65536):
+                self.watcher.watch(request, functools.partial(self.linger, request),
+                                   functools.partial(self.shutdown_request, request), SHED_LINGER)
+                return
+        except OSError:
+            pass
+        self.shutdown_request(request)
+
+    def close_parked(self, handler):
+        handler.parked = False
+        try:
+            handler.finish()
+        except OSError:
+            pass
+        self.shutdown_request(handler.request)
+
+    def server_close(self):
+        super().server_close()
+        # the idle connections are closed, the requests which are still in progress are waited for
+        self.watcher.stop()
+        self.executor.shutdown(wait=True)
+
+
+def build_store(opts):
+    """
+    function builds the store and its wrappers from the command line options, the optional backends
+    are imported only when they are used
+    :return store
+    """
+    if opts.store:
+        from resp import RespStore
+        store = RespStore.from_url(opts.store, max(1, opts.pool_size), deadline=opts.pool_deadline)
+    elif opts.pool_size > 0:
+        store = MockStore(StoreConnectionPool(MockStoreConnection, opts.pool_size, opts.pool_deadline))
+    else:
+        store = MockStore(MockStoreConnection())
+    if opts.interests_index:
+        from interests_index import InterestsIndex, IndexedStore
+        store = IndexedStore(store, InterestsIndex(opts.interests_index))
+    if opts.breaker_threshold > 0:
+        breaker = CircuitBreaker(opts.breaker_threshold, opts.breaker_reset)
+        store = BreakerStore(store, breaker)
+        metrics.registry.register(breaker_collector(breaker), "scoring_breaker")
+    if opts.l1_size > 0:
+        store = TieredStore(store, opts.l1_size, opts.l1_ttl, opts.l1_negative_ttl)
+        metrics.registry.register(metrics.stats_collector("scoring_l1", store.stats))
+    return MeteredStore(store) if detailed_metrics else store
+
+
+def check_store_options(opts):
+    """
+    function checks the store options at startup, the store itself is built lazily in the workers,
+    so a bad url or index file would be reported only on the first request otherwise
+    :return error message or None
+    """
+    if opts.store:
+        from urllib.parse import urlparse
+        parsed = urlparse(opts.store)
+        try:
+            parsed.port
+        except ValueError as e:
+            return "invalid --store %s: %s" % (opts.store, e)
+        if parsed.scheme != "resp":
+            return "invalid --store %s: resp://host:port is expected" % opts.store
+    if opts.interests_index:
+        import struct
+        from interests_index import InterestsIndex
+        try:
+            InterestsIndex(opts.interests_index).close()
+        except (OSError, ValueError, struct.error) as e:
+            return "invalid --interests-index %s: %s" % (opts.interests_index, e)
+    return None
+
+
+def make_server(host, port, threads=0, max_queue=MAX_QUEUE):
+    """
+    function creates listening server, threads > 0 switches on the thread pool serving mode,
+    in which up to max_queue connections wait for a free thread and the others are answered 503
+    :return HTTPServer
+    """
+    if threads > 0:
+        return ThreadPoolHTTPServer((host, port), MainHTTPHandler, threads, max_queue)
+    return HTTPServer((host, port), MainHTTPHandler)
+
+
+def serve(server, worker_id=0, warm=False):
+    """
+    function serves requests until SIGTERM or SIGINT, than closes the server gracefully,
+    with warm the store is connected before the first request
+    """
+    def stop(signum, frame):
+        # shutdown() waits for serve_forever loop, so it can not be called from the same thread
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    if warm:
+        warm_up(server.RequestHandlerClass)
+    server.serve_forever()
+    server.server_close()
+    logging.info("Worker %s (pid %s) served %s requests", worker_id, os.getpid(), MainHTTPHandler.requests_served)
+
+
+def serve_forked(server, workers, warm=False):
+    """
+    function forks workers which share the listening socket of the server, the parent process
+    only waits for them and passes SIGTERM or SIGINT through
+    """
+    children = []
+    for worker_id in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 0
+            try:
+                serve(server, worker_id, warm)
+            except Exception:
+                logging.exception("Worker %s has failed", worker_id)
+                exit_code = 1
+            finally:
+                logs.stop_logging()
+                os._exit(exit_code)
+        children.append(pid)
+
+    def stop(signum, frame):
+        for child in children:
+            try:
+                os.kill(child, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for child in children:
+        os.waitpid(child, 0)
+    server.server_close()
 
 
 if __name__ == "__main__":
+    from optparse import OptionParser
     op = OptionParser()
     op.add_option("-p", "--port", action="store", type=int, default=8080)
     op.add_option("-l", "--log", action="store", default=None)
+    op.add_option("--log-level", action="store", type="choice", default="info",
+                  choices=("debug", "info", "warning", "error", "critical"))
+    op.add_option("--log-sample", action="store", type=float, default=1.)
+    op.add_option("--log-rate-limit", action="store", type=int, default=0)
+    op.add_option("--log-queue", action="store", type=int, default=logs.QUEUE_SIZE)
+    op.add_option("-w", "--workers", action="store", type=int, default=1)
+    op.add_option("-t", "--threads", action="store", type=int, default=0)
+    op.add_option("-k", "--keepalive-timeout", action="store", type=float, default=KEEPALIVE_TIMEOUT)
+    op.add_option("--max-requests", action="store", type=int, default=MAX_REQUESTS_PER_CONNECTION)
+    op.add_option("--gzip-min-size", action="store", type=int, default=0)
+    op.add_option("--profile-dir", action="store", default=None)
+    op.add_option("--warm-up", action="store_true", default=False)
+    op.add_option("--memo-size", action="store", type=int, default=0)
+    op.add_option("--memo-ttl", action="store", type=float, default=5)
+    op.add_option("--rate", action="store", type=float, default=0)
+    op.add_option("--burst", action="store", type=float, default=100)
+    op.add_option("--max-queue", action="store", type=int, default=MAX_QUEUE)
+    op.add_option("-s", "--store", action="store", default=None)
+    op.add_option("--pool-size", action="store", type=int, default=0)
+    op.add_option("--pool-deadline", action="store", type=float, default=0.5)
+    op.add_option("-i", "--interests-index", action="store", default=None)
+    op.add_option("--breaker-threshold", action="store", type=int, default=0)
+    op.add_option("--breaker-reset", action="store", type=float, default=5)
+    op.add_option("--l1-size", action="store", type=int, default=0)
+    op.add_option("--l1-ttl", action="store", type=float, default=5)
+    op.add_option("--l1-negative-ttl", action="store", type=float, default=1)
+    op.add_option("--detailed-metrics", action="store_true", default=False)
     (opts, args) = op.parse_args()
-    logging.basicConfig(filename=opts.log, level=logging.INFO,
-                        format='[%(asctime)s] %(levelname).1s %(message)s', datefmt='%Y.%m.%d %H:%M:%S')
-    server = HTTPServer(("localhost", opts.port), MainHTTPHandler)
-    logging.info("Starting server at %s" % opts.port)
-    try:
-        server.serve_forever()
-    except KeyboardInterrupt:
-        pass
-    server.server_close()
+    error = check_store_options(opts)
+    if error:
+        op.error(error)
+    logs.setup_logging(opts.log, getattr(logging, opts.log_level.upper()), {logging.INFO: opts.log_sample},
+                       opts.log_rate_limit, opts.log_queue)
+    profiling.profiler.directory = opts.profile_dir or profiling.profiler.directory
+    MainHTTPHandler.timeout = opts.keepalive_timeout
+    MainHTTPHandler.max_requests = opts.max_requests
+    MainHTTPHandler.gzip_min_size = opts.gzip_min_size
+    detailed_metrics = opts.detailed_metrics
+    MainHTTPHandler.store = LazyStore(functools.partial(build_store, opts))
+    if opts.memo_size > 0:
+        response_memo = ResponseMemo(opts.memo_size, opts.memo_ttl)
+        metrics.registry.register(metrics.stats_collector("scoring_memo", response_memo.stats))
+    if opts.rate > 0:
+        rate_limiter = RateLimiter(opts.rate, opts.burst)
+        metrics.registry.register(metrics.stats_collector("scoring_rate", rate_limiter.stats))
+    server = make_server("localhost", opts.port, opts.threads, opts.max_queue)
+    if isinstance(server, ThreadPoolHTTPServer):
+        metrics.registry.register(metrics.stats_collector("scoring_concurrency", server.limiter.stats))
+    logging.info("Starting server at %s, workers: %s, threads: %s", opts.port, opts.workers, opts.threads)
+    if opts.workers > 1:
+        serve_forked(server, opts.workers, opts.warm_up)
+    else:
+        serve(server, warm=opts.warm_up)
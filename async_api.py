@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import asyncio
+import io
+import logging
+import signal
+import http.client
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from optparse import OptionParser
+
+import logs
+import serializers
+from api import MainHTTPHandler, BAD_REQUEST, NOT_FOUND, route_request, make_response, get_request_id
+from store import AsyncMockStore, MockStoreConnection
+
+MAX_HEADERS = 100
+KEEPALIVE_TIMEOUT = 15
+THREADS = 8
+
+
+async def read_request(reader):
+    """
+    function reads one HTTP request from the stream
+    :return: method, path, version, headers and body or None if the connection was closed
+    """
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    method, path, version = request_line.decode('latin-1').split()
+    header_lines = []
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        header_lines.append(line)
+        if len(header_lines) > MAX_HEADERS:
+            raise ValueError('Too many headers')
+    headers = http.client.parse_headers(io.BytesIO(b''.join(header_lines) + b'\r\n'))
+    body = None
+    try:
+        body = await reader.readexactly(int(headers['Content-Length']))
+    except (TypeError, ValueError):
+        pass
+    return method, path, version, headers, body
+
+
+def is_keep_alive(version, headers):
+    connection = headers.get('Connection', '').lower()
+    if version == 'HTTP/1.1':
+        return connection != 'close'
+    return connection == 'keep-alive'
+
+
+def write_response(writer, code, r, keep_alive):
+    body = serializers.dumps(r)
+    head = [
+        'HTTP/1.1 %s %s' % (code, HTTPStatus(code).phrase),
+        'Content-Type: application/json',
+        'Content-Length: %s' % len(body),
+        'Connection: %s' % ('keep-alive' if keep_alive else 'close'),
+    ]
+    writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + body)
+
+
+async def handle_connection(reader, writer, store, keepalive_timeout=KEEPALIVE_TIMEOUT, executor=None):
+    """
+    function serves the requests of one connection until the client closes it or stays idle
+    longer than keepalive_timeout; the handler runs in the executor (the default one of the loop
+    when it is None), so the store calls and the scoring do not block the event loop
+    """
+    loop = asyncio.get_running_loop()
+    connect_async = getattr(store, 'connect_async', None)
+    try:
+        while True:
+            try:
+                request = await asyncio.wait_for(read_request(reader), keepalive_timeout)
+            except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+                break
+            except ValueError:
+                write_response(writer, BAD_REQUEST, make_response(BAD_REQUEST, None), False)
+                await writer.drain()
+                break
+            if request is None:
+                break
+            method, path, version, headers, body = request
+            context = {"request_id": get_request_id(headers)}
+            if method != 'POST':
+                response, code = {}, NOT_FOUND
+            else:
+                if connect_async is not None and path.strip("/") in MainHTTPHandler.router:
+                    # the back-off waits here on the event loop, all the requests share one reconnect
+                    await connect_async()
+                response, code = await loop.run_in_executor(executor, route_request, MainHTTPHandler.router, path,
+                                                            body, headers, context, store)
+            r = make_response(code, response)
+            context.update(r)
+            logs.log_request(context, code)
+            keep_alive = is_keep_alive(version, headers)
+            write_response(writer, code, r, keep_alive)
+            await writer.drain()
+            if not keep_alive:
+                break
+    finally:
+        writer.close()
+
+
+async def serve(host, port, store, keepalive_timeout=KEEPALIVE_TIMEOUT, threads=THREADS):
+    """
+    function serves requests until SIGTERM or SIGINT, the handlers run in a pool of threads
+    """
+    executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='handler')
+    server = await asyncio.start_server(
+        lambda reader, writer: handle_connection(reader, writer, store, keepalive_timeout, executor), host, port)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stop.set)
+    async with server:
+        await stop.wait()
+    await server.wait_closed()
+    executor.shutdown(wait=True)
+
+
+if __name__ == "__main__":
+    op = OptionParser()
+    op.add_option("-p", "--port", action="store", type=int, default=8080)
+    op.add_option("-l", "--log", action="store", default=None)
+    op.add_option("-k", "--keepalive-timeout", action="store", type=int, default=KEEPALIVE_TIMEOUT)
+    op.add_option("-t", "--threads", action="store", type=int, default=THREADS)
+    (opts, args) = op.parse_args()
+    logs.setup_logging(opts.log)
+    logging.info("Starting asyncio server at %s", opts.port)
+    asyncio.run(serve("localhost", opts.port, AsyncMockStore(MockStoreConnection()), opts.keepalive_timeout,
+                      opts.threads))
@@ -0,0 +1,64 @@
+import datetime
+import hashlib
+import hmac
+import threading
+import time
+
+from cache import TTLCache
+
+
+class AuthVerifier(object):
+    """
+    Token check of check_auth without the per-request hashing: digests of (account, login) are kept in a bounded
+    LRU cache, the admin token is computed once per hour and replaced at the hour boundary, tokens are compared
+    in constant time.
+    """
+    def __init__(self, salt, admin_salt, capacity=10000, clock=time.time):
+        self.salt = salt
+        self.admin_salt = admin_salt
+        self.digests = TTLCache(capacity)
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.admin_token = None
+        self.admin_expires = 0.
+        self.admin_refreshes = 0
+
+    def user_digest(self, account, login):
+        key = (account, login)
+        digest = self.digests.get(key)
+        if digest is None:
+            digest = hashlib.sha512((account + login + self.salt).encode('utf-8')).hexdigest().encode('ascii')
+            self.digests.set(key, digest)
+        return digest
+
+    def admin_digest(self):
+        now = self.clock()
+        with self.lock:
+            if now >= self.admin_expires:
+                hour = datetime.datetime.fromtimestamp(now).replace(minute=0, second=0, microsecond=0)
+                self.admin_token = hashlib.sha512(
+                    (hour.strftime("%Y%m%d%H") + self.admin_salt).encode('utf-8')).hexdigest().encode('ascii')
+                self.admin_expires = (hour + datetime.timedelta(hours=1)).timestamp()
+                self.admin_refreshes += 1
+            return self.admin_token
+
+    def verify(self, request):
+        """
+        :return True if the token of the request is valid
+        """
+        if request.is_admin:
+            digest = self.admin_digest()
+        else:
+            digest = self.user_digest(request.account, request.login)
+        return hmac.compare_digest(digest, request.token.encode('utf-8'))
+
+    def stats(self):
+        stats = self.digests.stats()
+        return {
+            "hits": stats["hits"],
+            "misses": stats["misses"],
+            "hit_ratio": stats["hits"] / (stats["hits"] + stats["misses"]) if stats["hits"] + stats["misses"] else 0.,
+            "size": stats["size"],
+            "evictions": stats["evictions"],
+            "admin_refreshes": self.admin_refreshes,
+        }
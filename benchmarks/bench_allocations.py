@@ -0,0 +1,89 @@
+"""
+Memory of the request records measured with tracemalloc: bytes per validated record with __slots__ against
+the same values kept in an instance __dict__, and the peak of the allocations of one method_handler call.
+
+    $ python -m benchmarks.bench_allocations --number 10000
+"""
+import tracemalloc
+from optparse import OptionParser
+
+import api
+from benchmarks.loadtest import sign
+from store import MockStore, MockStoreConnection
+
+CASES = {
+    "method": (api.validate_method_request,
+               {"account": "horns&hoofs", "login": "h&f", "method": "online_score", "token": "", "arguments": {}}),
+    "online_score": (api.validate_online_score_request,
+                     {"phone": "79175002040", "email": "dev@otus.ru", "gender": 1, "birthday": "01.01.2000",
+                      "first_name": "a", "last_name": "b"}),
+    "clients_interests": (api.validate_clients_interests_request, {"client_ids": [1, 2, 3], "date": "19.07.2017"}),
+    "online_score_batch": (api.validate_online_score_batch_request, {"items": [{"phone": "79175002040"}]}),
+}
+
+HANDLER_CASES = {
+    "online_score": {"phone": "79175002040", "email": "dev@otus.ru", "gender": 1, "birthday": "01.01.2000",
+                     "first_name": "a", "last_name": "b"},
+    "clients_interests": {"client_ids": [1, 2, 3], "date": "19.07.2017"},
+}
+
+
+class DictRecord(object):
+    pass
+
+
+def dict_record(record):
+    """
+    the values of the slotted record in an instance __dict__, as the records were kept before
+    """
+    copy = DictRecord()
+    for slot in record.__slots__:
+        setattr(copy, slot, getattr(record, slot))
+    return copy
+
+
+def bytes_per_object(make, number):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    objects = [make() for _ in range(number)]
+    allocated = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del objects
+    return allocated / number
+
+
+def handler_peak(request, store, number):
+    """
+    mean peak of the memory allocated by one method_handler call over the memory before the call
+    """
+    tracemalloc.start()
+    total = 0
+    for _ in range(number):
+        current = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        api.method_handler({"body": request, "headers": {}}, {}, store)
+        total += tracemalloc.get_traced_memory()[1] - current
+    tracemalloc.stop()
+    return total / number
+
+
+def main(number):
+    print("%-20s %14s %14s" % ("record", "slots, bytes", "__dict__, bytes"))
+    for name, (validator, data) in CASES.items():
+        record = validator(data)
+        slots = bytes_per_object(lambda: validator(data), number)
+        dicts = bytes_per_object(lambda: dict_record(record), number)
+        print("%-20s %14.1f %14.1f" % (name, slots, dicts))
+
+    store = MockStore(MockStoreConnection())
+    print("\n%-20s %14s" % ("method_handler", "peak, bytes"))
+    for method, arguments in HANDLER_CASES.items():
+        request = sign({"account": "horns&hoofs", "login": "h&f", "method": method, "arguments": arguments})
+        print("%-20s %14.1f" % (method, handler_peak(request, store, number)))
+
+
+if __name__ == "__main__":
+    op = OptionParser()
+    op.add_option("-n", "--number", action="store", type=int, default=10000)
+    (opts, args) = op.parse_args()
+    main(opts.number)
@@ -0,0 +1,50 @@
+"""
+Throughput of the vectorized scoring kernel against the scalar compute_score.
+
+    $ python -m benchmarks.bench_kernel --max-rows 10000000
+"""
+import random
+import time
+from optparse import OptionParser
+
+import numpy as np
+
+import scoring_kernel
+from scoring import compute_score
+
+SCALAR_MAX_ROWS = 100000
+
+
+def timed(f, *args):
+    start = time.perf_counter()
+    f(*args)
+    return time.perf_counter() - start
+
+
+def main(max_rows):
+    rng = np.random.default_rng(42)
+    print("%10s %20s %20s %20s" % ("rows", "scalar, rows/s", "masks, rows/s", "columns, rows/s"))
+    rows = 10 ** 4
+    while rows <= max_rows:
+        masks = rng.integers(0, 64, size=rows, dtype=np.uint8)
+        columns = [(masks >> n) & 1 for n in range(len(scoring_kernel.FIELDS))]
+        scalar = "-"
+        if rows <= SCALAR_MAX_ROWS:
+            # a missing field is None: compute_score counts any other value, False included, as present
+            requests = [{name: True if (m >> n) & 1 else None for n, name in enumerate(scoring_kernel.FIELDS)}
+                        for m in masks.tolist()]
+            scalar = "%.0f" % (rows / timed(lambda: [compute_score(**r) for r in requests]))
+        print("%10d %20s %20.0f %20.0f" % (rows, scalar, rows / timed(scoring_kernel.score_masks, masks),
+                                          rows / timed(scoring_kernel.score_columns, *columns)))
+        rows *= 10
+
+    requests = [{"first_name": "a", "last_name": "b", "phone": str(79000000000 + random.randrange(10 ** 9)),
+                 "birthday": "01.01.2000"} for _ in range(10 ** 4)]
+    print("cache keys: %.0f rows/s" % (len(requests) / timed(scoring_kernel.score_keys, requests)))
+
+
+if __name__ == "__main__":
+    op = OptionParser()
+    op.add_option("-m", "--max-rows", action="store", type=int, default=10 ** 7)
+    (opts, args) = op.parse_args()
+    main(opts.max_rows)
@@ -0,0 +1,118 @@
+"""
+Overhead of the metrics per method. Requests of one method are passed through route_request (parsing of the
+body included) in three variants: without the metrics, with the default metrics (one request histogram) and
+with --detailed-metrics (the stage and parse histograms and MeteredStore). Rounds of the variants alternate,
+the best round of each is compared. The clock reads of method_handler stay in all the variants, so they are
+added to the overhead. The overhead is also given as a share of the same request sent over a keep-alive
+HTTP connection to a server in this process; the exit code is 1 when the default metrics cost more than
+--budget percent of it.
+
+    $ python -m benchmarks.bench_metrics --requests 10000 --rounds 9 --budget 1
+"""
+import http.client
+import json
+import sys
+import threading
+import time
+import timeit
+from optparse import OptionParser
+
+import api
+import metrics
+from benchmarks.loadtest import QuietHandler, sign
+from store import MockStore, MockStoreConnection, MeteredStore
+
+METHODS = {
+    "online_score": {"phone": "79175002040", "email": "dev@otus.ru", "gender": 1, "birthday": "01.01.2000",
+                     "first_name": "a", "last_name": "b"},
+    "clients_interests": {"client_ids": [1, 2, 3], "date": "19.07.2017"},
+    "online_score_batch": {"items": [{"phone": "79175002040", "email": "dev@otus.ru"},
+                                     {"first_name": "a", "last_name": "b"}]},
+}
+
+
+def run(body, store, number):
+    route, router = api.route_request, api.MainHTTPHandler.router
+    start = time.perf_counter()
+    for _ in range(number):
+        route(router, "/method", body, {}, {"request_id": ""}, store)
+    return time.perf_counter() - start
+
+
+def measure(body, number, rounds):
+    """
+    :return seconds per request of the best round without the metrics, with the default and the detailed ones
+    """
+    bare = MockStore(MockStoreConnection())
+    metered = MeteredStore(bare, metrics.Registry())
+    observe_request = api.observe_request
+    # the score cache is filled before the measurement, so all the variants read the same cache
+    run(body, bare, 10)
+    variants = (("off", bare, False, lambda *args: None), ("default", bare, False, observe_request),
+                ("detailed", metered, True, observe_request))
+    best = {}
+    try:
+        for _ in range(rounds):
+            for name, store, detailed, observe in variants:
+                api.detailed_metrics, api.observe_request = detailed, observe
+                seconds = run(body, store, number) / number
+                best[name] = min(best.get(name, seconds), seconds)
+    finally:
+        api.detailed_metrics, api.observe_request = False, observe_request
+    return best["off"], best["default"], best["detailed"]
+
+
+def measure_http(body, number, rounds):
+    """
+    :return seconds per request of the best round over one keep-alive connection
+    """
+    QuietHandler.store = MockStore(MockStoreConnection())
+    server = api.HTTPServer(("localhost", 0), QuietHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    connection = http.client.HTTPConnection(*server.server_address[:2])
+    headers = {"Content-Type": "application/json"}
+    best = None
+    try:
+        for _ in range(rounds):
+            start = time.perf_counter()
+            for _ in range(number):
+                connection.request("POST", "/method", body, headers)
+                connection.getresponse().read()
+            seconds = (time.perf_counter() - start) / number
+            best = seconds if best is None else min(best, seconds)
+    finally:
+        connection.close()
+        server.shutdown()
+        server.server_close()
+    return best
+
+
+def main(number, rounds, budget):
+    clock = time.perf_counter
+    reads = min(timeit.repeat(lambda: (clock(), clock(), clock(), clock()), number=number, repeat=rounds)) / number
+    print("%-20s %9s %13s %14s %9s %13s %14s" % ("method", "off, us", "default, us", "detailed, us", "http, us",
+                                                 "default/http", "detailed/http"))
+    status = 0
+    for method, arguments in METHODS.items():
+        body = json.dumps(sign({"account": "horns&hoofs", "login": "h&f", "method": method, "arguments": arguments}))
+        off, default, detailed = measure(body, number, rounds)
+        over_http = measure_http(body, max(1, number // 10), rounds)
+        default_overhead, detailed_overhead = default - off + reads, detailed - off + reads
+        print("%-20s %9.2f %13.2f %14.2f %9.2f %12.2f%% %13.2f%%" % (
+            method, off * 1e6, default_overhead * 1e6, detailed_overhead * 1e6, over_http * 1e6,
+            default_overhead / over_http * 100, detailed_overhead / over_http * 100))
+        if default_overhead / over_http * 100 > budget:
+            status = 1
+    print("the overhead includes %.2f us of the clock reads of method_handler" % (reads * 1e6))
+    if status:
+        print("The default metrics cost more than %s%% of an HTTP request" % budget)
+    return status
+
+
+if __name__ == "__main__":
+    op = OptionParser()
+    op.add_option("-n", "--requests", action="store", type=int, default=10000)
+    op.add_option("-r", "--rounds", action="store", type=int, default=9)
+    op.add_option("-b", "--budget", action="store", type=float, default=1.)
+    (opts, args) = op.parse_args()
+    sys.exit(main(opts.requests, opts.rounds, opts.budget))
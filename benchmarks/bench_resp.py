@@ -0,0 +1,48 @@
+"""
+Round-trip costs of the RESP store against the in-process RESP server: one GET per key, one MGET
+for all the keys and pipelined SETEX.
+
+    $ python -m benchmarks.bench_resp --keys 1000
+    $ python -m benchmarks.bench_resp --url resp://localhost:6380
+"""
+import time
+from optparse import OptionParser
+
+import resp
+
+
+def timed(f, *args):
+    start = time.perf_counter()
+    f(*args)
+    return time.perf_counter() - start
+
+
+def main(keys, url):
+    server = None
+    if url is None:
+        server = resp.RespServer().start()
+        url = "resp://localhost:%s" % server.port
+    store = resp.RespStore.from_url(url, pool_size=1)
+    resp.seed_interests(store, range(keys))
+    names = ["i:%s" % cid for cid in range(keys)]
+    scores = {"uid:%s" % n: 1.5 for n in range(keys)}
+    results = [
+        ("GET per key", timed(lambda: [store.get(key) for key in names])),
+        ("MGET", timed(store.get_many, names)),
+        ("SETEX per key", timed(lambda: [store.cache_set(k, v, 3600) for k, v in scores.items()])),
+        ("pipelined SETEX", timed(store.cache_set_many, scores, 3600)),
+    ]
+    print("%-20s %12s %14s" % ("operation", "total, ms", "per key, us"))
+    for name, seconds in results:
+        print("%-20s %12.2f %14.2f" % (name, seconds * 1e3, seconds / keys * 1e6))
+    store.pool.close()
+    if server is not None:
+        server.stop()
+
+
+if __name__ == "__main__":
+    op = OptionParser()
+    op.add_option("-k", "--keys", action="store", type=int, default=1000)
+    op.add_option("-u", "--url", action="store", default=None)
+    (opts, args) = op.parse_args()
+    main(opts.keys, opts.url)
@@ -0,0 +1,40 @@
+"""
+Encode and decode cost of the JSON backends per request type.
+
+    $ python -m benchmarks.bench_serializers --number 20000
+"""
+import timeit
+from optparse import OptionParser
+
+import serializers
+from store import generate_interests
+
+REQUESTS = {
+    "online_score": {"account": "horns&hoofs", "login": "h&f", "method": "online_score", "token": "a" * 128,
+                     "arguments": {"phone": "79175002040", "email": "dev@otus.ru", "first_name": "a",
+                                   "last_name": "b", "birthday": "01.01.2000", "gender": 1}},
+    "clients_interests/100": {"account": "horns&hoofs", "login": "h&f", "method": "clients_interests",
+                              "token": "a" * 128, "arguments": {"client_ids": list(range(100)), "date": "19.07.2017"}},
+}
+RESPONSES = {
+    "online_score": {"code": 200, "response": {"score": 5.0}},
+    "clients_interests/100": {"code": 200, "response": {str(cid): serializers.loads(generate_interests("i:%s" % cid))
+                                                        for cid in range(100)}},
+}
+
+
+def main(number):
+    print("%-8s %-24s %16s %16s" % ("backend", "request type", "decode req, us", "encode resp, us"))
+    for name, (dumps, loads) in serializers.available_backends().items():
+        for kind, request in REQUESTS.items():
+            body = dumps(request)
+            decode = timeit.timeit(lambda: loads(body), number=number) / number * 1e6
+            encode = timeit.timeit(lambda: dumps(RESPONSES[kind]), number=number) / number * 1e6
+            print("%-8s %-24s %16.2f %16.2f" % (name, kind, decode, encode))
+
+
+if __name__ == "__main__":
+    op = OptionParser()
+    op.add_option("-n", "--number", action="store", type=int, default=20000)
+    (opts, args) = op.parse_args()
+    main(opts.number)
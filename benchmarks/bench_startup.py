@@ -0,0 +1,57 @@
+"""
+Import time of the API module measured with python -X importtime in fresh interpreters. The median over the
+runs is compared with the budget, the exit code is 1 when it is over the budget, so the build can check it.
+
+    $ python -m benchmarks.bench_startup --runs 5 --budget-ms 130
+    $ python -m benchmarks.bench_startup --module offline_api --top 15
+"""
+import os
+import statistics
+import subprocess
+import sys
+from optparse import OptionParser
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BUDGET_MS = 130
+
+
+def import_times(module):
+    """
+    imports the module in a new interpreter
+    :return dict of module name -> (self us, cumulative us) of the top level imports and of the module itself
+    """
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import %s" % module], cwd=ROOT,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        own, cumulative, name = line[len("import time:"):].split("|")
+        times[name.strip()] = (int(own), int(cumulative))
+    return times
+
+
+def main(module, runs, budget_ms, top):
+    runs_times = [import_times(module) for _ in range(runs)]
+    totals = [times[module][1] / 1e3 for times in runs_times]
+    median = statistics.median(totals)
+    last = runs_times[-1]
+    print("%-40s %12s %16s" % ("module (last run)", "self, ms", "cumulative, ms"))
+    for name, (own, cumulative) in sorted(last.items(), key=lambda item: -item[1][1])[:top]:
+        print("%-40s %12.2f %16.2f" % (name, own / 1e3, cumulative / 1e3))
+    print("import %s: median %.2f ms over %s runs (min %.2f, max %.2f), budget %.2f ms" % (
+        module, median, runs, min(totals), max(totals), budget_ms))
+    if median > budget_ms:
+        print("Import time is over the budget")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    op = OptionParser()
+    op.add_option("-m", "--module", action="store", default="api")
+    op.add_option("-r", "--runs", action="store", type=int, default=5)
+    op.add_option("-b", "--budget-ms", action="store", type=float, default=BUDGET_MS)
+    op.add_option("-t", "--top", action="store", type=int, default=10)
+    (opts, args) = op.parse_args()
+    sys.exit(main(opts.module, opts.runs, opts.budget_ms, opts.top))
@@ -0,0 +1,49 @@
+"""
+Microbenchmark of request validation: descriptor based request classes against the compiled validators.
+
+    $ python -m benchmarks.bench_validation --number 100000
+"""
+import timeit
+from optparse import OptionParser
+
+import api
+
+CASES = {
+    "online_score": (api.OnlineScoreRequest, api.validate_online_score_request,
+                     {"phone": "79175002040", "email": "dev@otus.ru", "gender": 1, "birthday": "01.01.2000",
+                      "first_name": "a", "last_name": "b"}),
+    "clients_interests": (api.ClientsInterestsRequest, api.validate_clients_interests_request,
+                          {"client_ids": list(range(100)), "date": "19.07.2017"}),
+    "method": (api.MethodRequest, api.validate_method_request,
+               {"account": "horns&hoofs", "login": "h&f", "method": "online_score", "token": "", "arguments": {}}),
+}
+
+
+def descriptor_path(cls, data):
+    """
+    the validation as it was done before the compiled validators: descriptors and the scan of the attributes
+    """
+    instance = cls(**data)
+    notnullable = [k for k in instance.__slots__ if getattr(instance, k) is not None]
+    if (('_client_ids' in notnullable) or
+            ('_phone' in notnullable and '_email' in notnullable) or
+            ('_first_name' in notnullable and '_last_name' in notnullable) or
+            ('_gender' in notnullable and '_birthday' in notnullable) or
+            cls is api.MethodRequest):
+        return instance
+    raise ValueError('Arguments dictionary does not have required keys')
+
+
+def main(number):
+    print("%-20s %15s %15s %8s" % ("request", "descriptors, us", "compiled, us", "speedup"))
+    for name, (cls, validator, data) in CASES.items():
+        descriptors = timeit.timeit(lambda: descriptor_path(cls, data), number=number) / number * 1e6
+        compiled = timeit.timeit(lambda: validator(data), number=number) / number * 1e6
+        print("%-20s %15.2f %15.2f %7.2fx" % (name, descriptors, compiled, descriptors / compiled))
+
+
+if __name__ == "__main__":
+    op = OptionParser()
+    op.add_option("-n", "--number", action="store", type=int, default=100000)
+    (opts, args) = op.parse_args()
+    main(opts.number)
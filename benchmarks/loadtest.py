@@ -0,0 +1,268 @@
+"""
+Load test of the scoring API with a realistic request mix: valid and invalid requests, admin and
+not admin users, online_score, online_score_batch and clients_interests with large client_ids lists.
+
+The inprocess mode calls method_handler directly, the http mode sends the requests with keep-alive
+connections from concurrent client threads to a server started in this process (or to --url).
+It reports RPS and p50/p95/p99 latency; --save appends the result with the git commit to a JSON lines
+file, --compare prints the difference with the last saved result of the same mode, concurrency and server threads.
+
+    $ python -m benchmarks.loadtest --mode inprocess --requests 20000
+    $ python -m benchmarks.loadtest --mode http --concurrency 16 --threads 16 --save loadtest.jsonl
+    $ python -m benchmarks.loadtest --mode http -c 16 -t 16 --compare loadtest.jsonl --max-regression 10
+"""
+import http.client
+import json
+import random
+import subprocess
+import sys
+import threading
+import time
+from collections import Counter
+from optparse import OptionParser
+from urllib.parse import urlparse
+
+import api
+import serializers
+from store import MockStore, MockStoreConnection
+
+# share of the request kinds in the mix
+MIX = (
+    ("score", 40),
+    ("score_admin", 5),
+    ("score_batch", 5),
+    ("interests", 25),
+    ("interests_large", 5),
+    ("invalid_arguments", 10),
+    ("invalid_token", 10),
+)
+LARGE_CLIENT_IDS = 1000
+# results are compared only with the saved ones of the same setup
+SETUP = ("mode", "concurrency", "threads")
+
+
+def sign(request):
+    if request["login"] == api.ADMIN_LOGIN:
+        request["token"] = api.auth_verifier.admin_digest().decode('ascii')
+    else:
+        request["token"] = api.auth_verifier.user_digest(request["account"], request["login"]).decode('ascii')
+    return request
+
+
+def score_arguments(rnd):
+    return {"phone": "7%010d" % rnd.randrange(10 ** 10), "email": "user%s@otus.ru" % rnd.randrange(1000),
+            "first_name": rnd.choice(("a", "b", "c")), "last_name": rnd.choice(("x", "y")),
+            "gender": rnd.choice((0, 1, 2)), "birthday": "%02d.%02d.%s" % (rnd.randint(1, 28), rnd.randint(1, 12),
+                                                                         rnd.randint(1960, 2005))}
+
+
+def make_request(kind, rnd):
+    """
+    :return request body of the kind
+    """
+    request = {"account": "horns&hoofs", "login": "h&f%s" % rnd.randrange(100), "method": "online_score"}
+    if kind == "score":
+        request["arguments"] = score_arguments(rnd)
+    elif kind == "score_admin":
+        request["login"] = api.ADMIN_LOGIN
+        request["arguments"] = score_arguments(rnd)
+    elif kind == "score_batch":
+        request["method"] = "online_score_batch"
+        request["arguments"] = {"items": [score_arguments(rnd) for _ in range(rnd.randint(2, 20))]}
+    elif kind == "interests":
+        request["method"] = "clients_interests"
+        request["arguments"] = {"client_ids": rnd.sample(range(100000), rnd.randint(1, 10)), "date": "19.07.2017"}
+    elif kind == "interests_large":
+        request["method"] = "clients_interests"
+        request["arguments"] = {"client_ids": rnd.sample(range(100000), LARGE_CLIENT_IDS)}
+    elif kind == "invalid_arguments":
+        request["arguments"] = {"phone": "89175002040", "birthday": "01.01.1890"}
+    sign(request)
+    if kind == "invalid_token":
+        request["arguments"] = score_arguments(rnd)
+        request["token"] = "0" * 128
+    return request
+
+
+def make_requests(number, seed=0):
+    rnd = random.Random(seed)
+    kinds, weights = zip(*MIX)
+    return [make_request(kind, rnd) for kind in rnd.choices(kinds, weights, k=number)]
+
+
+def percentile(ordered, q):
+    if not ordered:
+        return 0.
+    return ordered[min(len(ordered) - 1, int(round(q / 100. * (len(ordered) - 1))))]
+
+
+def summary(latencies, codes, seconds):
+    latencies = sorted(latencies)
+    return {
+        "requests": len(latencies),
+        "seconds": round(seconds, 3),
+        "rps": round(len(latencies) / seconds, 1) if seconds else 0.,
+        "p50_ms": round(percentile(latencies, 50) * 1e3, 3),
+        "p95_ms": round(percentile(latencies, 95) * 1e3, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1e3, 3),
+        "codes": {str(code): count for code, count in sorted(codes.items())},
+    }
+
+
+def run_inprocess(requests, store):
+    """
+    function passes the requests through method_handler one by one
+    :return summary of the run
+    """
+    latencies, codes = [], Counter()
+    clock = time.perf_counter
+    start = clock()
+    for request in requests:
+        began = clock()
+        _, code = api.method_handler({"body": request, "headers": {}}, {}, store)
+        latencies.append(clock() - began)
+        codes[code] += 1
+    return summary(latencies, codes, clock() - start)
+
+
+def http_client(host, port, bodies, latencies, codes, lock):
+    connection = http.client.HTTPConnection(host, port, timeout=30)
+    clock = time.perf_counter
+    local_latencies, local_codes = [], Counter()
+    headers = {"Content-Type": "application/json"}
+    try:
+        for body in bodies:
+            began = clock()
+            connection.request("POST", "/method", body, headers)
+            response = connection.getresponse()
+            response.read()
+            local_latencies.append(clock() - began)
+            local_codes[response.status] += 1
+    finally:
+        connection.close()
+    with lock:
+        latencies.extend(local_latencies)
+        codes.update(local_codes)
+
+
+def run_http(requests, concurrency, host, port):
+    """
+    function sends the requests from concurrency client threads, every thread keeps its own connection
+    :return summary of the run
+    """
+    bodies = [serializers.dumps(request) for request in requests]
+    latencies, codes, lock = [], Counter(), threading.Lock()
+    clients = [threading.Thread(target=http_client, args=(host, port, bodies[n::concurrency], latencies, codes, lock))
+               for n in range(concurrency)]
+    start = time.perf_counter()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    return summary(latencies, codes, time.perf_counter() - start)
+
+
+class QuietHandler(api.MainHTTPHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(threads):
+    """
+    function starts the API server on a free port in a background thread
+    :return server
+    """
+    if threads > 0:
+        server = api.ThreadPoolHTTPServer(("localhost", 0), QuietHandler, threads)
+    else:
+        server = api.HTTPServer(("localhost", 0), QuietHandler)
+    threading.Thread(target=server.serve_forever, name='loadtest-server', daemon=True).start()
+    return server
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL,
+                                       universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_results(path):
+    try:
+        with open(path) as f:
+            return [json.loads(line) for line in f if line.strip()]
+    except FileNotFoundError:
+        return []
+
+
+def compare(result, previous):
+    """
+    :return list of (metric, previous, current, change in percent)
+    """
+    rows = []
+    for metric in ("rps", "p50_ms", "p95_ms", "p99_ms"):
+        before, after = previous[metric], result[metric]
+        rows.append((metric, before, after, (after - before) / before * 100. if before else 0.))
+    return rows
+
+
+def main(opts):
+    requests = make_requests(opts.requests, opts.seed)
+    server = None
+    if opts.mode == "inprocess":
+        result = run_inprocess(requests, MockStore(MockStoreConnection()))
+    else:
+        if opts.url:
+            parsed = urlparse(opts.url)
+            host, port = parsed.hostname, parsed.port or 80
+        else:
+            server = start_server(opts.threads)
+            host, port = server.server_address[:2]
+        result = run_http(requests, opts.concurrency, host, port)
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+    http_mode = opts.mode == "http"
+    result.update({"mode": opts.mode, "concurrency": opts.concurrency if http_mode else 1,
+                   "threads": opts.threads if http_mode else 0, "commit": git_commit(),
+                   "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                   "serializer": serializers.backend})
+    print("%s: %s requests in %.2f s, %.1f RPS, p50 %.3f ms, p95 %.3f ms, p99 %.3f ms, codes %s" % (
+        result["mode"], result["requests"], result["seconds"], result["rps"], result["p50_ms"], result["p95_ms"],
+        result["p99_ms"], result["codes"]))
+
+    status = 0
+    if opts.compare:
+        setup = [result[key] for key in SETUP]
+        previous = [r for r in load_results(opts.compare) if [r.get(key) for key in SETUP] == setup]
+        if not previous:
+            print("No saved results of the %s mode with concurrency %s and threads %s" % tuple(setup))
+        else:
+            print("%-8s %12s %12s %9s   against %s" % ("metric", "previous", "current", "change",
+                                                      previous[-1]["commit"]))
+            for metric, before, after, change in compare(result, previous[-1]):
+                print("%-8s %12.3f %12.3f %8.1f%%" % (metric, before, after, change))
+            rps_change = compare(result, previous[-1])[0][3]
+            if opts.max_regression is not None and rps_change < -opts.max_regression:
+                print("RPS dropped by %.1f%%, more than %s%%" % (-rps_change, opts.max_regression))
+                status = 1
+    if opts.save:
+        with open(opts.save, "a") as f:
+            f.write(json.dumps(result, sort_keys=True) + "\n")
+    return status
+
+
+if __name__ == "__main__":
+    op = OptionParser()
+    op.add_option("-m", "--mode", action="store", type="choice", choices=("inprocess", "http"), default="inprocess")
+    op.add_option("-n", "--requests", action="store", type=int, default=10000)
+    op.add_option("-c", "--concurrency", action="store", type=int, default=8)
+    op.add_option("-t", "--threads", action="store", type=int, default=8)
+    op.add_option("-u", "--url", action="store", default=None)
+    op.add_option("--seed", action="store", type=int, default=0)
+    op.add_option("-s", "--save", action="store", default=None)
+    op.add_option("--compare", action="store", default=None)
+    op.add_option("--max-regression", action="store", type=float, default=None)
+    (opts, args) = op.parse_args()
+    sys.exit(main(opts))
@@ -0,0 +1,120 @@
+import logging
+import threading
+import time
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+STATES = (CLOSED, OPEN, HALF_OPEN)
+
+
+class CircuitBreaker(object):
+    """
+    Circuit breaker: after failure_threshold failures in a row the circuit opens and calls are rejected
+    without trying; after reset_timeout seconds it becomes half-open and lets half_open_calls trial calls
+    through, their success closes the circuit and a failure opens it again.
+    """
+    def __init__(self, failure_threshold=5, reset_timeout=5., half_open_calls=1, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_calls = half_open_calls
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.current = CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.trials = 0
+        self.transitions = {(old, new): 0 for old in STATES for new in STATES if old != new}
+        self.listeners = []
+
+    @property
+    def state(self):
+        with self.lock:
+            transition = self.refresh()
+            state = self.current
+        self.notify(transition)
+        return state
+
+    def allow(self):
+        """
+        :return: True if the call may be tried
+        """
+        with self.lock:
+            transition = self.refresh()
+            if self.current == CLOSED:
+                allowed = True
+            elif self.current == HALF_OPEN and self.trials < self.half_open_calls:
+                self.trials += 1
+                allowed = True
+            else:
+                allowed = False
+        self.notify(transition)
+        return allowed
+
+    def record_success(self):
+        transition = None
+        with self.lock:
+            self.failures = 0
+            if self.current == HALF_OPEN:
+                transition = self.switch(CLOSED)
+        self.notify(transition)
+
+    def record_failure(self):
+        transition = None
+        with self.lock:
+            self.failures += 1
+            if self.current == HALF_OPEN:
+                transition = self.switch(OPEN)
+            elif self.current == CLOSED and self.failures >= self.failure_threshold:
+                transition = self.switch(OPEN)
+        self.notify(transition)
+
+    def release(self):
+        """
+        the trial call has ended with neither a success nor a failure of the store, its place is given back
+        """
+        with self.lock:
+            if self.current == HALF_OPEN:
+                self.trials = max(0, self.trials - 1)
+
+    def snapshot(self):
+        with self.lock:
+            transition = self.refresh()
+            snapshot = {
+                "state": self.current,
+                "failures": self.failures,
+                "opened_at": self.opened_at,
+                "transitions": {"%s->%s" % k: v for k, v in self.transitions.items()},
+            }
+        self.notify(transition)
+        return snapshot
+
+    def refresh(self):
+        if self.current == OPEN and self.clock() >= self.opened_at + self.reset_timeout:
+            return self.switch(HALF_OPEN)
+        return None
+
+    def switch(self, state):
+        """
+        changes the state, the lock is held by the caller
+        :return the transition (old, new), the caller passes it to notify() after the lock is released
+        """
+        old, self.current = self.current, state
+        if state == OPEN:
+            self.opened_at = self.clock()
+        elif state == CLOSED:
+            self.opened_at = None
+        self.trials = 0
+        self.transitions[(old, state)] += 1
+        return old, state
+
+    def notify(self, transition):
+        """
+        logs the transition and calls the listeners, they may read the state of the breaker
+        """
+        if transition is None:
+            return
+        old, state = transition
+        logging.warning("Circuit breaker: %s -> %s", old, state)
+        for listener in self.listeners:
+            listener(old, state)
@@ -0,0 +1,121 @@
+import heapq
+import itertools
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache(object):
+    """
+    Bounded thread-safe cache: entries are evicted in LRU order when the capacity is exceeded and expire
+    after their ttl. Get and set are O(1): the LRU order is kept by OrderedDict, expired entries are swept
+    from the head of a heap of expiry times, so the memory does not grow with keys which are never read again.
+    """
+    def __init__(self, capacity=100000, clock=time.time):
+        self.capacity = capacity
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.expiry = []
+        self.sequence = itertools.count()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        entry = self.entries.get(key)
+        return entry is not None and (entry[0] is None or entry[0] > self.clock())
+
+    def __getitem__(self, key):
+        entry = self.entries.get(key)
+        if entry is None or (entry[0] is not None and entry[0] <= self.clock()):
+            raise KeyError(key)
+        return entry[1]
+
+    def get(self, key, default=None):
+        now = self.clock()
+        with self.lock:
+            return self.lookup(key, now, default)
+
+    def get_many(self, keys, default=None):
+        now = self.clock()
+        with self.lock:
+            return [self.lookup(key, now, default) for key in keys]
+
+    def set(self, key, value, ttl=None):
+        """
+        ttl in seconds, None - the entry does not expire and leaves the cache only by eviction
+        """
+        now = self.clock()
+        with self.lock:
+            self.store(key, value, ttl, now)
+            self.sweep(now)
+
+    def set_many(self, mapping, ttl=None):
+        now = self.clock()
+        with self.lock:
+            for key, value in mapping.items():
+                self.store(key, value, ttl, now)
+            self.sweep(now)
+
+    def delete(self, key):
+        with self.lock:
+            return self.entries.pop(key, None) is not None
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.expiry = []
+
+    def stats(self):
+        return {
+            "size": len(self.entries),
+            "capacity": self.capacity,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+    def lookup(self, key, now, default):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        expire_at, value = entry
+        if expire_at is not None and expire_at <= now:
+            del self.entries[key]
+            self.expirations += 1
+            self.misses += 1
+            return default
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def store(self, key, value, ttl, now):
+        expire_at = None if ttl is None else now + ttl
+        self.entries[key] = (expire_at, value)
+        self.entries.move_to_end(key)
+        if expire_at is not None:
+            heapq.heappush(self.expiry, (expire_at, next(self.sequence), key))
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def sweep(self, now):
+        expiry, entries = self.expiry, self.entries
+        while expiry and expiry[0][0] <= now:
+            expire_at, _, key = heapq.heappop(expiry)
+            entry = entries.get(key)
+            # the heap keeps records of overwritten and evicted entries, they are skipped here
+            if entry is not None and entry[0] == expire_at:
+                del entries[key]
+                self.expirations += 1
+        if len(expiry) > 2 * len(entries) + 64:
+            self.expiry = [(entry[0], next(self.sequence), key) for key, entry in entries.items()
+                           if entry[0] is not None]
+            heapq.heapify(self.expiry)
@@ -0,0 +1,181 @@
+"""
+Structured asynchronous logging of the API. Records are put into a bounded queue as they are, the message and
+the JSON line are formatted by a background thread which writes them to the --log file, so the request thread
+pays neither for the formatting nor for the write. When the queue is full the record is dropped. Records below
+WARNING are sampled by level and limited per second, dropped records are counted in the metrics.
+
+Every request gives one INFO record of the scoring.requests logger with the context of the request
+(request_id, has, nclients, code, ...) as the fields of the JSON line.
+"""
+import atexit
+import datetime
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import threading
+import time
+
+import metrics
+
+QUEUE_SIZE = 10000
+
+request_logger = logging.getLogger("scoring.requests")
+dropped_sampled = metrics.registry.counter("scoring_log_dropped_total", (("reason", "sampled"),),
+                                           "Log records dropped by the sampling or the full queue")
+dropped_full = metrics.registry.counter("scoring_log_dropped_total", (("reason", "queue_full"),))
+pipeline = None
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    one JSON object per line: time, level, logger, message and the fields of the context of the record
+    """
+    def format(self, record):
+        payload = {
+            "time": datetime.datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        context = getattr(record, "context", None)
+        if context:
+            payload.update(context)
+        if record.exc_info:
+            payload["exception"] = self.formatException(record.exc_info)
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+
+class Sampler(logging.Filter):
+    """
+    Records of a level in rates are kept with the probability of its rate, not more than rate_limit records
+    per second below WARNING are kept at all, 0 - no limit. Warnings and errors are never dropped.
+    """
+    def __init__(self, rates=None, rate_limit=0, clock=time.monotonic, random=random.random):
+        super().__init__()
+        self.rates = rates or {}
+        self.rate_limit = rate_limit
+        self.clock = clock
+        self.random = random
+        self.lock = threading.Lock()
+        self.second = None
+        self.passed = 0
+
+    def allow(self, levelno):
+        if levelno >= logging.WARNING:
+            return True
+        rate = self.rates.get(levelno, 1.)
+        if rate < 1. and self.random() >= rate:
+            return False
+        if self.rate_limit:
+            second = int(self.clock())
+            with self.lock:
+                if second != self.second:
+                    self.second, self.passed = second, 0
+                if self.passed >= self.rate_limit:
+                    return False
+                self.passed += 1
+        return True
+
+    def filter(self, record):
+        # the request records are sampled by log_request before they are created
+        if getattr(record, "sampled", False) or self.allow(record.levelno):
+            return True
+        dropped_sampled.inc()
+        return False
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler which leaves the formatting to the listener and drops the record when the queue is full.
+    The arguments of the records are formatted later, so they must not be changed after the logging call.
+    """
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            dropped_full.inc()
+
+
+class QueueListener(logging.handlers.QueueListener):
+    def enqueue_sentinel(self):
+        # the queue may be full, the sentinel waits for a free place
+        self.queue.put(self._sentinel)
+
+
+class AsyncLogging(object):
+    """
+    queue handler of the root logger and the listener thread which writes the records to the target handler
+    """
+    def __init__(self, target, sampler, queue_size=QUEUE_SIZE):
+        self.target = target
+        self.sampler = sampler
+        self.queue_size = queue_size
+        self.handler = DroppingQueueHandler(queue.Queue(queue_size))
+        self.handler.addFilter(sampler)
+        self.listener = None
+        self.pid = os.getpid()
+
+    def start(self):
+        # a forked worker has no listener thread and may inherit a locked queue, so there the queue is
+        # created again; in the same process the records queued before the start are kept
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.handler.queue = queue.Queue(self.queue_size)
+        self.listener = QueueListener(self.handler.queue, self.target, respect_handler_level=True)
+        self.listener.start()
+
+    def stop(self):
+        """
+        waits for the records in the queue to be written
+        """
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+        self.target.flush()
+
+
+def setup_logging(filename=None, level=logging.INFO, rates=None, rate_limit=0, queue_size=QUEUE_SIZE):
+    """
+    function switches the root logger to the asynchronous JSON pipeline
+    :param rates: dict of level -> share of the records of the level to keep
+    :return AsyncLogging
+    """
+    global pipeline
+    target = logging.FileHandler(filename) if filename else logging.StreamHandler()
+    target.setFormatter(JsonFormatter())
+    pipeline = AsyncLogging(target, Sampler(rates, rate_limit), queue_size)
+    pipeline.start()
+    root = logging.getLogger()
+    root.handlers[:] = [pipeline.handler]
+    root.setLevel(level)
+    os.register_at_fork(after_in_child=pipeline.start)
+    atexit.register(stop_logging)
+    return pipeline
+
+
+def stop_logging():
+    if pipeline is not None:
+        pipeline.stop()
+
+
+def log_request(context, code):
+    """
+    function logs the context of the finished request, server errors with ERROR level except 503 of the shed
+    load, which is sampled as the other requests; the record is not created at all when it is not sampled
+    """
+    level = logging.ERROR if code >= 500 and code != 503 else logging.INFO
+    if not request_logger.isEnabledFor(level):
+        return
+    if pipeline is None:
+        request_logger.log(level, "%s", context)
+        return
+    if not pipeline.sampler.allow(level):
+        dropped_sampled.inc()
+        return
+    request_logger.log(level, "request", extra={"context": context, "sampled": True})
@@ -0,0 +1,83 @@
+"""
+Memoization of whole responses of the methods which are repeated often with the same arguments, like
+clients_interests under retries and fan-out. The key is a hash of the method and the canonical JSON of the
+arguments; identical requests which come while the response is computed wait for it instead of computing
+it again. Only successful responses are kept. The cache is in front of method_apply, after check_auth,
+so every request is still authorized on its own.
+"""
+import hashlib
+import json
+import threading
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+
+from cache import TTLCache
+
+
+def request_key(method, arguments):
+    """
+    :return digest of the method and the arguments, the same for the dictionaries with another order of keys
+    """
+    canonical = json.dumps([method, arguments], sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.blake2b(canonical.encode('utf-8'), digest_size=16).digest()
+
+
+class ResponseMemo(object):
+    def __init__(self, capacity=10000, ttl=5, wait_timeout=5, methods=("clients_interests",)):
+        self.cache = TTLCache(capacity)
+        self.ttl = ttl
+        self.wait_timeout = wait_timeout
+        self.methods = methods
+        self.in_flight = {}
+        self.lock = threading.Lock()
+        self.coalesced = 0
+
+    def apply(self, request, store, method_apply, ok):
+        """
+        function returns the memoized result of method_apply(request, store) for the methods of the memo,
+        a result is kept when its code is ok
+        :return code, response, context
+        """
+        if request.method not in self.methods:
+            return method_apply(request, store)
+        try:
+            key = request_key(request.method, request.arguments)
+        except (TypeError, ValueError):
+            return method_apply(request, store)
+        result = self.cache.get(key)
+        if result is not None:
+            return result
+        with self.lock:
+            future = self.in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = self.in_flight[key] = Future()
+            else:
+                self.coalesced += 1
+        if not leader:
+            try:
+                return future.result(self.wait_timeout)
+            except FutureTimeout:
+                return method_apply(request, store)
+        try:
+            result = method_apply(request, store)
+            if result[0] == ok:
+                self.cache.set(key, result, self.ttl)
+            future.set_result(result)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+        return result
+
+    def stats(self):
+        stats = self.cache.stats()
+        lookups = stats["hits"] + stats["misses"]
+        return {
+            "hits": stats["hits"],
+            "misses": stats["misses"],
+            "hit_ratio": stats["hits"] / lookups if lookups else 0.,
+            "coalesced": self.coalesced,
+            "size": stats["size"],
+        }
@@ -0,0 +1,176 @@
+"""
+In-process metrics of the API in the Prometheus text format: counters, histograms with fixed buckets and
+gauges which are read from the stats of the store wrappers when the metrics are rendered. An observation is
+a bisect over the buckets and two additions without a lock, an increment of a counter is one addition.
+Every process keeps its own metrics, in the pre-fork mode they describe the worker which served GET /metrics.
+"""
+import bisect
+import threading
+
+# latency buckets in seconds, from 50 us to 5 s
+BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5.)
+
+
+class Sharded(object):
+    """
+    Every thread counts into its own shard, so an update takes no lock; the shards are summed when they are read.
+    The threads of the servers are long-lived, so the number of the shards is bounded by the pool size.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.local = threading.local()
+        self.shards = []
+        self.lock = threading.Lock()
+
+    def shard(self):
+        shard = [0] * self.size
+        with self.lock:
+            self.shards.append(shard)
+        self.local.shard = shard
+        return shard
+
+    def totals(self):
+        with self.lock:
+            shards = list(self.shards)
+        return [sum(column) for column in zip(*shards)] if shards else [0] * self.size
+
+
+class Counter(Sharded):
+    def __init__(self):
+        super().__init__(1)
+
+    def inc(self, amount=1):
+        try:
+            shard = self.local.shard
+        except AttributeError:
+            shard = self.shard()
+        shard[0] += amount
+
+    @property
+    def value(self):
+        return self.totals()[0]
+
+    def samples(self, name, labels):
+        yield name, labels, self.value
+
+
+class Histogram(Sharded):
+    """
+    Bucket counts, the +Inf bucket and the sum are kept in the shards of the threads.
+    """
+    def __init__(self, buckets=BUCKETS):
+        super().__init__(len(buckets) + 2)
+        self.buckets = buckets
+
+    def observe(self, value):
+        try:
+            shard = self.local.shard
+        except AttributeError:
+            shard = self.shard()
+        shard[bisect.bisect_left(self.buckets, value)] += 1
+        shard[-1] += value
+
+    @property
+    def counts(self):
+        return self.totals()[:-1]
+
+    def samples(self, name, labels):
+        totals = self.totals()
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), totals):
+            cumulative += count
+            yield name + "_bucket", labels + (("le", format_value(bound)),), cumulative
+        yield name + "_sum", labels, float(totals[-1])
+        yield name + "_count", labels, cumulative
+
+
+class Registry(object):
+    """
+    Metrics by name and labels, labels are a tuple of (name, value) pairs. The metric objects are created
+    on the first use and kept, the hot path keeps a reference to them instead of looking them up every time.
+    """
+    def __init__(self):
+        self.metrics = {}
+        self.types = {}
+        self.help = {}
+        self.collectors = {}
+        self.lock = threading.Lock()
+
+    def get(self, kind, name, labels=(), description=""):
+        key = (name, labels)
+        metric = self.metrics.get(key)
+        if metric is None:
+            with self.lock:
+                metric = self.metrics.get(key)
+                if metric is None:
+                    metric = self.metrics[key] = kind()
+                    self.types[name] = "histogram" if kind is Histogram else "counter"
+                    if description:
+                        self.help[name] = description
+        return metric
+
+    def counter(self, name, labels=(), description=""):
+        return self.get(Counter, name, labels, description)
+
+    def histogram(self, name, labels=(), description=""):
+        return self.get(Histogram, name, labels, description)
+
+    def register(self, collector, name=None):
+        """
+        collector() returns the list of (name, labels, value) gauges (counters for the names ending with _total),
+        it is called on every render; a collector replaces the one registered with the same name, so a rebuilt
+        store wrapper does not duplicate the series. The name of a stats_collector is its prefix
+        """
+        with self.lock:
+            self.collectors[name or getattr(collector, 'name', collector)] = collector
+
+    def render(self):
+        """
+        :return metrics in the Prometheus text exposition format
+        """
+        lines = []
+        with self.lock:
+            metrics = sorted(self.metrics.items(), key=lambda item: item[0])
+        last = None
+        for (name, labels), metric in metrics:
+            if name != last:
+                if name in self.help:
+                    lines.append("# HELP %s %s" % (name, self.help[name]))
+                lines.append("# TYPE %s %s" % (name, self.types[name]))
+                last = name
+            lines.extend(format_sample(*sample) for sample in metric.samples(name, labels))
+        with self.lock:
+            collectors = list(self.collectors.values())
+        for collector in collectors:
+            samples = collector()
+            for name in sorted(set(sample[0] for sample in samples)):
+                lines.append("# TYPE %s %s" % (name, "counter" if name.endswith("_total") else "gauge"))
+                lines.extend(format_sample(*sample) for sample in samples if sample[0] == name)
+        return "\n".join(lines) + "\n"
+
+
+def format_value(value):
+    if value == float('inf'):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def format_sample(name, labels, value):
+    if labels:
+        label_text = ",".join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels)
+        return "%s{%s} %s" % (name, label_text, format_value(value))
+    return "%s %s" % (name, format_value(value))
+
+
+def stats_collector(prefix, stats, labels=()):
+    """
+    collector of the numeric values of the stats() dictionary as the gauges prefix_key
+    """
+    def collect():
+        return [(prefix + "_" + key, labels, value) for key, value in sorted(stats().items())
+                if isinstance(value, (int, float)) and not isinstance(value, bool)]
+    collect.name = prefix
+    return collect
+
+
+registry = Registry()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Offline scoring: newline-delimited JSON requests (the same bodies as POST /method) are read from
+a file or stdin and passed through method_handler without HTTP, results are written as NDJSON.
+
+    $ python offline_api.py --input requests.ndjson --output results.ndjson --processes 4 --unordered
+"""
+import logging
+import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from optparse import OptionParser
+
+import serializers
+from api import method_handler, make_response, BAD_REQUEST, INTERNAL_ERROR
+from store import MockStore, MockStoreConnection
+
+CHUNK_SIZE = 1000
+
+store = None
+
+
+def init_worker():
+    global store
+    store = MockStore(MockStoreConnection())
+
+
+def process_line(number, line, store):
+    """
+    function handles one request line
+    :return: NDJSON line (bytes) of the result, which has the number of the request line
+    """
+    context = {}
+    try:
+        request = serializers.loads(line)
+    except ValueError:
+        code, response = BAD_REQUEST, None
+    else:
+        try:
+            response, code = method_handler({"body": request, "headers": {}}, context, store)
+        except Exception as e:
+            logging.exception("Unexpected error: %s", e)
+            code, response = INTERNAL_ERROR, None
+    r = make_response(code, response)
+    r["line"] = number
+    return serializers.dumps(r) + b"\n"
+
+
+def process_chunk(chunk):
+    return [process_line(number, line, store) for number, line in chunk]
+
+
+def read_chunks(lines, chunk_size):
+    """
+    function groups the not empty lines into chunks of (line number, line), only one chunk is kept in memory
+    """
+    chunk = []
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        chunk.append((number, line))
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def run(lines, output, processes=1, chunk_size=CHUNK_SIZE, ordered=True):
+    """
+    function streams the lines through method_handler and writes the results to output; with processes > 1
+    chunks are handled in a process pool with at most 2 chunks per process in flight, so the memory stays
+    flat on any input size
+    :return number of the written results
+    """
+    written = 0
+    if processes <= 1:
+        if store is None:
+            init_worker()
+        for chunk in read_chunks(lines, chunk_size):
+            results = process_chunk(chunk)
+            output.writelines(results)
+            written += len(results)
+        return written
+
+    max_in_flight = processes * 2
+    with ProcessPoolExecutor(processes, initializer=init_worker) as pool:
+        if ordered:
+            pending = deque()
+            for chunk in read_chunks(lines, chunk_size):
+                pending.append(pool.submit(process_chunk, chunk))
+                while len(pending) >= max_in_flight:
+                    results = pending.popleft().result()
+                    output.writelines(results)
+                    written += len(results)
+            while pending:
+                results = pending.popleft().result()
+                output.writelines(results)
+                written += len(results)
+        else:
+            pending = set()
+            for chunk in read_chunks(lines, chunk_size):
+                pending.add(pool.submit(process_chunk, chunk))
+                if len(pending) >= max_in_flight:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        results = future.result()
+                        output.writelines(results)
+                        written += len(results)
+            for future in pending:
+                results = future.result()
+                output.writelines(results)
+                written += len(results)
+    return written
+
+
+if __name__ == "__main__":
+    op = OptionParser()
+    op.add_option("-i", "--input", action="store", default="-")
+    op.add_option("-o", "--output", action="store", default="-")
+    op.add_option("-p", "--processes", action="store", type=int, default=1)
+    op.add_option("-c", "--chunk-size", action="store", type=int, default=CHUNK_SIZE)
+    op.add_option("-u", "--unordered", action="store_true", default=False)
+    op.add_option("-l", "--log", action="store", default=None)
+    (opts, args) = op.parse_args()
+    logging.basicConfig(filename=opts.log, level=logging.WARNING,
+                        format='[%(asctime)s] %(levelname).1s %(message)s', datefmt='%Y.%m.%d %H:%M:%S')
+    lines = sys.stdin.buffer if opts.input == "-" else open(opts.input, "rb")
+    output = sys.stdout.buffer if opts.output == "-" else open(opts.output, "wb")
+    try:
+        run(lines, output, opts.processes, opts.chunk_size, not opts.unordered)
+    finally:
+        lines.close()
+        output.close()
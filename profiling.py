@@ -0,0 +1,208 @@
+"""
+On-demand profiling of a running worker, started by the admin method "profile":
+
+    sampling  a background thread reads the stacks of all the threads with sys._current_frames() every
+              interval seconds and writes them as collapsed stacks ("frame;frame;frame count" lines), which
+              flamegraph.pl, speedscope and inferno read
+    cprofile  the handler of the requests runs under cProfile, one request at a time (the other requests go
+              on unprofiled), the stats are written with pstats dump_stats
+
+A session lasts the given seconds or, for cprofile, the given number of requests, whichever ends first.
+Only one session runs at a time in a process; in the pre-fork mode it profiles the worker which got the request.
+"""
+import cProfile
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+SAMPLING = "sampling"
+CPROFILE = "cprofile"
+MAX_SECONDS = 300
+DEFAULT_SECONDS = 10
+SAMPLE_INTERVAL = 0.005
+
+
+class ProfileError(Exception):
+    pass
+
+
+def collapse(frame):
+    """
+    stack of the frame from the outermost call, frames are joined with ";"
+    """
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append("%s (%s:%s)" % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class Session(object):
+    def __init__(self, mode, path, seconds, requests=None, on_finish=None):
+        self.mode = mode
+        self.path = path
+        self.seconds = seconds
+        self.requests = requests
+        self.started = time.time()
+        self.finished = None
+        self.error = None
+        self.on_finish = on_finish
+        self.done = threading.Event()
+
+    def status(self):
+        return {
+            "mode": self.mode,
+            "state": ("failed" if self.error else "done") if self.finished else "running",
+            "file": self.path,
+            "started": self.started,
+            "finished": self.finished,
+            "samples": self.samples,
+            "error": self.error,
+        }
+
+    def write(self, dump):
+        """
+        writes the result with dump(path); the session is finished even when the file can not be written
+        """
+        try:
+            dump(self.path)
+        except Exception as e:
+            self.error = str(e)
+            logging.warning("Profile %s is not written: %s", self.path, e)
+        finally:
+            self.finished = time.time()
+            self.done.set()
+            if self.on_finish is not None:
+                self.on_finish(self)
+
+    def wait(self, timeout=None):
+        return self.done.wait(timeout)
+
+
+class SamplingSession(Session):
+    def __init__(self, path, seconds, interval=SAMPLE_INTERVAL, on_finish=None):
+        super().__init__(SAMPLING, path, seconds, on_finish=on_finish)
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self.thread = threading.Thread(target=self.run, name='profiler', daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        own = threading.get_ident()
+        deadline = time.monotonic() + self.seconds
+        while time.monotonic() < deadline:
+            for ident, frame in sys._current_frames().items():
+                if ident != own:
+                    self.stacks[collapse(frame)] += 1
+            self.samples += 1
+            time.sleep(self.interval)
+        self.write(self.dump)
+
+    def dump(self, path):
+        with open(path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write("%s %s\n" % (stack, count))
+
+
+class CProfileSession(Session):
+    def __init__(self, path, seconds, requests=None, on_finish=None):
+        super().__init__(CPROFILE, path, seconds, requests, on_finish)
+        self.profile = cProfile.Profile()
+        self.lock = threading.Lock()
+        self.samples = 0
+        self.timer = threading.Timer(seconds, self.finish)
+        self.timer.daemon = True
+
+    def start(self):
+        self.timer.start()
+
+    def full(self):
+        return self.requests is not None and self.samples >= self.requests
+
+    def call(self, handler, *args):
+        # cProfile can not follow several threads, the requests which come while one is profiled are not profiled
+        if self.finished or not self.lock.acquire(blocking=False):
+            return handler(*args)
+        try:
+            if self.finished or self.full():
+                return handler(*args)
+            self.profile.enable()
+            try:
+                return handler(*args)
+            finally:
+                self.profile.disable()
+                self.samples += 1
+                if self.full():
+                    # the stats are written by another thread, the request does not wait for them or fail with them
+                    threading.Thread(target=self.finish, name='profiler', daemon=True).start()
+        finally:
+            self.lock.release()
+
+    def finish(self):
+        with self.lock:
+            if not self.finished:
+                self.timer.cancel()
+                self.write(self.profile.dump_stats)
+
+
+class Profiler(object):
+    """
+    The sessions of the process: start() starts a new one if none is running, call() passes the handler
+    of a request through the running cprofile session.
+    """
+    def __init__(self, directory=None):
+        self.directory = directory or tempfile.gettempdir()
+        self.active = None
+        self.last = None
+        self.lock = threading.Lock()
+
+    def start(self, mode=SAMPLING, seconds=DEFAULT_SECONDS, requests=None):
+        """
+        :return (True, status of the new session) or (False, status of the session which is still running),
+        raises ProfileError when the directory of the profiles can not be written
+        """
+        with self.lock:
+            if self.active is not None:
+                return False, self.active.status()
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+                if not os.access(self.directory, os.W_OK | os.X_OK):
+                    raise PermissionError("permission denied")
+            except OSError as e:
+                raise ProfileError("directory {} is not writable: {}".format(self.directory, e))
+            path = os.path.join(self.directory, "scoring-%s-%s-%s.%s" % (
+                os.getpid(), time.strftime("%Y%m%d%H%M%S"), mode, "pstats" if mode == CPROFILE else "collapsed"))
+            seconds = min(seconds, MAX_SECONDS)
+            if mode == CPROFILE:
+                session = CProfileSession(path, seconds, requests, self.finished)
+            else:
+                session = SamplingSession(path, seconds, on_finish=self.finished)
+            self.active = self.last = session
+            session.start()
+            return True, session.status()
+
+    def finished(self, session):
+        with self.lock:
+            if self.active is session:
+                self.active = None
+
+    def status(self):
+        session = self.last
+        return session.status() if session is not None else {"state": "idle"}
+
+    def call(self, handler, *args):
+        session = self.active
+        if session is None or session.mode != CPROFILE:
+            return handler(*args)
+        return session.call(handler, *args)
+
+
+profiler = Profiler()
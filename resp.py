@@ -0,0 +1,348 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Networked store backend which speaks the Redis protocol (RESP), and a small in-process RESP server
+for tests and local use, so several API workers can share one score cache and interests database.
+
+    $ python resp.py --port 6380 --seed-interests 100000
+    $ python api.py --store resp://localhost:6380
+"""
+import logging
+import os
+import select
+import socket
+import socketserver
+import threading
+import time
+from optparse import OptionParser
+from urllib.parse import urlparse
+
+from store import StoreConnectionPool, generate_interests
+
+
+class RespError(Exception):
+    pass
+
+
+def encode_command(*args):
+    """
+    RESP array of bulk strings
+    :return bytes
+    """
+    parts = [b'*%d\r\n' % len(args)]
+    for arg in args:
+        if not isinstance(arg, bytes):
+            arg = str(arg).encode('utf-8')
+        parts.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+    return b''.join(parts)
+
+
+def read_reply(stream):
+    """
+    reads one RESP value from the buffered stream
+    :return bytes, int, list, None or RespError for error replies
+    """
+    line = stream.readline()
+    if not line.endswith(b'\r\n'):
+        raise ConnectionError('Connection closed by the store')
+    prefix, payload = line[:1], line[1:-2]
+    if prefix == b'+':
+        return payload
+    if prefix == b'-':
+        return RespError(payload.decode('utf-8', 'replace'))
+    if prefix == b':':
+        return int(payload)
+    if prefix == b'$':
+        length = int(payload)
+        if length < 0:
+            return None
+        data = stream.read(length + 2)
+        if len(data) != length + 2:
+            raise ConnectionError('Connection closed by the store')
+        return data[:-2]
+    if prefix == b'*':
+        length = int(payload)
+        if length < 0:
+            return None
+        return [read_reply(stream) for _ in range(length)]
+    raise RespError('Unknown reply type %r' % prefix)
+
+
+class RespConnection(object):
+    """
+    Connection to a RESP server. It has connected and try_connect like MockStoreConnection, so it can be
+    held by StoreConnectionPool; any socket error marks it as disconnected and raises ConnectionError.
+    The socket is opened by the first command in the process which runs it, so a connection created before
+    fork is never shared by the workers: connected stays True until an attempt fails.
+    """
+    def __init__(self, host="localhost", port=6379, timeout=1.):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.sock = None
+        self.stream = None
+        self.pid = None
+        self.connected = True
+
+    def try_connect(self):
+        if self.sock is not None:
+            if self.pid == os.getpid():
+                return True
+            # the socket is inherited from the parent process, closing it here only releases the descriptor
+            # of this process, the parent keeps its connection
+            self.close()
+        try:
+            self.sock = socket.create_connection((self.host, self.port), self.timeout)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.stream = self.sock.makefile('rb')
+            self.pid = os.getpid()
+            self.connected = True
+        except OSError as e:
+            logging.info("Can not connect to the store %s:%s: %s", self.host, self.port, e)
+            self.close()
+        return self.connected
+
+    def close(self):
+        self.connected = False
+        if self.stream is not None:
+            self.stream.close()
+        if self.sock is not None:
+            self.sock.close()
+        self.sock = self.stream = None
+
+    def pipeline(self, commands):
+        """
+        sends all the commands in one write and reads their replies
+        :return list of replies in the order of the commands, error replies are RespError instances
+        """
+        if not self.try_connect():
+            raise ConnectionError('Can not connect to the store %s:%s' % (self.host, self.port))
+        try:
+            self.sock.sendall(b''.join(encode_command(*command) for command in commands))
+            return [read_reply(self.stream) for _ in commands]
+        except (OSError, ValueError) as e:
+            self.close()
+            raise ConnectionError('Store connection failed: %s' % e)
+
+    def execute(self, *command):
+        reply = self.pipeline([command])[0]
+        if isinstance(reply, RespError):
+            raise reply
+        return reply
+
+
+class RespStore(object):
+    """
+    Store interface of scoring.py over a pool of RESP connections: get and get_many raise ConnectionError
+    when the store is unavailable, the cache methods work as a cache miss in that case.
+    """
+    def __init__(self, pool):
+        self.pool = pool
+
+    @classmethod
+    def from_url(cls, url, pool_size=4, timeout=1., deadline=0.5):
+        """
+        :param url: resp://host:port
+        """
+        parsed = urlparse(url)
+        host, port = parsed.hostname or "localhost", parsed.port or 6379
+        return cls(StoreConnectionPool(lambda: RespConnection(host, port, timeout), pool_size, deadline))
+
+    def connect(self):
+        return self.pool.connected
+
+    def pipeline(self, commands):
+        with self.pool.connection() as conn:
+            return conn.pipeline(commands)
+
+    def execute(self, *command):
+        with self.pool.connection() as conn:
+            return conn.execute(*command)
+
+    def get(self, key):
+        value = self.execute("GET", key)
+        return value.decode('utf-8') if value is not None else None
+
+    def get_many(self, keys):
+        if not keys:
+            return []
+        return [v.decode('utf-8') if v is not None else None for v in self.execute("MGET", *keys)]
+
+    def cache_get(self, key):
+        return self.cache_get_many([key])[0]
+
+    def cache_get_many(self, keys):
+        try:
+            values = self.get_many(keys)
+        except ConnectionError:
+            return [None] * len(keys)
+        return [float(v) if v is not None else None for v in values]
+
+    def cache_set(self, key, value, save_time):
+        self.cache_set_many({key: value}, save_time)
+
+    def cache_set_many(self, mapping, save_time):
+        try:
+            self.pipeline([("SETEX", key, max(1, int(save_time)), value) for key, value in mapping.items()])
+        except ConnectionError:
+            pass
+
+
+###---------------------------------------------- Local server ----------------------------------------------
+
+class RespHandler(socketserver.StreamRequestHandler):
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.clients.add(self.connection)
+
+    def finish(self):
+        with self.server.lock:
+            self.server.clients.discard(self.connection)
+        super().finish()
+
+    def handle(self):
+        replies = []
+        while True:
+            try:
+                command = read_reply(self.rfile)
+            except (ConnectionError, ValueError, OSError):
+                return
+            if not isinstance(command, list) or not command or not all(isinstance(arg, bytes) for arg in command):
+                self.wfile.write(b''.join(replies) + b'-ERR Protocol error\r\n')
+                return
+            replies.append(self.server.execute(command))
+            # replies of pipelined commands are sent together, when there is nothing more to read
+            if not select.select([self.connection], [], [], 0)[0]:
+                self.wfile.write(b''.join(replies))
+                replies = []
+
+
+class RespServer(socketserver.ThreadingTCPServer):
+    """
+    In-process RESP server with GET, SET [EX], SETEX, MGET, MSET, DEL, EXISTS, EXPIRE, DBSIZE, FLUSHALL, PING.
+    Pipelined commands are answered in order.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, server_address=("localhost", 0)):
+        super().__init__(server_address, RespHandler)
+        self.data = {}
+        self.clients = set()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, name='resp-server', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """
+        stops the server and drops the client connections, like an outage of the store
+        """
+        self.shutdown()
+        self.server_close()
+        with self.lock:
+            for client in self.clients:
+                try:
+                    client.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+    def lookup(self, key, now):
+        entry = self.data.get(key)
+        if entry is None:
+            return None
+        value, expire_at = entry
+        if expire_at is not None and expire_at <= now:
+            del self.data[key]
+            return None
+        return value
+
+    def execute(self, command):
+        name, args = command[0].upper(), command[1:]
+        now = time.time()
+        try:
+            with self.lock:
+                if name == b'PING':
+                    return b'+PONG\r\n'
+                if name == b'GET' and len(args) == 1:
+                    return bulk(self.lookup(args[0], now))
+                if name == b'MGET' and args:
+                    return b'*%d\r\n' % len(args) + b''.join(bulk(self.lookup(key, now)) for key in args)
+                if name == b'SET' and len(args) in (2, 4):
+                    expire_at = None
+                    if len(args) == 4:
+                        if args[2].upper() != b'EX':
+                            return b'-ERR syntax error\r\n'
+                        expire_at = now + int(args[3])
+                    self.data[args[0]] = (args[1], expire_at)
+                    return b'+OK\r\n'
+                if name == b'SETEX' and len(args) == 3:
+                    self.data[args[0]] = (args[2], now + int(args[1]))
+                    return b'+OK\r\n'
+                if name == b'MSET' and args and len(args) % 2 == 0:
+                    for n in range(0, len(args), 2):
+                        self.data[args[n]] = (args[n + 1], None)
+                    return b'+OK\r\n'
+                if name == b'DEL' and args:
+                    return b':%d\r\n' % sum(self.data.pop(key, None) is not None for key in args)
+                if name == b'EXISTS' and args:
+                    return b':%d\r\n' % sum(self.lookup(key, now) is not None for key in args)
+                if name == b'EXPIRE' and len(args) == 2:
+                    value = self.lookup(args[0], now)
+                    if value is None:
+                        return b':0\r\n'
+                    self.data[args[0]] = (value, now + int(args[1]))
+                    return b':1\r\n'
+                if name == b'DBSIZE' and not args:
+                    return b':%d\r\n' % len(self.data)
+                if name == b'FLUSHALL':
+                    self.data.clear()
+                    return b'+OK\r\n'
+        except ValueError:
+            return b'-ERR value is not an integer or out of range\r\n'
+        return b'-ERR unknown command or wrong number of arguments\r\n'
+
+
+def bulk(value):
+    if value is None:
+        return b'$-1\r\n'
+    return b'$%d\r\n%s\r\n' % (len(value), value)
+
+
+def seed_interests(store, cids, batch=1000):
+    """
+    function writes the interests of the mock store for the client ids with pipelined MSET
+    """
+    cids = list(cids)
+    for start in range(0, len(cids), batch):
+        args = []
+        for cid in cids[start:start + batch]:
+            key = "i:%s" % cid
+            args.extend((key, generate_interests(key)))
+        store.execute("MSET", *args)
+
+
+if __name__ == "__main__":
+    op = OptionParser()
+    op.add_option("-p", "--port", action="store", type=int, default=6379)
+    op.add_option("-s", "--seed-interests", action="store", type=int, default=0)
+    (opts, args) = op.parse_args()
+    logging.basicConfig(level=logging.INFO, format='[%(asctime)s] %(levelname).1s %(message)s',
+                        datefmt='%Y.%m.%d %H:%M:%S')
+    server = RespServer(("localhost", opts.port)).start()
+    logging.info("Starting RESP server at %s", opts.port)
+    if opts.seed_interests:
+        seed_interests(RespStore.from_url("resp://localhost:%s" % opts.port), range(opts.seed_interests))
+        logging.info("Seeded interests of %s clients", opts.seed_interests)
+    try:
+        server.thread.join()
+    except KeyboardInterrupt:
+        server.stop()
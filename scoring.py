@@ -1,34 +1,86 @@
 import hashlib
-import json
 import datetime
 
+import serializers
 
-def get_score(store, phone=None, email=None, birthday=None, gender=None, first_name=None, last_name=None):
+
+def get_score_key(first_name=None, last_name=None, phone=None, birthday=None, **kwargs):
+    # birthday is either the date parsed by the request validation or a string DD.MM.YYYY,
+    # phone is a string or an integer
+    if isinstance(birthday, str):
+        birthday = datetime.datetime.strptime(birthday, '%d.%m.%Y')
     key_parts = [
         first_name or "",
         last_name or "",
-        phone or "",
-        datetime.datetime.strptime(birthday, '%d.%m.%Y').strftime("%Y%m%d") if birthday is not None else ""
+        str(phone) if phone else "",
+        "%04d%02d%02d" % (birthday.year, birthday.month, birthday.day) if birthday is not None else ""
     ]
-    key = "uid:" + hashlib.md5("".join(key_parts).encode('utf-8')).hexdigest()
-    # try get from cache,
-    # fallback to heavy calculation in case of cache miss
-    score = store.cache_get(key) or 0
-    if score:
-        return score
+    return "uid:" + hashlib.md5("".join(key_parts).encode('utf-8')).hexdigest()
+
+
+def compute_score(phone=None, email=None, birthday=None, gender=None, first_name=None, last_name=None):
+    score = 0
     if phone:
         score += 1.5
     if email:
         score += 1.5
-    if birthday and gender:
+    # gender 0 (unknown) is a given value, only a missing gender does not count
+    if birthday and gender is not None:
         score += 1.5
     if first_name and last_name:
         score += 0.5
+    return score
+
+
+def get_score(store, phone=None, email=None, birthday=None, gender=None, first_name=None, last_name=None):
+    key = get_score_key(first_name, last_name, phone, birthday)
+    # try get from cache,
+    # fallback to heavy calculation in case of cache miss
+    score = store.cache_get(key) or 0
+    if score:
+        return score
+    score = compute_score(phone, email, birthday, gender, first_name, last_name)
     # cache for 60 minutes
     store.cache_set(key, score, 60 * 60)
     return score
 
 
+def get_scores_many(store, requests):
+    """
+    batched get_score: requests is a list of get_score keyword arguments, the cache is read
+    with one multi-get and the computed scores are saved with one multi-set
+    :return list of scores in the order of requests
+    """
+    keys = [get_score_key(**r) for r in requests]
+    scores = []
+    computed = {}
+    for key, r, score in zip(keys, requests, store.cache_get_many(keys)):
+        if not score:
+            score = compute_score(**r)
+            computed[key] = score
+        scores.append(score)
+    if computed:
+        store.cache_set_many(computed, 60 * 60)
+    return scores
+
+
 def get_interests(store, cid):
     r = store.get("i:%s" % cid)
-    return json.loads(r) if r else []
+    return decode_interests(r)
+
+
+def decode_interests(r):
+    # stores return JSON, the interests index returns the list itself
+    if not r:
+        return []
+    return r if isinstance(r, list) else serializers.loads(r)
+
+
+def get_interests_many(store, cids):
+    """
+    batched get_interests: repeated ids are requested once, all the keys in one store round-trip
+    :return dict[str, list]
+    """
+    unique = list(dict.fromkeys(str(cid) for cid in cids))
+    values = store.get_many(["i:%s" % cid for cid in unique])
+    return {cid: decode_interests(r) for cid, r in zip(unique, values)}
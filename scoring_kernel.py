@@ -0,0 +1,86 @@
+"""
+Columnar scoring for batch and offline rescoring: the scores of N applicants are computed in one
+vectorized pass over the presence bitmasks of their fields. NumPy is an optional dependency, it is
+needed only by this module.
+"""
+from scoring import compute_score, get_score_key
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+FIELDS = ("phone", "email", "birthday", "gender", "first_name", "last_name")
+PHONE, EMAIL, BIRTHDAY, GENDER, FIRST_NAME, LAST_NAME = (1 << n for n in range(len(FIELDS)))
+
+
+def require_numpy():
+    if np is None:
+        raise ImportError('scoring_kernel requires numpy, install it with "pip install numpy"')
+
+
+def score_table():
+    """
+    scores of all the 64 combinations of present fields, computed by the scalar compute_score,
+    so the kernel can not diverge from get_score
+    :return numpy.ndarray[float64] indexed by presence mask
+    """
+    require_numpy()
+    return np.array([compute_score(**{name: True if (mask >> n) & 1 else None for n, name in enumerate(FIELDS)})
+                     for mask in range(1 << len(FIELDS))], dtype=np.float64)
+
+
+SCORE_TABLE = score_table() if np is not None else None
+
+
+def presence_mask(request):
+    """
+    presence bitmask of get_score keyword arguments, the field is present when get_score treats it as present
+    :return int
+    """
+    mask = 0
+    for n, name in enumerate(FIELDS):
+        value = request.get(name)
+        # the same presence as in compute_score, gender 0 is present
+        if value or (name == "gender" and value is not None):
+            mask |= 1 << n
+    return mask
+
+
+def score_masks(masks):
+    """
+    scores of N applicants from their presence bitmasks, one gather from SCORE_TABLE
+    :return numpy.ndarray[float64]
+    """
+    require_numpy()
+    return SCORE_TABLE[np.asarray(masks, dtype=np.uint8) & ((1 << len(FIELDS)) - 1)]
+
+
+def score_columns(phone, email, birthday, gender, first_name, last_name):
+    """
+    scores of N applicants from per field presence columns (arrays of bool or anything numpy casts to bool)
+    :return numpy.ndarray[float64]
+    """
+    require_numpy()
+    masks = np.zeros(len(phone), dtype=np.uint8)
+    for n, column in enumerate((phone, email, birthday, gender, first_name, last_name)):
+        masks |= np.asarray(column, dtype=bool).astype(np.uint8) << n
+    return SCORE_TABLE[masks]
+
+
+def score_requests(requests):
+    """
+    scores of the list of get_score keyword arguments
+    :return numpy.ndarray[float64]
+    """
+    require_numpy()
+    return score_masks(np.fromiter((presence_mask(r) for r in requests), dtype=np.uint8, count=len(requests)))
+
+
+def score_keys(requests):
+    """
+    "uid:" cache keys of the list of get_score keyword arguments, md5 has no vectorized form,
+    so the keys are computed in one loop with the same get_score_key as the scalar path
+    :return list[str]
+    """
+    return [get_score_key(**r) for r in requests]
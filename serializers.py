@@ -0,0 +1,89 @@
+"""
+JSON serialization of the HTTP handlers and the store. The fastest installed backend is picked at import:
+orjson, ujson or the standard json module; the SCORING_JSON environment variable forces one of them, and then
+the other backends are not imported. dumps always returns bytes, loads takes bytes or str and raises ValueError
+on invalid JSON. orjson does not encode integers beyond 64 bits, such values are encoded by the json module.
+The fast backends decode the same as json.loads: a document with a number of 19 digits or more (which may not fit
+in 64 bits, orjson reads it as a float) or one they reject (NaN, Infinity) is decoded by the json module.
+"""
+import json
+import os
+
+# the digits are replaced with zeros, a run of 19 zeros is a long number; this is faster than a regular expression
+DIGITS_TO_ZEROS = bytes.maketrans(b'123456789', b'000000000')
+LONG_NUMBER = b'0' * 19
+
+
+def agreeing_loads(fast_loads):
+    """
+    :return loads of the fast backend, which falls back to json.loads where the backend differs from it
+    """
+    stdlib_loads = json.loads
+
+    def loads(data):
+        if LONG_NUMBER in (data.encode('utf-8') if isinstance(data, str) else data).translate(DIGITS_TO_ZEROS):
+            return stdlib_loads(data)
+        try:
+            return fast_loads(data)
+        except ValueError:
+            return stdlib_loads(data)
+
+    return loads
+
+
+def stdlib_backend():
+    encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+    return lambda obj: encoder.encode(obj).encode('utf-8'), json.loads
+
+
+def orjson_backend():
+    import orjson
+    orjson_dumps, stdlib_dumps = orjson.dumps, stdlib_backend()[0]
+
+    def dumps(obj):
+        try:
+            return orjson_dumps(obj)
+        except orjson.JSONEncodeError:
+            return stdlib_dumps(obj)
+
+    return dumps, agreeing_loads(orjson.loads)
+
+
+def ujson_backend():
+    import ujson
+    return lambda obj: ujson.dumps(obj, ensure_ascii=False).encode('utf-8'), agreeing_loads(ujson.loads)
+
+
+PREFERENCE = (("orjson", orjson_backend), ("ujson", ujson_backend), ("json", stdlib_backend))
+
+
+def available_backends():
+    """
+    :return dict of name -> (dumps, loads) of the installed backends in the order of preference
+    """
+    backends = {}
+    for name, factory in PREFERENCE:
+        try:
+            backends[name] = factory()
+        except ImportError:
+            pass
+    return backends
+
+
+def select_backend(name=None):
+    """
+    imports only the named backend, or the backends in the order of preference up to the first installed one
+    :return name, (dumps, loads)
+    """
+    for backend_name, factory in PREFERENCE:
+        if name and name != backend_name:
+            continue
+        try:
+            return backend_name, factory()
+        except ImportError:
+            if name:
+                raise ImportError('JSON backend %s is not installed' % name)
+    raise ImportError('JSON backend %s is unknown' % name)
+
+
+backend, (dumps, loads) = select_backend(os.environ.get("SCORING_JSON"))
@@ -1,12 +1,38 @@
-from datetime import datetime
+import contextlib
+import logging
+import os
 import random
+import threading
 import time
-import json
+from concurrent.futures import Future
+
+import metrics
+import serializers
+from cache import TTLCache
+
+
+INTERESTS = ("cars", "pets", "travel", "hi-tech", "sport", "music", "books", "tv", "cinema", "geek", "otus")
+
+
+def generate_interests(key):
+    """
+    interests of the mock store, they are the same for the same client id in the key; the generator
+    is seeded per call and does not touch the global random state, so it is thread-safe
+    :return JSON bytes
+    """
+    key_seed = key.split(':')[-1]
+    return serializers.dumps(random.Random(key_seed).sample(INTERESTS, 2))
+
 
 class MockStore(object):
-    def __init__(self, server):
-        self.store_cache = {}
+    """
+    The server is a MockStoreConnection or a StoreConnectionPool of them. With the pool every operation
+    borrows a connection for its time, so the size of the pool bounds the concurrent store calls.
+    """
+    def __init__(self, server, cache_capacity=100000):
+        self.store_cache = TTLCache(cache_capacity)
         self.server = server
+        self.pool = server if isinstance(server, StoreConnectionPool) else None
 
     def connect(self):
         if self.server.connected:
@@ -17,37 +43,323 @@ class MockStore(object):
                 return True
             return False
 
+    def cached(self, operation, *args, default=None):
+        """
+        runs the cache operation with a connection of the store, the default is returned when there is none
+        """
+        if self.pool is None:
+            return operation(*args) if self.connect() else default
+        try:
+            with self.pool.connection():
+                return operation(*args)
+        except ConnectionError:
+            return default
+
+    def stored(self, operation, *args):
+        """
+        runs the store operation with a connection of the store, raises ConnectionError when there is none
+        """
+        if self.pool is None:
+            if not self.connect():
+                raise ConnectionError('MokeStore emulating a connection error')
+            return operation(*args)
+        with self.pool.connection():
+            return operation(*args)
 
     def cache_set(self, key, value, save_time):
-        cache_time = datetime.now().timestamp() + save_time
-        connected = self.connect()
-        if connected:
-            self.store_cache[key] = (cache_time, value)
-        return
+        self.cached(self.store_cache.set, key, value, save_time)
 
     def cache_get(self, key):
-        request_time = datetime.now().timestamp()
-        connected = self.connect()
-        value = None
-        if connected:
-            try:
-                time_set, value = self.store_cache[key]
-            except KeyError:
-                pass
+        return self.cached(self.store_cache.get, key)
+
+    def cache_set_many(self, mapping, save_time):
+        """
+        multi-set: all the key-value pairs of the mapping for one connection check
+        """
+        self.cached(self.store_cache.set_many, mapping, save_time)
+
+    def cache_get_many(self, keys):
+        """
+        multi-get from the cache: values or None in the order of the keys
+        """
+        return self.cached(self.store_cache.get_many, keys, default=[None] * len(keys))
+
+    def get(self, key):
+        return self.stored(self.read, key)
+
+    def get_many(self, keys):
+        """
+        multi-get: values of all the keys for one connection check, in the order of the keys
+        """
+        return self.stored(self.read_many, keys)
+
+    def read(self, key):
+        return generate_interests(key)
+
+    def read_many(self, keys):
+        return [self.read(key) for key in keys]
+
+
+class AsyncMockStore(MockStore):
+    """
+    MockStore for the asyncio server: the server awaits connect_async before a request, it waits for a reconnect
+    with asyncio.sleep and all the waiting requests share one reconnect loop; then the handler calls the
+    synchronous methods in the thread pool of the server, they never wait for a reconnect themselves
+    """
+    def __init__(self, server, cache_capacity=100000):
+        super().__init__(server, cache_capacity)
+        self.reconnecting = None
+
+    def connect(self):
+        return self.server.connected
+
+    async def connect_async(self):
+        if self.server.connected:
+            return True
+        # asyncio is imported here, the blocking servers do not need it at the start
+        import asyncio
+        # all the coroutines waiting for the store share one reconnect loop
+        if self.reconnecting is None:
+            self.reconnecting = asyncio.ensure_future(self.reconnect())
+        return await asyncio.shield(self.reconnecting)
+
+    async def reconnect(self):
+        import asyncio
+        try:
+            for _ in range(self.server.attemps_lim):
+                if self.server.try_connect():
+                    return True
+                await asyncio.sleep(self.server.timeout)
+            return False
+        finally:
+            self.reconnecting = None
+
+
+class TieredStore(object):
+    """
+    Two-tier score cache: a local in-process L1 in front of the cache of the shared store (L2).
+    L1 entries live for ttl seconds, misses of L2 are cached for negative_ttl seconds, concurrent
+    lookups of the same key wait for one L2 read. Writes go through both tiers, everything else
+    is passed to the wrapped store. The counters of the stats are sharded per thread, as the metrics are.
+    """
+    MISSING = object()
+    NEGATIVE = object()
+
+    def __init__(self, store, capacity=10000, ttl=5, negative_ttl=1, wait_timeout=5):
+        self.store = store
+        self.l1 = TTLCache(capacity)
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.wait_timeout = wait_timeout
+        self.in_flight = {}
+        self.lock = threading.Lock()
+        self.l1_hits = metrics.Counter()
+        self.l1_negative_hits = metrics.Counter()
+        self.l1_misses = metrics.Counter()
+        self.l2_hits = metrics.Counter()
+        self.l2_misses = metrics.Counter()
+        self.coalesced = metrics.Counter()
+
+    def __getattr__(self, name):
+        return getattr(self.store, name)
+
+    def cache_get(self, key):
+        value = self.l1.get(key, self.MISSING)
+        if value is self.NEGATIVE:
+            self.l1_negative_hits.inc()
+            return None
+        if value is not self.MISSING:
+            self.l1_hits.inc()
+            return value
+        self.l1_misses.inc()
+        with self.lock:
+            future = self.in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = self.in_flight[key] = Future()
             else:
-                if time_set < request_time:
-                    del self.store_cache[key]
-                    value = None
+                self.coalesced.inc()
+        if not leader:
+            try:
+                return future.result(self.wait_timeout)
+            except Exception:
+                return None
+        try:
+            value = self.store.cache_get(key)
+            self.remember(key, value)
+            future.set_result(value)
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.in_flight[key]
         return value
 
-    def get(self, key):
-        connected = self.connect()
+    def cache_get_many(self, keys):
+        values = self.l1.get_many(keys, self.MISSING)
+        missed = [n for n, value in enumerate(values) if value is self.MISSING]
+        negative = values.count(self.NEGATIVE)
+        self.l1_hits.inc(len(values) - len(missed) - negative)
+        self.l1_negative_hits.inc(negative)
+        self.l1_misses.inc(len(missed))
+        if missed:
+            for n, value in zip(missed, self.store.cache_get_many([keys[n] for n in missed])):
+                self.remember(keys[n], value)
+                values[n] = value
+        return [None if value is self.NEGATIVE else value for value in values]
+
+    def cache_set(self, key, value, save_time):
+        self.store.cache_set(key, value, save_time)
+        self.l1.set(key, value, min(self.ttl, save_time))
+
+    def cache_set_many(self, mapping, save_time):
+        self.store.cache_set_many(mapping, save_time)
+        self.l1.set_many(mapping, min(self.ttl, save_time))
+
+    def remember(self, key, value):
+        if value is None:
+            self.l2_misses.inc()
+            self.l1.set(key, self.NEGATIVE, self.negative_ttl)
+        else:
+            self.l2_hits.inc()
+            self.l1.set(key, value, self.ttl)
+
+    def stats(self):
+        l1_hits, l1_negative_hits, l1_misses = self.l1_hits.value, self.l1_negative_hits.value, self.l1_misses.value
+        l2_hits, l2_misses = self.l2_hits.value, self.l2_misses.value
+        l1_lookups = l1_hits + l1_negative_hits + l1_misses
+        l2_lookups = l2_hits + l2_misses
+        return {
+            "l1_hits": l1_hits,
+            "l1_negative_hits": l1_negative_hits,
+            "l1_misses": l1_misses,
+            "l1_hit_ratio": (l1_hits + l1_negative_hits) / l1_lookups if l1_lookups else 0.,
+            "l2_hits": l2_hits,
+            "l2_misses": l2_misses,
+            "l2_hit_ratio": l2_hits / l2_lookups if l2_lookups else 0.,
+            "coalesced": self.coalesced.value,
+            "l1_size": len(self.l1),
+        }
+
+
+class BreakerStore(object):
+    """
+    Store wrapper with the circuit breaker: while the circuit is open get and get_many fail at once with
+    ConnectionError and the cache methods skip the store entirely, so an outage does not cost a reconnect
+    per request. Everything else is passed to the wrapped store.
+    """
+    def __init__(self, store, breaker):
+        self.store = store
+        self.breaker = breaker
+
+    def __getattr__(self, name):
+        return getattr(self.store, name)
+
+    def call(self, method, *args):
+        if not self.breaker.allow():
+            raise ConnectionError('Store circuit breaker is open')
+        try:
+            value = method(*args)
+        except ConnectionError:
+            self.breaker.record_failure()
+            raise
+        except BaseException:
+            # not an outage of the store, a half-open trial must not be kept forever
+            self.breaker.release()
+            raise
+        else:
+            self.breaker.record_success()
+            return value
+
+    def cache_call(self, method, *args, default=None):
+        if not self.breaker.allow():
+            return default
+        # the cache methods of the store hide connection errors, so the connection is checked here
+        try:
+            connected = self.store.connect()
+        except BaseException:
+            self.breaker.release()
+            raise
         if not connected:
-            raise ConnectionError('MokeStore emulating a connection error')
-        key_seed = key.split(':')[-1]
-        random.seed(key_seed)
-        interests = ["cars", "pets", "travel", "hi-tech", "sport", "music", "books", "tv", "cinema", "geek", "otus"]
-        return json.dumps(random.sample(interests, 2))
+            self.breaker.record_failure()
+            return default
+        self.breaker.record_success()
+        return method(*args)
+
+    def get(self, key):
+        return self.call(self.store.get, key)
+
+    def get_many(self, keys):
+        return self.call(self.store.get_many, keys)
+
+    def cache_get(self, key):
+        return self.cache_call(self.store.cache_get, key)
+
+    def cache_get_many(self, keys):
+        return self.cache_call(self.store.cache_get_many, keys, default=[None] * len(keys))
+
+    def cache_set(self, key, value, save_time):
+        return self.cache_call(self.store.cache_set, key, value, save_time)
+
+    def cache_set_many(self, mapping, save_time):
+        return self.cache_call(self.store.cache_set_many, mapping, save_time)
+
+
+class MeteredStore(object):
+    """
+    Store wrapper which records the latency and the connection errors of every store call and the hits and
+    misses of the score cache in the metrics registry. Everything else is passed to the wrapped store.
+    The timed calls are closures over the method of the store and its metrics, built once for the wrapper.
+    """
+    OPERATIONS = ("get", "get_many", "cache_get", "cache_get_many", "cache_set", "cache_set_many")
+
+    def __init__(self, store, registry=metrics.registry):
+        self.store = store
+        self.hits = registry.counter("scoring_cache_hits_total", (), "Scores found in the cache")
+        self.misses = registry.counter("scoring_cache_misses_total", (), "Scores not found in the cache")
+        for op in self.OPERATIONS:
+            latency = registry.histogram("scoring_store_seconds", (("operation", op),), "Latency of the store calls")
+            errors = registry.counter("scoring_store_errors_total", (("operation", op),),
+                                      "Store calls failed with a connection error")
+            setattr(self, "timed_" + op, self.timed(getattr(store, op), latency.observe, errors.inc))
+        self.get, self.get_many = self.timed_get, self.timed_get_many
+        self.cache_set, self.cache_set_many = self.timed_cache_set, self.timed_cache_set_many
+        registry.register(self.collect, "scoring_cache")
+
+    @staticmethod
+    def timed(method, observe, error):
+        clock = time.perf_counter
+
+        def call(*args):
+            started = clock()
+            try:
+                return method(*args)
+            except ConnectionError:
+                error()
+                raise
+            finally:
+                observe(clock() - started)
+        return call
+
+    def __getattr__(self, name):
+        return getattr(self.store, name)
+
+    def collect(self):
+        hits, misses = self.hits.value, self.misses.value
+        return [("scoring_cache_hit_ratio", (), hits / (hits + misses) if hits + misses else 0.)]
+
+    def cache_get(self, key):
+        value = self.timed_cache_get(key)
+        (self.misses if value is None else self.hits).inc()
+        return value
+
+    def cache_get_many(self, keys):
+        values = self.timed_cache_get_many(keys)
+        missed = values.count(None)
+        self.hits.inc(len(values) - missed)
+        self.misses.inc(missed)
+        return values
 
 
 class MockStoreConnection(object):
@@ -57,18 +369,126 @@ class MockStoreConnection(object):
         self.timeout = 1
         self.attemps_lim = 10
 
+    def try_connect(self):
+        if not self.connected:
+            self.connected = random.random() > self.connect_prob
+        return self.connected
+
     def request(self):
 
         if not self.connected:
             attemps = 0
-            value = False
             while attemps < self.attemps_lim:
-                if random.random() > self.connect_prob:
-                    value = True
+                if self.try_connect():
                     break
                 else:
-                    print(attemps)
                     attemps += 1
-                    print('Try to reconnect.')
+                    logging.info('Try to reconnect to the store, attempt %s', attemps)
                     time.sleep(self.timeout)
-            self.connected = value
+
+
+class StoreConnectionPool(object):
+    """
+    Pool of store connections, which MockStore can use in place of a single connection. A background
+    thread checks the connections and reconnects the dead ones with exponential back-off and jitter,
+    so a request never runs the reconnect loop itself: it gets a healthy connection or gives up
+    after the deadline.
+    """
+    def __init__(self, factory, size=4, deadline=0.5, base_delay=0.1, max_delay=10., check_interval=0.1,
+                 health_check=None):
+        self.connections = [factory() for _ in range(size)]
+        self.idle = list(self.connections)
+        self.failures = [0] * size
+        self.next_attempt = [0.] * size
+        self.deadline = deadline
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.check_interval = check_interval
+        self.health_check = health_check or (lambda conn: conn.connected)
+        self.condition = threading.Condition()
+        self.stopped = threading.Event()
+        self.reconnector = None
+        self.pid = None
+
+    @property
+    def connected(self):
+        return any(self.health_check(conn) for conn in self.connections)
+
+    def start(self):
+        # the thread is started on first use and again in a forked worker, where it does not exist
+        if self.reconnector is None or self.pid != os.getpid() or not self.reconnector.is_alive():
+            self.pid = os.getpid()
+            self.reconnector = threading.Thread(target=self.reconnect_loop, name='store-reconnect', daemon=True)
+            self.reconnector.start()
+
+    def close(self):
+        self.stopped.set()
+        if self.reconnector is not None and self.pid == os.getpid():
+            self.reconnector.join()
+
+    def request(self):
+        """
+        waits up to the deadline until the reconnect thread restores any connection
+        """
+        self.start()
+        deadline = time.monotonic() + self.deadline
+        with self.condition:
+            while not self.connected:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                self.condition.wait(remaining)
+
+    def acquire(self, timeout=None):
+        """
+        takes a healthy idle connection, waits for it up to timeout (the deadline by default)
+        :return connection or raises ConnectionError
+        """
+        self.start()
+        timeout = self.deadline if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while True:
+                for conn in self.idle:
+                    if self.health_check(conn):
+                        self.idle.remove(conn)
+                        return conn
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise ConnectionError('No healthy store connection in %s seconds' % timeout)
+                self.condition.wait(remaining)
+
+    def release(self, conn):
+        with self.condition:
+            self.idle.append(conn)
+            self.condition.notify_all()
+
+    @contextlib.contextmanager
+    def connection(self, timeout=None):
+        conn = self.acquire(timeout)
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def reconnect_loop(self):
+        while not self.stopped.wait(self.check_interval):
+            self.check()
+
+    def check(self):
+        now = time.monotonic()
+        for n, conn in enumerate(self.connections):
+            if self.health_check(conn):
+                self.failures[n] = 0
+                continue
+            if now < self.next_attempt[n]:
+                continue
+            if conn.try_connect():
+                self.failures[n] = 0
+                with self.condition:
+                    self.condition.notify_all()
+            else:
+                self.failures[n] += 1
+                delay = random.uniform(0.5, 1.) * min(self.max_delay, self.base_delay * 2 ** self.failures[n])
+                self.next_attempt[n] = now + delay
+                logging.info('Store connection %s is down, next attempt in %.2f seconds', n, delay)
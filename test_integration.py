@@ -1,8 +1,29 @@
+import asyncio
+import contextlib
+import gzip
+import http.client
+import io
+import json
+import optparse
+import os
+import pstats
+import signal
+import tempfile
+import threading
+import time
 import unittest
 from datetime import datetime
+from http.server import HTTPServer
 
-from store import MockStore, MockStoreConnection
+from store import MockStore, MockStoreConnection, AsyncMockStore, TieredStore, StoreConnectionPool, BreakerStore
+from breaker import CircuitBreaker, OPEN, CLOSED
 import api
+import async_api
+import resp
+import interests_index
+import offline_api
+import profiling
+from benchmarks import loadtest
 from help_functions import cases, set_valid_auth, get_store_cache_key
 
 
@@ -33,7 +54,7 @@ class TestIntergationConnectSuite(unittest.TestCase):
         self.assertEqual(api.OK, code, arguments)
         key = get_store_cache_key(request)
         self.assertTrue(key in self.store.store_cache, arguments)
-        self.assertEqual(response.get("score"), self.store.store_cache[key][1], arguments)
+        self.assertEqual(response.get("score"), self.store.store_cache[key], arguments)
 
     @cases([
         {"phone": "79175002040", "email": "dev@otus.ru"},
@@ -77,6 +98,60 @@ class TestIntergationConnectSuite(unittest.TestCase):
         self.assertTrue(all(v and isinstance(v, list) for v in response.values()))
         self.assertEqual(self.context.get("nclients"), len(arguments["client_ids"]))
 
+    def test_ok_score_batch_request(self):
+        calls = []
+        for name in ("cache_get_many", "cache_set_many"):
+            method = getattr(self.store, name)
+            setattr(self.store, name, lambda *args, _name=name, _method=method: calls.append(_name) or _method(*args))
+        items = [
+            {"phone": "79175002040", "email": "dev@otus.ru"},
+            {"phone": "79175002040"},
+            {"gender": 1, "birthday": "01.01.2000", "first_name": "a", "last_name": "b"},
+            "a",
+        ]
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "online_score_batch",
+                   "arguments": {"items": items}}
+        set_valid_auth(request)
+        response, code = self.get_response(request)
+        self.assertEqual(api.OK, code)
+        self.assertEqual(["cache_get_many", "cache_set_many"], calls)
+        self.assertEqual([api.OK, api.INVALID_REQUEST, api.OK, api.INVALID_REQUEST], [r["code"] for r in response])
+        self.assertEqual(3.0, response[0]["response"]["score"])
+        self.assertEqual(2.0, response[2]["response"]["score"])
+        self.assertEqual(self.context["nitems"], 4)
+        self.assertEqual(self.context["nerrors"], 2)
+        self.assertEqual(self.context["has"]["phone"], 1)
+        for item in (items[0], items[2]):
+            single = {"account": "horns&hoofs", "login": "h&f", "method": "online_score", "arguments": item}
+            set_valid_auth(single)
+            self.assertTrue(get_store_cache_key(single) in self.store.store_cache)
+
+    @cases([
+        {"items": []},
+        {"items": {"phone": "79175002040", "email": "dev@otus.ru"}},
+        {"items": [{}] * (api.MAX_BATCH_SIZE + 1)},
+        {},
+    ])
+    def test_invalid_score_batch_request(self, arguments):
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "online_score_batch", "arguments": arguments}
+        set_valid_auth(request)
+        response, code = self.get_response(request)
+        self.assertEqual(api.INVALID_REQUEST, code)
+
+    def test_interests_one_round_trip(self):
+        requested = []
+        get_many = self.store.get_many
+        self.store.get_many = lambda keys: requested.append(keys) or get_many(keys)
+        arguments = {"client_ids": [1, 2, 1, 3, 2]}
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "clients_interests", "arguments": arguments}
+        set_valid_auth(request)
+        response, code = self.get_response(request)
+        self.assertEqual(api.OK, code)
+        self.assertEqual([["i:1", "i:2", "i:3"]], requested)
+        self.assertEqual(["1", "2", "3"], sorted(response))
+        self.assertEqual(json.loads(self.store.get("i:2")), response["2"])
+        self.assertEqual(self.context.get("nclients"), 5)
+
 
 class TestIntergationUnconnectSuite(unittest.TestCase):
     def setUp(self):
@@ -116,5 +191,761 @@ class TestIntergationUnconnectSuite(unittest.TestCase):
         self.assertEqual(api.INTERNAL_ERROR, code, arguments)
 
 
+class TestIntegrationAsyncSuite(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.store_connection = MockStoreConnection(connected=False, probability=1)
+        self.store_connection.timeout = 0.01
+        self.store = AsyncMockStore(self.store_connection)
+        self.server = await asyncio.start_server(
+            lambda reader, writer: async_api.handle_connection(reader, writer, self.store), "localhost", 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def asyncTearDown(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def post(self, reader, writer, request):
+        body = json.dumps(request).encode('utf-8')
+        writer.write(b'POST /method HTTP/1.1\r\nContent-Length: %d\r\n\r\n' % len(body) + body)
+        await writer.drain()
+        headers = await reader.readuntil(b'\r\n\r\n')
+        length = int([h for h in headers.split(b'\r\n') if h.startswith(b'Content-Length')][0].split(b':')[1])
+        return json.loads(await reader.readexactly(length))
+
+    async def test_reconnect_is_shared(self):
+        attempts = []
+        try_connect = self.store_connection.try_connect
+        self.store_connection.try_connect = lambda: attempts.append(1) or try_connect()
+        results = await asyncio.gather(*[self.store.connect_async() for _ in range(5)])
+        self.assertEqual([False] * 5, results)
+        self.assertIsNone(self.store.reconnecting)
+        # one reconnect loop has run for all the five waiting coroutines
+        self.assertEqual(self.store_connection.attemps_lim, len(attempts))
+
+    async def test_blocking_store_does_not_block_loop(self):
+        connection = MockStoreConnection(connected=False, probability=1)
+        connection.timeout, connection.attemps_lim = 0.1, 3
+        server = await asyncio.start_server(
+            lambda reader, writer: async_api.handle_connection(reader, writer, MockStore(connection)), "localhost", 0)
+        try:
+            reader, writer = await asyncio.open_connection("localhost", server.sockets[0].getsockname()[1])
+            request = {"account": "horns&hoofs", "login": "h&f", "method": "online_score",
+                       "arguments": {"first_name": "a", "last_name": "b"}}
+            set_valid_auth(request)
+            response = asyncio.ensure_future(self.post(reader, writer, request))
+            await asyncio.sleep(0.05)
+            started = asyncio.get_running_loop().time()
+            await asyncio.sleep(0.01)
+            self.assertLess(asyncio.get_running_loop().time() - started, 0.1)
+            self.assertEqual(api.OK, (await response)["code"])
+            writer.close()
+        finally:
+            server.close()
+            await server.wait_closed()
+
+    async def test_keep_alive_requests(self):
+        reader, writer = await asyncio.open_connection("localhost", self.port)
+        score = {"account": "horns&hoofs", "login": "h&f", "method": "online_score",
+                 "arguments": {"first_name": "a", "last_name": "b"}}
+        interests = {"account": "horns&hoofs", "login": "h&f", "method": "clients_interests",
+                     "arguments": {"client_ids": [1, 2]}}
+        set_valid_auth(score)
+        set_valid_auth(interests)
+        r = await self.post(reader, writer, score)
+        self.assertEqual(api.OK, r["code"])
+        r = await self.post(reader, writer, interests)
+        self.assertEqual(api.INTERNAL_ERROR, r["code"])
+        writer.close()
+
+
+class TestIntegrationTieredStoreSuite(unittest.TestCase):
+    def setUp(self):
+        self.context = {}
+        self.headers = {}
+        self.store = TieredStore(MockStore(MockStoreConnection()), capacity=100, ttl=60, negative_ttl=60)
+
+    def get_response(self, request):
+        return api.method_handler({"body": request, "headers": self.headers}, self.context, self.store)
+
+    def test_score_tiers(self):
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "online_score",
+                   "arguments": {"phone": "79175002040", "email": "dev@otus.ru"}}
+        set_valid_auth(request)
+        key = get_store_cache_key(request)
+        for _ in range(3):
+            response, code = self.get_response(request)
+            self.assertEqual(api.OK, code)
+            self.assertEqual(3.0, response["score"])
+        self.assertEqual(3.0, self.store.store.store_cache[key])
+        stats = self.store.stats()
+        self.assertEqual((2, 1, 0, 1), (stats["l1_hits"], stats["l1_misses"], stats["l2_hits"], stats["l2_misses"]))
+
+    def test_negative_cache(self):
+        self.assertIsNone(self.store.cache_get("uid:1"))
+        self.store.store.cache_set("uid:1", 1.5, 60)
+        self.assertIsNone(self.store.cache_get("uid:1"))
+        self.assertEqual(1, self.store.stats()["l1_negative_hits"])
+        self.store.cache_set("uid:1", 1.5, 60)
+        self.assertEqual(1.5, self.store.cache_get("uid:1"))
+
+    def test_coalescing(self):
+        reads = []
+        cache_get = self.store.store.cache_get
+
+        def slow_cache_get(key):
+            reads.append(key)
+            time.sleep(0.1)
+            return cache_get(key)
+
+        self.store.store.cache_set("uid:2", 3.0, 60)
+        self.store.store.cache_get = slow_cache_get
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(self.store.cache_get("uid:2"))) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(["uid:2"], reads)
+        self.assertEqual([3.0] * 5, results)
+        self.assertEqual(4, self.store.stats()["coalesced"])
+
+    def test_stats_of_threads(self):
+        self.store.cache_set("uid:3", 2.0, 60)
+
+        def lookups():
+            for _ in range(2000):
+                self.store.cache_get("uid:3")
+                self.store.cache_get_many(["uid:3", "uid:4"])
+
+        threads = [threading.Thread(target=lookups) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stats = self.store.stats()
+        self.assertEqual(8000 * 3, stats["l1_hits"] + stats["l1_negative_hits"] + stats["l1_misses"])
+
+
+class TestIntegrationConnectionPoolSuite(unittest.TestCase):
+    def setUp(self):
+        self.context = {}
+        self.headers = {}
+
+    def tearDown(self):
+        self.pool.close()
+
+    def get_response(self, request, store):
+        return api.method_handler({"body": request, "headers": self.headers}, self.context, store)
+
+    def test_dead_store_fails_within_deadline(self):
+        self.pool = StoreConnectionPool(lambda: MockStoreConnection(connected=False, probability=1),
+                                        size=2, deadline=0.2)
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "clients_interests",
+                   "arguments": {"client_ids": [1, 2]}}
+        set_valid_auth(request)
+        start = time.monotonic()
+        response, code = self.get_response(request, MockStore(self.pool))
+        self.assertEqual(api.INTERNAL_ERROR, code)
+        self.assertTrue(time.monotonic() - start < 1)
+        with self.assertRaises(ConnectionError):
+            self.pool.acquire()
+
+    def test_healthy_connection(self):
+        self.pool = StoreConnectionPool(lambda: MockStoreConnection(), size=2, deadline=0.2)
+        self.pool.connections[0].connected = False
+        self.pool.connections[0].connect_prob = 1
+        with self.pool.connection() as conn:
+            self.assertIs(self.pool.connections[1], conn)
+            with self.assertRaises(ConnectionError):
+                self.pool.acquire()
+        self.assertTrue(self.pool.connected)
+
+    def test_background_reconnect(self):
+        self.pool = StoreConnectionPool(lambda: MockStoreConnection(connected=False, probability=0),
+                                        size=2, deadline=1, check_interval=0.01)
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "clients_interests",
+                   "arguments": {"client_ids": [1, 2]}}
+        set_valid_auth(request)
+        response, code = self.get_response(request, MockStore(self.pool))
+        self.assertEqual(api.OK, code)
+        self.assertTrue(self.pool.connected)
+
+    def test_size_bounds_concurrent_calls(self):
+        self.pool = StoreConnectionPool(MockStoreConnection, size=2, deadline=0.5)
+        store = MockStore(self.pool)
+        lock, active, peak = threading.Lock(), [0], [0]
+        read = store.read
+
+        def slow_read(key):
+            with lock:
+                active[0] += 1
+                peak[0] = max(peak[0], active[0])
+            time.sleep(0.05)
+            with lock:
+                active[0] -= 1
+            return read(key)
+
+        store.read = slow_read
+        threads = [threading.Thread(target=store.get, args=("i:%s" % n,)) for n in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(2, peak[0])
+        self.assertEqual(2, len(self.pool.idle))
+        with self.pool.connection(), self.pool.connection():
+            self.assertIsNone(store.cache_get("uid:1"))
+
+
+class TestIntegrationBreakerSuite(unittest.TestCase):
+    def setUp(self):
+        self.context = {}
+        self.headers = {}
+        self.store_connection = MockStoreConnection(connected=False, probability=1)
+        self.store_connection.timeout = 0
+        self.breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+        self.store = BreakerStore(MockStore(self.store_connection), self.breaker)
+        self.score = {"account": "horns&hoofs", "login": "h&f", "method": "online_score",
+                      "arguments": {"phone": "79175002040", "email": "dev@otus.ru"}}
+        self.interests = {"account": "horns&hoofs", "login": "h&f", "method": "clients_interests",
+                          "arguments": {"client_ids": [1, 2]}}
+        set_valid_auth(self.score)
+        set_valid_auth(self.interests)
+
+    def get_response(self, request):
+        return api.method_handler({"body": request, "headers": self.headers}, self.context, self.store)
+
+    def test_outage(self):
+        for _ in range(2):
+            _, code = self.get_response(self.interests)
+            self.assertEqual(api.INTERNAL_ERROR, code)
+        self.assertEqual(OPEN, self.breaker.state)
+        requests = []
+        self.store_connection.request = lambda: requests.append(1)
+        _, code = self.get_response(self.interests)
+        self.assertEqual(api.INTERNAL_ERROR, code)
+        response, code = self.get_response(self.score)
+        self.assertEqual(api.OK, code)
+        self.assertEqual(3.0, response["score"])
+        self.assertEqual([], requests)
+
+    def test_recovery(self):
+        self.get_response(self.score)
+        self.assertEqual(OPEN, self.breaker.state)
+        self.breaker.reset_timeout = 0
+        self.store_connection.connect_prob = 0
+        _, code = self.get_response(self.interests)
+        self.assertEqual(api.OK, code)
+        self.assertEqual(CLOSED, self.breaker.state)
+
+
+class TestIntegrationRespSuite(unittest.TestCase):
+    def setUp(self):
+        self.context = {}
+        self.headers = {}
+        self.server = resp.RespServer().start()
+        self.store = resp.RespStore.from_url("resp://localhost:%s" % self.server.port, pool_size=2, deadline=0.2)
+        resp.seed_interests(self.store, range(10))
+
+    def tearDown(self):
+        self.server.stop()
+        self.store.pool.close()
+
+    def get_response(self, request):
+        return api.method_handler({"body": request, "headers": self.headers}, self.context, self.store)
+
+    def test_ok_score_request(self):
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "online_score",
+                   "arguments": {"phone": "79175002040", "email": "dev@otus.ru"}}
+        set_valid_auth(request)
+        response, code = self.get_response(request)
+        self.assertEqual(api.OK, code)
+        key = get_store_cache_key(request)
+        self.assertEqual(b"3.0", self.server.data[key.encode('utf-8')][0])
+        self.assertEqual(3.0, self.store.cache_get(key))
+
+    def test_ok_interests_request(self):
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "clients_interests",
+                   "arguments": {"client_ids": [1, 2, 100]}}
+        set_valid_auth(request)
+        response, code = self.get_response(request)
+        self.assertEqual(api.OK, code)
+        self.assertEqual(json.loads(MockStore(MockStoreConnection()).get("i:1")), response["1"])
+        self.assertEqual([], response["100"])
+
+    def test_pipeline(self):
+        replies = self.store.pipeline([("SETEX", "a", 10, "1"), ("SET", "b", "2", "EX", 10), ("MGET", "a", "b", "c"),
+                                       ("DEL", "a"), ("EXISTS", "a", "b"), ("UNKNOWN",)])
+        self.assertEqual([b"OK", b"OK", [b"1", b"2", None], 1, 1], replies[:5])
+        self.assertIsInstance(replies[5], resp.RespError)
+
+    def test_store_outage(self):
+        self.server.stop()
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "clients_interests",
+                   "arguments": {"client_ids": [1, 2]}}
+        set_valid_auth(request)
+        _, code = self.get_response(request)
+        self.assertEqual(api.INTERNAL_ERROR, code)
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "online_score",
+                   "arguments": {"first_name": "a", "last_name": "b"}}
+        set_valid_auth(request)
+        response, code = self.get_response(request)
+        self.assertEqual(api.OK, code)
+        self.assertEqual(0.5, response["score"])
+
+    def test_connects_on_first_command(self):
+        conn = resp.RespConnection("localhost", self.server.port)
+        self.assertTrue(conn.connected)
+        self.assertIsNone(conn.sock)
+        self.assertEqual(b"OK", conn.execute("SET", "a", "1"))
+        self.assertIsNotNone(conn.sock)
+        conn.close()
+        conn = resp.RespConnection("localhost", 1)
+        self.assertRaises(ConnectionError, conn.execute, "GET", "a")
+        self.assertFalse(conn.connected)
+
+    def test_socket_is_not_shared_after_fork(self):
+        conn = resp.RespConnection("localhost", self.server.port)
+        conn.execute("SET", "a", "1")
+        parent_address = conn.sock.getsockname()
+        read_end, write_end = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.close(read_end)
+                value = conn.execute("GET", "a")
+                os.write(write_end, json.dumps([value.decode(), conn.sock.getsockname()[1]]).encode())
+            finally:
+                os._exit(0)
+        os.close(write_end)
+        with os.fdopen(read_end) as f:
+            value, child_port = json.load(f)
+        os.waitpid(pid, 0)
+        self.assertEqual("1", value)
+        self.assertNotEqual(parent_address[1], child_port)
+        self.assertEqual(parent_address, conn.sock.getsockname())
+        self.assertEqual(b"1", conn.execute("GET", "a"))
+        conn.close()
+
+
+class TestIntegrationInterestsIndexSuite(unittest.TestCase):
+    def setUp(self):
+        self.context = {}
+        self.headers = {}
+        self.mock_store = MockStore(MockStoreConnection())
+        fd, self.path = tempfile.mkstemp(suffix=".idx")
+        os.close(fd)
+
+    def tearDown(self):
+        self.index.close()
+        os.remove(self.path)
+
+    def get_response(self, request, store):
+        return api.method_handler({"body": request, "headers": self.headers}, self.context, store)
+
+    @cases([range(0, 50), [7, 3, 10 ** 12, 3, -5]])
+    def test_same_as_mock_store(self, cids):
+        interests_index.build_index(self.path, cids)
+        self.index = interests_index.InterestsIndex(self.path)
+        self.assertEqual(len(set(cids)), len(self.index))
+        for cid in set(cids):
+            self.assertEqual(json.loads(self.mock_store.get("i:%s" % cid)), self.index.lookup(cid))
+        self.assertIsNone(self.index.lookup(51))
+        self.index.close()
+
+    def test_interests_request(self):
+        interests_index.build_index(self.path, [1, 2, 5])
+        self.index = interests_index.InterestsIndex(self.path)
+        store = interests_index.IndexedStore(self.mock_store, self.index)
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "clients_interests",
+                   "arguments": {"client_ids": [1, 5, 3, 1.0, 5.0, 1.5, 10 ** 12]}}
+        set_valid_auth(request)
+        response, code = self.get_response(request, store)
+        self.assertEqual(api.OK, code)
+        self.assertEqual(json.loads(self.mock_store.get("i:5")), response["5"])
+        self.assertEqual(response["1"], response["1.0"])
+        self.assertEqual(response["5"], response["5.0"])
+        self.assertTrue(response["1.0"])
+        # the clients which are not in the index have no interests
+        self.assertEqual([], response["3"])
+        self.assertEqual([], response["1.5"])
+        self.assertEqual([], response[str(10 ** 12)])
+
+
+class TestIntegrationOfflineSuite(unittest.TestCase):
+    def setUp(self):
+        score = {"account": "horns&hoofs", "login": "h&f", "method": "online_score",
+                 "arguments": {"phone": "79175002040", "email": "dev@otus.ru"}}
+        interests = {"account": "horns&hoofs", "login": "h&f", "method": "clients_interests",
+                     "arguments": {"client_ids": [1, 2]}}
+        set_valid_auth(score)
+        set_valid_auth(interests)
+        lines = [json.dumps(score), "", json.dumps(interests), "{not a json", json.dumps({"login": "h&f"})] * 5
+        self.lines = [(line + "\n").encode('utf-8') for line in lines]
+
+    def run_offline(self, **kwargs):
+        output = io.BytesIO()
+        written = offline_api.run(io.BytesIO(b"".join(self.lines)), output, chunk_size=3, **kwargs)
+        results = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEqual(20, written)
+        self.assertEqual(20, len(results))
+        return results
+
+    def check(self, results):
+        for r in results:
+            code = {1: api.OK, 3: api.OK, 4: api.BAD_REQUEST, 0: api.INVALID_REQUEST}[r["line"] % 5]
+            self.assertEqual(code, r["code"], r)
+        self.assertEqual({"score": 3.0}, results[0]["response"])
+
+    def test_ordered(self):
+        results = self.run_offline()
+        self.assertEqual([n for n in range(1, 26) if n % 5 != 2], [r["line"] for r in results])
+        self.check(results)
+
+    def test_process_pool(self):
+        results = self.run_offline(processes=2)
+        self.assertEqual([n for n in range(1, 26) if n % 5 != 2], [r["line"] for r in results])
+        self.check(results)
+
+    def test_process_pool_unordered(self):
+        results = sorted(self.run_offline(processes=2, ordered=False), key=lambda r: r["line"])
+        self.check(results)
+
+
+class TestIntegrationKeepAliveSuite(unittest.TestCase):
+    class Handler(api.MainHTTPHandler):
+        max_requests = 3
+        gzip_min_size = 1
+        timeout = 5
+
+    def setUp(self):
+        self.server = api.ThreadPoolHTTPServer(("localhost", 0), self.Handler, 2)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.connection = http.client.HTTPConnection("localhost", self.server.server_address[1], timeout=5)
+        self.request = {"account": "horns&hoofs", "login": "h&f", "method": "online_score",
+                        "arguments": {"phone": "79175002040", "email": "dev@otus.ru"}}
+        set_valid_auth(self.request)
+
+    def tearDown(self):
+        self.connection.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def post(self, headers=None):
+        self.connection.request("POST", "/method", json.dumps(self.request), headers or {})
+        response = self.connection.getresponse()
+        return response, response.read()
+
+    def test_persistent_connection(self):
+        sockets = set()
+        for n in range(3):
+            response, body = self.post()
+            if self.connection.sock is not None:
+                sockets.add(self.connection.sock)
+            self.assertEqual(api.OK, response.status)
+            self.assertEqual(str(len(body)), response.getheader("Content-Length"))
+            self.assertEqual({"score": 3.0}, json.loads(body)["response"])
+        self.assertEqual(1, len(sockets))
+        self.assertEqual("close", response.getheader("Connection"))
+        self.assertIsNone(self.connection.sock)
+
+    def test_gzip(self):
+        response, body = self.post({"Accept-Encoding": "gzip"})
+        self.assertEqual("gzip", response.getheader("Content-Encoding"))
+        self.assertEqual(str(len(body)), response.getheader("Content-Length"))
+        self.assertEqual({"score": 3.0}, json.loads(gzip.decompress(body))["response"])
+        response, body = self.post()
+        self.assertIsNone(response.getheader("Content-Encoding"))
+        self.assertEqual({"score": 3.0}, json.loads(body)["response"])
+
+    def test_metrics(self):
+        self.post()
+        self.connection.request("GET", "/metrics")
+        response = self.connection.getresponse()
+        text = response.read().decode('utf-8')
+        self.assertEqual(api.OK, response.status)
+        self.assertTrue(response.getheader("Content-Type").startswith("text/plain"))
+        self.assertIn('scoring_request_seconds_bucket{method="online_score",code="200",le="+Inf"}', text)
+        self.assertIn("scoring_auth_hit_ratio", text)
+        self.connection.request("GET", "/unknown")
+        response = self.connection.getresponse()
+        self.assertEqual(api.NOT_FOUND, response.status)
+        self.assertEqual(api.NOT_FOUND, json.loads(response.read())["code"])
+
+    def test_idle_connections(self):
+        port = self.server.server_address[1]
+        idle = [http.client.HTTPConnection("localhost", port, timeout=5) for _ in range(2)]
+        try:
+            for connection in idle:
+                connection.request("POST", "/method", json.dumps(self.request))
+                response = connection.getresponse()
+                self.assertEqual(api.OK, response.status)
+                response.read()
+            started = time.monotonic()
+            response, body = self.post()
+            self.assertEqual(api.OK, response.status)
+            self.assertLess(time.monotonic() - started, 1)
+            for connection in idle:
+                sock = connection.sock
+                connection.request("POST", "/method", json.dumps(self.request))
+                response = connection.getresponse()
+                self.assertEqual({"score": 3.0}, json.loads(response.read())["response"])
+                self.assertIs(sock, connection.sock)
+        finally:
+            for connection in idle:
+                connection.close()
+
+
+class TestIntegrationAdmissionSuite(unittest.TestCase):
+    def setUp(self):
+        self.release = release = threading.Event()
+
+        class Handler(api.MainHTTPHandler):
+            get_router = dict(api.MainHTTPHandler.get_router, slow=lambda: release.wait(5) and "done")
+            timeout = 5
+
+        self.server = api.ThreadPoolHTTPServer(("localhost", 0), Handler, 2, max_queue=1)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def tearDown(self):
+        self.release.set()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def get(self, path):
+        connection = http.client.HTTPConnection("localhost", self.server.server_address[1], timeout=5)
+        try:
+            connection.request("GET", path)
+            response = connection.getresponse()
+            return response.status, response.getheader("Retry-After"), response.read()
+        finally:
+            connection.close()
+
+    def test_shed(self):
+        results = []
+        clients = [threading.Thread(target=lambda: results.append(self.get("/slow"))) for _ in range(3)]
+        for client in clients:
+            client.start()
+        deadline = time.monotonic() + 5
+        while self.server.limiter.stats() != {"active": 2, "queued": 1, "shed": 0} and time.monotonic() < deadline:
+            time.sleep(0.001)
+        started = time.monotonic()
+        code, retry_after, body = self.get("/slow")
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertEqual(api.SERVICE_UNAVAILABLE, code)
+        self.assertEqual("1", retry_after)
+        self.assertEqual(api.SERVICE_UNAVAILABLE, json.loads(body)["code"])
+        self.assertEqual(1, self.server.limiter.stats()["shed"])
+        self.release.set()
+        for client in clients:
+            client.join()
+        self.assertEqual([api.OK] * 3, [code for code, _, _ in results])
+        # the threads release their places right after the answers are sent
+        while self.server.limiter.stats() != {"active": 0, "queued": 0, "shed": 1} and time.monotonic() < deadline:
+            time.sleep(0.001)
+        self.assertEqual(api.OK, self.get("/slow")[0])
+
+
+class TestIntegrationServingSuite(unittest.TestCase):
+    class Handler(api.MainHTTPHandler):
+        get_router = dict(api.MainHTTPHandler.get_router, slow=lambda: time.sleep(0.3) or str(os.getpid()))
+        timeout = 5
+
+    def get_concurrently(self, port, clients):
+        results = []
+
+        def get():
+            connection = http.client.HTTPConnection("localhost", port, timeout=5)
+            try:
+                connection.request("GET", "/slow")
+                response = connection.getresponse()
+                results.append((response.status, response.read().decode('utf-8')))
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=get) for _ in range(clients)]
+        started = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results, time.monotonic() - started
+
+    def test_thread_pool(self):
+        server = api.ThreadPoolHTTPServer(("localhost", 0), self.Handler, 4)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            results, elapsed = self.get_concurrently(server.server_address[1], 4)
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertEqual([api.OK] * 4, [code for code, _ in results])
+        self.assertLess(elapsed, 0.9)
+
+    def test_forked(self):
+        server = HTTPServer(("localhost", 0), self.Handler)
+        pid = os.fork()
+        if pid == 0:
+            try:
+                api.serve_forked(server, 2)
+            finally:
+                os._exit(0)
+        server.server_close()
+        try:
+            results, elapsed = self.get_concurrently(server.server_address[1], 4)
+        finally:
+            os.kill(pid, signal.SIGTERM)
+            os.waitpid(pid, 0)
+        self.assertEqual([api.OK] * 4, [code for code, _ in results])
+        self.assertEqual(2, len({worker for _, worker in results}))
+        self.assertLess(elapsed, 1.1)
+
+
+class TestIntegrationProfilingSuite(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.profiler = profiling.profiler
+        profiling.profiler = profiling.Profiler(self.directory.name)
+        self.store = MockStore(MockStoreConnection())
+
+    def tearDown(self):
+        session = profiling.profiler.active
+        if session is not None:
+            session.wait(5)
+        profiling.profiler = self.profiler
+        self.directory.cleanup()
+
+    def route(self, request):
+        set_valid_auth(request)
+        return api.route_request(api.MainHTTPHandler.router, "/method", json.dumps(request), {},
+                                 {"request_id": "1"}, self.store)
+
+    def profile(self, **arguments):
+        return self.route({"account": "horns&hoofs", "login": "admin", "method": "profile", "arguments": arguments})
+
+    def test_only_admin(self):
+        response, code = self.route({"account": "horns&hoofs", "login": "h&f", "method": "profile",
+                                     "arguments": {}})
+        self.assertEqual(api.FORBIDDEN, code)
+        self.assertIsNone(profiling.profiler.active)
+        _, code = self.profile(mode="perf")
+        self.assertEqual(api.INVALID_REQUEST, code)
+
+    def test_cprofile_requests(self):
+        response, code = self.profile(mode="cprofile", requests=2, seconds=30)
+        self.assertEqual(api.OK, code)
+        self.assertTrue(response["started_now"])
+        response, code = self.profile(mode="sampling")
+        self.assertEqual(api.OK, code)
+        self.assertFalse(response["started_now"])
+        for _ in range(2):
+            _, code = self.route({"account": "horns&hoofs", "login": "h&f", "method": "online_score",
+                                  "arguments": {"phone": "79175002040", "email": "dev@otus.ru"}})
+            self.assertEqual(api.OK, code)
+        self.assertTrue(profiling.profiler.last.wait(5))
+        status, _ = self.profile(action="status")
+        self.assertEqual("done", status["state"])
+        self.assertEqual(2, status["samples"])
+        functions = [function for _, _, function in pstats.Stats(status["file"]).stats]
+        self.assertIn("method_handler", functions)
+
+    @cases([{"requests": 0.5}, {"requests": 1.0}, {"requests": 0}, {"requests": True}, {"seconds": "1"}])
+    def test_invalid_arguments(self, arguments):
+        _, code = self.profile(mode="cprofile", **arguments)
+        self.assertEqual(api.INVALID_REQUEST, code)
+        self.assertIsNone(profiling.profiler.active)
+
+    def test_null_arguments_are_defaults(self):
+        response, code = self.profile(mode="cprofile", seconds=None, requests=1)
+        self.assertEqual(api.OK, code)
+        self.assertEqual(profiling.DEFAULT_SECONDS, profiling.profiler.active.timer.interval)
+        _, code = self.route({"account": "horns&hoofs", "login": "h&f", "method": "online_score",
+                              "arguments": {"phone": "79175002040", "email": "dev@otus.ru"}})
+        self.assertEqual(api.OK, code)
+        self.assertTrue(profiling.profiler.last.wait(5))
+        self.assertEqual(1, profiling.profiler.status()["samples"])
+
+    def test_sampling(self):
+        response, code = self.profile(mode="sampling", seconds=0.2)
+        self.assertEqual(api.OK, code)
+        self.assertEqual("running", response["state"])
+        self.assertTrue(profiling.profiler.last.wait(5))
+        status, _ = self.profile(action="status")
+        self.assertEqual("done", status["state"])
+        with open(status["file"]) as f:
+            lines = f.read().splitlines()
+        self.assertTrue(lines)
+        stack, count = lines[0].rsplit(" ", 1)
+        self.assertTrue(int(count) > 0)
+        self.assertIn(";", stack)
+
+    def test_unwritable_directory(self):
+        path = os.path.join(self.directory.name, "file")
+        open(path, "w").close()
+        profiling.profiler.directory = path
+        response, code = self.profile(mode="cprofile", requests=1)
+        self.assertEqual(api.INVALID_REQUEST, code)
+        self.assertIsNone(profiling.profiler.active)
+
+        profiling.profiler.directory = os.path.join(self.directory.name, "profiles")
+        _, code = self.profile(mode="cprofile", requests=1)
+        self.assertEqual(api.OK, code)
+        os.rmdir(profiling.profiler.directory)
+        for _ in range(3):
+            _, code = self.route({"account": "horns&hoofs", "login": "h&f", "method": "online_score",
+                                  "arguments": {"phone": "79175002040", "email": "dev@otus.ru"}})
+            self.assertEqual(api.OK, code)
+        self.assertTrue(profiling.profiler.last.wait(5))
+        status, _ = self.profile(action="status")
+        self.assertEqual("failed", status["state"])
+        self.assertTrue(status["error"])
+        self.assertIsNone(profiling.profiler.active)
+
+        session = profiling.SamplingSession(os.path.join(path, "stacks"), 0.01, on_finish=profiling.profiler.finished)
+        profiling.profiler.active = session
+        session.start()
+        self.assertTrue(session.wait(5))
+        self.assertEqual("failed", session.status()["state"])
+        self.assertIsNone(profiling.profiler.active)
+
+
+class TestIntegrationLoadtestSuite(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.results = os.path.join(self.directory.name, "loadtest.jsonl")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def run_loadtest(self, **options):
+        defaults = {"mode": "inprocess", "requests": 50, "concurrency": 2, "threads": 2, "url": None, "seed": 0,
+                    "save": self.results, "compare": self.results, "max_regression": None}
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            status = loadtest.main(optparse.Values(dict(defaults, **options)))
+        return status, output.getvalue()
+
+    def test_short_runs(self):
+        status, output = self.run_loadtest()
+        self.assertEqual(0, status)
+        self.assertIn("No saved results of the inprocess mode", output)
+        status, output = self.run_loadtest(mode="http")
+        self.assertEqual(0, status)
+        self.assertIn("No saved results of the http mode with concurrency 2 and threads 2", output)
+        status, output = self.run_loadtest(mode="http", threads=1)
+        self.assertIn("No saved results of the http mode with concurrency 2 and threads 1", output)
+        status, output = self.run_loadtest(mode="http")
+        self.assertIn("rps", output)
+        with open(self.results) as f:
+            results = [json.loads(line) for line in f]
+        self.assertEqual([0, 2, 1, 2], [result["threads"] for result in results])
+        self.assertEqual([50] * 4, [result["requests"] for result in results])
+        for result in results:
+            self.assertNotIn("500", result["codes"])
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -1,8 +1,29 @@
+import hashlib
+import io
+import json
+import logging
+import optparse
+import os
+import subprocess
+import sys
+import threading
+import time
 import unittest
+from datetime import datetime
 
-from store import MockStore, MockStoreConnection
+from store import MockStore, MockStoreConnection, MeteredStore, BreakerStore
 import api
-from help_functions import cases, set_valid_auth
+from cache import TTLCache
+from auth import AuthVerifier
+from breaker import CircuitBreaker, CLOSED, OPEN, HALF_OPEN
+import scoring
+import scoring_kernel
+import serializers
+import metrics
+import logs
+from memo import ResponseMemo, request_key
+from admission import ConcurrencyLimiter, RateLimiter, request_cost
+from help_functions import cases, set_valid_auth, get_store_cache_key
 
 
 class TestModuleSuite(unittest.TestCase):
@@ -210,5 +231,611 @@ class TestModuleSuite(unittest.TestCase):
         self.assertTrue(len(response))
 
 
+class TestCompiledValidatorSuite(unittest.TestCase):
+    @staticmethod
+    def error(f, *args, **kwargs):
+        try:
+            f(*args, **kwargs)
+        except (TypeError, ValueError) as e:
+            return type(e), str(e)
+
+    @cases([
+        {"phone": "79175002040", "email": "devotus.ru", "gender": 1, "birthday": "01.01.2000", "first_name": 1},
+        {"phone": "7917500d040", "email": 43, "gender": -1, "birthday": "01.01.1930"},
+        {"phone": "79175002040", "gender": "1", "birthday": "01.01.2000"},
+        {"phone": "79175002040", "email": "dev@otus.ru", "birthday": "01.01.1930"},
+        {"phone": "79175002040", "email": "dev@otus.ru", "unknown": 1},
+    ])
+    def test_same_errors_online_score(self, arguments):
+        self.assertEqual(self.error(api.OnlineScoreRequest, **arguments),
+                         self.error(api.validate_online_score_request, arguments), arguments)
+
+    @cases([
+        {"date": "01.01.2020"},
+        {"date": "01.01.20", "client_ids": [1, 2]},
+        {"date": "01.01.2020", "client_ids": ["1"]},
+        {"date": "01.01.2020", "client_ids": []},
+    ])
+    def test_same_errors_clients_interests(self, arguments):
+        self.assertEqual(self.error(api.ClientsInterestsRequest, **arguments),
+                         self.error(api.validate_clients_interests_request, arguments), arguments)
+
+    @cases([
+        {"phone": "79175002040", "email": "dev@otus.ru"},
+        {"gender": 0, "birthday": "01.01.2000"},
+        {"first_name": "", "last_name": ""},
+    ])
+    def test_pairs(self, arguments):
+        request = api.validate_online_score_request(arguments)
+        for k, v in arguments.items():
+            self.assertEqual(api.parse_date(v) if k == "birthday" else v, getattr(request, k))
+
+    def test_slots(self):
+        request = api.validate_online_score_request({"phone": 79175002040, "gender": 0, "birthday": "01.01.2000"})
+        self.assertFalse(hasattr(request, "__dict__"))
+        self.assertEqual({"phone": 79175002040, "gender": 0, "birthday": api.parse_date("01.01.2000")},
+                         api.get_score_arguments(request))
+
+    @cases([
+        ({"phone": 79175002040, "email": "dev@otus.ru"}, 3.0),
+        ({"gender": 0, "birthday": "01.01.2000"}, 1.5),
+        ({"phone": "79175002040", "gender": 0, "birthday": "01.01.2000", "first_name": "", "last_name": ""}, 3.0),
+    ])
+    def test_direct_arguments(self, arguments, score):
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "online_score", "arguments": arguments}
+        set_valid_auth(request)
+        store = MockStore(MockStoreConnection())
+        context = {}
+        response, code = api.method_handler({"body": request, "headers": {}}, context, store)
+        self.assertEqual((api.OK, score), (code, response["score"]))
+        self.assertEqual(sorted(arguments), sorted(context["has"]))
+        # the key of the integer phone is the same as of the string one
+        self.assertIn(get_store_cache_key(request), store.store_cache)
+
+    def test_keyword_only_and_varargs(self):
+        class Request(object):
+            __slots__ = ('_phone',)
+            phone = api.PhoneField(required=False, nullable=True)
+
+            def __init__(self, *, phone=None):
+                self.phone = phone
+
+        self.assertEqual(79175002040, api.compile_validator(Request)({"phone": 79175002040}).phone)
+
+        class VarRequest(Request):
+            __slots__ = ()
+
+            def __init__(self, **kwargs):
+                super().__init__(**kwargs)
+
+        self.assertRaises(TypeError, api.compile_validator, VarRequest)
+
+
+class TestParseDateSuite(unittest.TestCase):
+    @cases(["01.01.2000", "1.1.2000", "29.02.2020", "31.12.1999"])
+    def test_same_as_strptime(self, value):
+        self.assertEqual(datetime.strptime(value, "%d.%m.%Y").date(), api.parse_date(value))
+
+    @cases(["01.01.20", "01/01/2000", "29.02.2021", "05.30.2020", "01.01.20000", "a.b.cdef", "", "+1.01.2000"])
+    def test_invalid(self, value):
+        with self.assertRaises(ValueError):
+            api.parse_date(value)
+
+
+@unittest.skipIf(scoring_kernel.np is None, "numpy is not installed")
+class TestScoringKernelSuite(unittest.TestCase):
+    requests = [
+        {},
+        {"phone": "79175002040", "email": "dev@otus.ru"},
+        {"phone": "79175002040", "gender": "0", "birthday": "01.01.2000"},
+        {"gender": "1", "birthday": "01.01.2000", "first_name": "a", "last_name": "b"},
+        {"first_name": "a", "last_name": ""},
+        {"phone": "79175002040", "email": "dev@otus.ru", "gender": "2", "birthday": "01.01.2000",
+         "first_name": "a", "last_name": "b"},
+    ]
+
+    def test_same_as_compute_score(self):
+        scores = scoring_kernel.score_requests(self.requests)
+        self.assertEqual([scoring.compute_score(**r) for r in self.requests], scores.tolist())
+
+    def test_all_masks(self):
+        masks = list(range(64))
+        columns = [[(m >> n) & 1 for m in masks] for n in range(len(scoring_kernel.FIELDS))]
+        expected = [scoring.compute_score(**{name: True if (m >> n) & 1 else None
+                                             for n, name in enumerate(scoring_kernel.FIELDS)}) for m in masks]
+        self.assertEqual(expected, scoring_kernel.score_masks(masks).tolist())
+        self.assertEqual(expected, scoring_kernel.score_columns(*columns).tolist())
+
+    def test_keys(self):
+        self.assertEqual([scoring.get_score_key(**r) for r in self.requests], scoring_kernel.score_keys(self.requests))
+
+
+class TestTTLCacheSuite(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.
+        self.cache = TTLCache(capacity=3, clock=lambda: self.now)
+
+    def test_lru_eviction(self):
+        for key in "abc":
+            self.cache.set(key, key, 60)
+        self.assertEqual("a", self.cache.get("a"))
+        self.cache.set("d", "d", 60)
+        self.assertEqual(["a", "c", "d"], [k for k in "abcd" if k in self.cache])
+        self.assertEqual(1, self.cache.stats()["evictions"])
+
+    def test_expiry(self):
+        self.cache.set("a", 1, 10)
+        self.cache.set("b", 2, None)
+        self.now += 10
+        self.assertIsNone(self.cache.get("a"))
+        self.assertEqual(2, self.cache.get("b"))
+        self.cache.set("c", 3, 10)
+        self.now += 5
+        self.cache.set("d", 4, 10)
+        self.assertEqual(3, len(self.cache))
+        self.now += 5
+        self.cache.set("e", 5, 10)
+        self.assertEqual(["d", "e"], [k for k in "abcde" if k in self.cache])
+        self.assertEqual({"size": 2, "capacity": 3, "hits": 1, "misses": 1, "evictions": 1, "expirations": 2},
+                         self.cache.stats())
+
+    def test_expiry_heap_is_bounded(self):
+        for n in range(1000):
+            self.cache.set(n % 5, n, 3600)
+        self.assertTrue(len(self.cache.expiry) <= 2 * len(self.cache) + 64)
+
+    def test_many(self):
+        self.cache.set_many({"a": 1, "b": 2}, 10)
+        self.assertEqual([1, None, 2], self.cache.get_many(["a", "c", "b"]))
+
+
+class TestAuthVerifierSuite(unittest.TestCase):
+    def setUp(self):
+        self.now = datetime(2026, 1, 1, 10, 59, 59).timestamp()
+        self.verifier = AuthVerifier(api.SALT, api.ADMIN_SALT, capacity=2, clock=lambda: self.now)
+
+    @staticmethod
+    def request(body):
+        return api.validate_method_request(dict(body, method="online_score", arguments={}))
+
+    def test_cached_user_digest(self):
+        body = {"account": "horns&hoofs", "login": "h&f"}
+        set_valid_auth(body)
+        for _ in range(3):
+            self.assertTrue(self.verifier.verify(self.request(body)))
+        self.assertFalse(self.verifier.verify(self.request(dict(body, token=body["token"][:-1]))))
+        self.assertFalse(self.verifier.verify(self.request(dict(body, token="токен"))))
+        stats = self.verifier.stats()
+        self.assertEqual((1, 4), (stats["misses"], stats["hits"]))
+
+    def test_admin_token_rollover(self):
+        token = hashlib.sha512(("2026010110" + api.ADMIN_SALT).encode('utf-8')).hexdigest()
+        body = {"account": "horns&hoofs", "login": "admin", "token": token}
+        self.assertTrue(self.verifier.verify(self.request(body)))
+        self.now += 1
+        self.assertFalse(self.verifier.verify(self.request(body)))
+        self.assertEqual(2, self.verifier.stats()["admin_refreshes"])
+
+
+class TestSerializersSuite(unittest.TestCase):
+    def test_backends(self):
+        value = {"code": 200, "response": {"1": ["книги", "tv"], "score": 1.5}}
+        for name, (dumps, loads) in serializers.available_backends().items():
+            self.assertIsInstance(dumps(value), bytes, name)
+            self.assertEqual(value, loads(dumps(value)), name)
+            self.assertEqual(value, loads(dumps(value).decode('utf-8')), name)
+            with self.assertRaises(ValueError):
+                loads(b"{not a json")
+
+    @cases([
+        b'{"client_ids": [123456789012345678901234567890, -98765432109876543210, 1]}',
+        '{"phone": 79175002040123456789, "text": "\u0442\u0435\u043a\u0441\u0442"}',
+        b'{"score": NaN, "max": Infinity, "min": -Infinity}',
+        b'{"ids": [9223372036854775807, 18446744073709551615, 1e300, 0.5]}',
+        '{"token": "12345678901234567890abcdef", "items": [{"a": null}, true, false]}',
+    ])
+    def test_backends_decode_the_same(self, document):
+        expected = repr(json.loads(document))
+        for name, (dumps, loads) in serializers.available_backends().items():
+            self.assertEqual(expected, repr(loads(document)), name)
+
+    def test_big_integers(self):
+        value = {"id": 2 ** 70, "ids": [-2 ** 64, 1]}
+        for name, (dumps, loads) in serializers.available_backends().items():
+            self.assertEqual(value, loads(dumps(value)), name)
+
+    def test_only_selected_backend_is_imported(self):
+        code = "import sys, serializers; print(serializers.backend, 'orjson' in sys.modules, 'ujson' in sys.modules)"
+        output = subprocess.run([sys.executable, "-c", code], env=dict(os.environ, SCORING_JSON="json"),
+                                cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, check=True)
+        self.assertEqual(b"json False False", output.stdout.strip())
+        self.assertRaises(ImportError, serializers.select_backend, "unknown")
+
+
+class TestCircuitBreakerSuite(unittest.TestCase):
+    def setUp(self):
+        self.now = 0.
+        self.breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10, clock=lambda: self.now)
+
+    def test_open_after_failures(self):
+        self.breaker.record_failure()
+        self.assertEqual(CLOSED, self.breaker.state)
+        self.breaker.record_success()
+        self.breaker.record_failure()
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record_failure()
+        self.assertEqual(OPEN, self.breaker.state)
+        self.assertFalse(self.breaker.allow())
+
+    def test_half_open(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.now = 10
+        self.assertEqual(HALF_OPEN, self.breaker.state)
+        self.assertTrue(self.breaker.allow())
+        self.assertFalse(self.breaker.allow())
+        self.breaker.record_failure()
+        self.assertEqual(OPEN, self.breaker.state)
+        self.now = 20
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record_success()
+        self.assertEqual(CLOSED, self.breaker.state)
+        transitions = self.breaker.snapshot()["transitions"]
+        self.assertEqual((1, 2, 1, 1), (transitions["closed->open"], transitions["open->half_open"],
+                                        transitions["half_open->open"], transitions["half_open->closed"]))
+
+    def test_metrics(self):
+        registry = metrics.Registry()
+        registry.register(api.breaker_collector(self.breaker), "scoring_breaker")
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.now = 10
+        self.assertTrue(self.breaker.allow())
+        text = registry.render()
+        self.assertIn('scoring_breaker_state{state="half_open"} 1', text)
+        self.assertIn('scoring_breaker_state{state="open"} 0', text)
+        self.assertIn('scoring_breaker_state{state="closed"} 0', text)
+        self.assertIn("scoring_breaker_failures 2", text)
+        self.assertIn("# TYPE scoring_breaker_transitions_total counter", text)
+        self.assertIn('scoring_breaker_transitions_total{from="closed",to="open"} 1', text)
+        self.assertIn('scoring_breaker_transitions_total{from="open",to="half_open"} 1', text)
+        self.assertIn('scoring_breaker_transitions_total{from="half_open",to="closed"} 0', text)
+
+    def test_listener_reads_state(self):
+        seen = []
+        self.breaker.listeners.append(lambda old, new: seen.append((new, self.breaker.state,
+                                                                    self.breaker.snapshot()["state"])))
+        caller = threading.Thread(target=lambda: [self.breaker.record_failure() for _ in range(2)], daemon=True)
+        caller.start()
+        caller.join(5)
+        self.assertFalse(caller.is_alive())
+        self.assertEqual([(OPEN, OPEN, OPEN)], seen)
+
+    def test_trial_released_on_other_errors(self):
+        store = BreakerStore(MockStore(MockStoreConnection()), self.breaker)
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.now = 10
+
+        def fail(key):
+            raise KeyError(key)
+
+        with self.assertRaises(KeyError):
+            store.call(fail, "i:1")
+        self.assertEqual(HALF_OPEN, self.breaker.state)
+        self.assertTrue(self.breaker.allow())
+
+
+class TestMetricsSuite(unittest.TestCase):
+    def setUp(self):
+        self.registry = metrics.Registry()
+
+    def test_histogram(self):
+        histogram = self.registry.histogram("latency_seconds", (("stage", "auth"),), "Latency")
+        for value in (0.00001, 0.0003, 0.0003, 10):
+            histogram.observe(value)
+        text = self.registry.render()
+        self.assertIn("# TYPE latency_seconds histogram", text)
+        self.assertIn('latency_seconds_bucket{stage="auth",le="5e-05"} 1', text)
+        self.assertIn('latency_seconds_bucket{stage="auth",le="0.0005"} 3', text)
+        self.assertIn('latency_seconds_bucket{stage="auth",le="5.0"} 3', text)
+        self.assertIn('latency_seconds_bucket{stage="auth",le="+Inf"} 4', text)
+        self.assertIn('latency_seconds_count{stage="auth"} 4', text)
+        self.assertIs(histogram, self.registry.histogram("latency_seconds", (("stage", "auth"),)))
+
+    def test_metered_store(self):
+        store = MeteredStore(MockStore(MockStoreConnection()), self.registry)
+        store.cache_set("a", 1.5, 60)
+        self.assertEqual([1.5, None], store.cache_get_many(["a", "b"]))
+        self.assertIsNone(store.cache_get("c"))
+        text = self.registry.render()
+        self.assertIn("scoring_cache_hits_total 1", text)
+        self.assertIn("scoring_cache_misses_total 2", text)
+        self.assertIn("scoring_cache_hit_ratio 0.3333", text)
+        self.assertIn('scoring_store_seconds_count{operation="cache_set"} 1', text)
+
+    def test_counter_threads(self):
+        counter = self.registry.counter("requests_total")
+        threads = [threading.Thread(target=lambda: [counter.inc() for _ in range(1000)]) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(4000, counter.value)
+        self.assertIn("requests_total 4000", self.registry.render())
+
+    def test_collectors_are_replaced(self):
+        for _ in range(2):
+            MeteredStore(MockStore(MockStoreConnection()), self.registry)
+            self.registry.register(metrics.stats_collector("scoring_l1", lambda: {"hits": 1}))
+        lines = self.registry.render().splitlines()
+        self.assertEqual(1, lines.count("scoring_cache_hit_ratio 0.0"))
+        self.assertEqual(1, lines.count("scoring_l1_hits 1"))
+
+    def handle(self, token=""):
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "online_score", "token": token,
+                   "arguments": {"phone": "79175002040", "email": "dev@otus.ru"}}
+        if not token:
+            set_valid_auth(request)
+        api.method_handler({"body": request, "headers": {}}, {}, MockStore(MockStoreConnection()))
+
+    def test_method_handler_stages(self):
+        histograms = api.stage_histograms("online_score")
+        counts = lambda: tuple(sum(histogram.counts) for histogram in histograms)
+        before = counts()
+        self.handle("invalid")
+        self.handle()
+        self.assertEqual(before, counts())
+        api.detailed_metrics = True
+        try:
+            self.handle("invalid")
+            self.handle()
+        finally:
+            api.detailed_metrics = False
+        self.assertEqual((2, 2, 1), tuple(a - b for a, b in zip(counts(), before)))
+        text = api.metrics_handler()
+        self.assertIn('scoring_request_seconds_count{method="online_score",code="403"}', text)
+        self.assertIn('scoring_request_seconds_count{method="online_score",code="200"}', text)
+
+
+class TestLogsSuite(unittest.TestCase):
+    def setUp(self):
+        self.output = io.StringIO()
+        self.logger = logging.getLogger("test.logs")
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+        self.pipeline = None
+
+    def tearDown(self):
+        if self.pipeline is not None:
+            self.logger.removeHandler(self.pipeline.handler)
+            self.pipeline.stop()
+
+    def attach(self, queue_size):
+        target = logging.StreamHandler(self.output)
+        target.setFormatter(logs.JsonFormatter())
+        self.pipeline = logs.AsyncLogging(target, logs.Sampler(), queue_size=queue_size)
+        self.logger.addHandler(self.pipeline.handler)
+
+    def test_json_records(self):
+        self.attach(10)
+        self.pipeline.start()
+        self.logger.info("request", extra={"context": {"request_id": "1", "code": 200, "has": ["phone"]}})
+        self.logger.warning("Store %s is down", "resp")
+        self.pipeline.stop()
+        records = [json.loads(line) for line in self.output.getvalue().splitlines()]
+        self.assertEqual(["1", 200, ["phone"]], [records[0][k] for k in ("request_id", "code", "has")])
+        self.assertEqual(("WARNING", "Store resp is down"), (records[1]["level"], records[1]["message"]))
+
+    def test_full_queue(self):
+        self.attach(1)
+        dropped = logs.dropped_full.value
+        self.logger.info("first")
+        self.logger.info("second")
+        self.assertEqual(1, logs.dropped_full.value - dropped)
+        self.pipeline.start()
+        self.pipeline.stop()
+        self.assertEqual(["first"], [json.loads(line)["message"] for line in self.output.getvalue().splitlines()])
+
+    def test_queue_after_fork(self):
+        self.attach(1)
+        inherited = self.pipeline.handler.queue
+        self.pipeline.start()
+        self.pipeline.stop()
+        self.assertIs(inherited, self.pipeline.handler.queue)
+        self.pipeline.pid = -1
+        self.pipeline.start()
+        self.assertIsNot(inherited, self.pipeline.handler.queue)
+
+    def test_sampler(self):
+        now, draws = [0.], iter([0.05, 0.5, 0.05, 0.05, 0.05])
+        sampler = logs.Sampler({logging.INFO: 0.1}, rate_limit=2, clock=lambda: now[0], random=lambda: next(draws))
+        self.assertEqual([True, False, True, False], [sampler.allow(logging.INFO) for _ in range(4)])
+        self.assertTrue(sampler.allow(logging.ERROR))
+        now[0] = 1.
+        self.assertTrue(sampler.allow(logging.INFO))
+
+
+class TestResponseMemoSuite(unittest.TestCase):
+    class Request(object):
+        def __init__(self, method, arguments):
+            self.method = method
+            self.arguments = arguments
+
+    def setUp(self):
+        self.memo = ResponseMemo(capacity=10, ttl=60)
+        self.calls = 0
+
+    def method_apply(self, request, store):
+        self.calls += 1
+        return api.OK, {"calls": self.calls}, {"nclients": 1}
+
+    def test_key(self):
+        self.assertEqual(request_key("clients_interests", {"client_ids": [1, 2], "date": "19.07.2017"}),
+                         request_key("clients_interests", {"date": "19.07.2017", "client_ids": [1, 2]}))
+        self.assertNotEqual(request_key("clients_interests", {"client_ids": [1, 2]}),
+                            request_key("clients_interests", {"client_ids": [2, 1]}))
+
+    def test_memoized(self):
+        request = self.Request("clients_interests", {"client_ids": [1, 2]})
+        self.assertEqual({"calls": 1}, self.memo.apply(request, None, self.method_apply, api.OK)[1])
+        self.assertEqual({"calls": 1}, self.memo.apply(request, None, self.method_apply, api.OK)[1])
+        other = self.Request("online_score", {"first_name": "a", "last_name": "b"})
+        self.memo.apply(other, None, self.method_apply, api.OK)
+        self.memo.apply(other, None, self.method_apply, api.OK)
+        self.assertEqual(3, self.calls)
+        self.memo.apply(self.Request("clients_interests", {}), None,
+                        lambda request, store: (api.INVALID_REQUEST, "error", {}), api.OK)
+        self.assertEqual(1, self.memo.stats()["size"])
+
+    def test_in_flight(self):
+        started, release = threading.Event(), threading.Event()
+
+        def slow_apply(request, store):
+            started.set()
+            release.wait(5)
+            return self.method_apply(request, store)
+
+        request = self.Request("clients_interests", {"client_ids": [1]})
+        results = []
+        leader = threading.Thread(target=lambda: results.append(self.memo.apply(request, None, slow_apply, api.OK)))
+        leader.start()
+        started.wait(5)
+        follower = threading.Thread(target=lambda: results.append(self.memo.apply(request, None, slow_apply, api.OK)))
+        follower.start()
+        while self.memo.coalesced == 0:
+            time.sleep(0.001)
+        release.set()
+        leader.join()
+        follower.join()
+        self.assertEqual(1, self.calls)
+        self.assertEqual(results[0], results[1])
+
+    def test_auth_is_checked(self):
+        api.response_memo = self.memo
+        try:
+            request = {"account": "horns&hoofs", "login": "h&f", "method": "clients_interests",
+                       "arguments": {"client_ids": [1, 2]}}
+            set_valid_auth(request)
+            store = MockStore(MockStoreConnection())
+            response, code = api.method_handler({"body": request, "headers": {}}, {}, store)
+            self.assertEqual(api.OK, code)
+            request["token"] = "bad"
+            _, code = api.method_handler({"body": request, "headers": {}}, {}, store)
+            self.assertEqual(api.FORBIDDEN, code)
+            set_valid_auth(request)
+            context = {}
+            self.assertEqual((response, api.OK), api.method_handler({"body": request, "headers": {}}, context, store))
+            self.assertEqual(2, context["nclients"])
+            self.assertEqual(1, self.memo.stats()["hits"])
+        finally:
+            api.response_memo = None
+
+
+class TestAdmissionSuite(unittest.TestCase):
+    def setUp(self):
+        self.now = 0.
+        self.limiter = RateLimiter(rate=2, burst=4, capacity=2, clock=lambda: self.now)
+
+    def test_refill(self):
+        self.assertEqual([True] * 4 + [False], [self.limiter.allow("a") for _ in range(5)])
+        self.now = 0.5
+        self.assertTrue(self.limiter.allow("a"))
+        self.assertFalse(self.limiter.allow("a"))
+        self.now = 100
+        self.assertEqual([True] * 4 + [False], [self.limiter.allow("a") for _ in range(5)])
+        self.assertEqual({"admitted": 9, "rejected": 3, "accounts": 1}, self.limiter.stats())
+
+    def test_cost(self):
+        self.assertTrue(self.limiter.allow("a", cost=10))
+        self.now = 2
+        self.assertFalse(self.limiter.allow("a"))
+        self.now = 3.5
+        self.assertTrue(self.limiter.allow("a"))
+        self.assertFalse(self.limiter.allow("b", cost=3) and self.limiter.allow("b", cost=3))
+
+    def test_capacity(self):
+        self.limiter.allow("a", cost=4)
+        self.limiter.allow("b", cost=4)
+        self.limiter.allow("a")
+        self.limiter.allow("c")
+        self.assertEqual(["a", "c"], list(self.limiter.buckets))
+        self.assertEqual(2, self.limiter.stats()["accounts"])
+
+    @cases([
+        ("clients_interests", {"client_ids": [1, 2, 3], "date": "19.07.2017"}, 3),
+        ("online_score_batch", {"items": [{}, {}]}, 2),
+        ("online_score", {"client_ids": [1, 2, 3]}, 1),
+        ("clients_interests", {"client_ids": "1,2"}, 1),
+        ("clients_interests", {"client_ids": []}, 1),
+        ("clients_interests", None, 1),
+    ])
+    def test_request_cost(self, method, arguments, cost):
+        self.assertEqual(cost, request_cost(method, arguments))
+
+    def test_concurrency(self):
+        limiter = ConcurrencyLimiter(2, max_queue=1)
+        self.assertEqual([True, True, True, False], [limiter.acquire() for _ in range(4)])
+        limiter.start()
+        limiter.start()
+        self.assertEqual({"active": 2, "queued": 1, "shed": 1}, limiter.stats())
+        self.assertFalse(limiter.acquire())
+        limiter.release()
+        self.assertTrue(limiter.acquire())
+        limiter.cancel()
+        self.assertEqual({"active": 1, "queued": 1, "shed": 2}, limiter.stats())
+
+    def test_method_handler(self):
+        api.rate_limiter = self.limiter
+        try:
+            store = MockStore(MockStoreConnection())
+            request = {"account": "horns&hoofs", "login": "h&f", "method": "clients_interests",
+                       "arguments": {"client_ids": [1, 2, 3]}}
+            set_valid_auth(request)
+            _, code = api.method_handler({"body": request, "headers": {}}, {}, store)
+            self.assertEqual(api.OK, code)
+            response, code = api.method_handler({"body": request, "headers": {}}, {}, store)
+            self.assertEqual((api.ERRORS[api.TOO_MANY_REQUESTS], api.TOO_MANY_REQUESTS), (response, code))
+            request["token"] = "bad"
+            _, code = api.method_handler({"body": request, "headers": {}}, {}, store)
+            self.assertEqual(api.FORBIDDEN, code)
+            admin = {"account": "horns&hoofs", "login": "admin", "method": "clients_interests",
+                     "arguments": {"client_ids": [1, 2, 3]}}
+            set_valid_auth(admin)
+            for _ in range(3):
+                _, code = api.method_handler({"body": admin, "headers": {}}, {}, store)
+                self.assertEqual(api.OK, code)
+        finally:
+            api.rate_limiter = None
+
+
+class TestLazyStoreSuite(unittest.TestCase):
+    def test_created_on_first_use(self):
+        created = []
+
+        class Handler(object):
+            store = api.LazyStore(lambda: created.append(1) or MockStore(MockStoreConnection(connected=False)))
+
+        self.assertEqual([], created)
+        self.assertIs(Handler.store, Handler.store)
+        self.assertEqual([1], created)
+        Handler.store.server.connect_prob = 0
+        api.warm_up(Handler)
+        self.assertTrue(Handler.store.server.connected)
+
+    @cases([
+        ({"store": "resp://localhost:port", "interests_index": None}, "--store"),
+        ({"store": "redis://localhost:6379", "interests_index": None}, "--store"),
+        ({"store": None, "interests_index": "/nonexistent/index"}, "--interests-index"),
+        ({"store": None, "interests_index": __file__}, "--interests-index"),
+    ])
+    def test_bad_options_at_startup(self, options, option):
+        self.assertIn(option, api.check_store_options(optparse.Values(options)))
+
+    def test_good_options(self):
+        self.assertIsNone(api.check_store_options(optparse.Values({"store": "resp://localhost:6379",
+                                                                   "interests_index": None})))
+
+
 if __name__ == "__main__":
     unittest.main()